@@ -0,0 +1,23 @@
+"""Helper scripts for the HW1 Sentinel-5P workflow.
+
+Submodules are imported on first attribute access (``scripts.zonal_stats``)
+and defer their heavy dependencies (rasterio, sentinelhub, geopandas) to the
+functions that use them, so importing a helper stays cheap.
+"""
+import importlib
+
+__all__ = [
+    "evalscripts",
+    "s5p_composite",
+    "s5p_cube",
+    "s5p_tiles",
+    "sh_cache",
+    "stat_batch",
+    "zonal_stats",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,204 @@
+"""Multi-pollutant evalscripts: one request for any set of NO2, O3, CH4 and CO.
+
+The notebook evalscripts hard-code one variable each, so covering both assigned
+variables (or all four) for an interval means one request per variable. The
+generators here build a single evalscript for a list of variables:
+
+- ``raw_evalscript``: the latest value of every variable (SIMPLE mosaic);
+- ``mean_evalscript``: mean over the orbits of the time interval, one band per
+  variable. Every variable has its own valid samples (``dataMask == 1`` and a
+  finite value), so a missing CO retrieval does not drop the NO2 value of the
+  same orbit. Pixels without any valid sample are NaN;
+- ``stat_evalscript``: the same means for the Statistical API, with one output
+  per variable.
+
+``split_bands`` and ``split_stats`` turn the multi-band raster or statistics
+back into per-variable products shaped like the single-variable ones, so the
+rest of the notebook (zonal statistics, ``stats_to_df``) is unchanged:
+
+    variables = ["NO2", "CO"]
+    request = SentinelHubRequest(evalscript=mean_evalscript(variables), ...)
+    means = split_bands(cached_get_data([request], config=config)[0][0], variables)
+    means["NO2"]  # (height, width) like mean_data[0] of the NO2-only request
+"""
+import csv
+import math
+
+import numpy as np
+
+POLLUTANTS = ("NO2", "O3", "CH4", "CO")
+
+_VALUE_FUNCTIONS = """
+const VARIABLES = {variables};
+
+function isValid(sample, band) {{
+    const value = sample[band];
+    return sample.dataMask == 1 && value !== null && isFinite(value);
+}}
+
+function orbitMeans(samples) {{
+    const sums = VARIABLES.map(() => 0);
+    const counts = VARIABLES.map(() => 0);
+    for (const sample of samples) {{
+        VARIABLES.forEach((band, i) => {{
+            if (isValid(sample, band)) {{
+                sums[i] += sample[band];
+                counts[i] += 1;
+            }}
+        }});
+    }}
+    return {{
+        means: VARIABLES.map((_, i) => counts[i] > 0 ? sums[i] / counts[i] : NaN),
+        counts: counts
+    }};
+}}
+"""
+
+
+def check_variables(variables):
+    variables = list(dict.fromkeys(variables))
+    unknown = [v for v in variables if v not in POLLUTANTS]
+    if unknown or not variables:
+        raise ValueError(f"Variables must be a non-empty subset of {POLLUTANTS}, got {variables}")
+    return variables
+
+
+def _header(variables):
+    return "//VERSION=3\n" + _VALUE_FUNCTIONS.format(variables=str(variables).replace("'", '"'))
+
+
+def raw_evalscript(variables):
+    """Latest value of every variable, one FLOAT32 band per variable (NaN without data)."""
+    variables = check_variables(variables)
+    return _header(variables) + f"""
+function setup() {{
+    return {{
+        input: [{{bands: VARIABLES.concat(["dataMask"])}}],
+        output: {{bands: {len(variables)}, sampleType: "FLOAT32"}},
+        mosaicking: "SIMPLE"
+    }};
+}}
+
+function evaluatePixel(sample) {{
+    return VARIABLES.map(band => isValid(sample, band) ? sample[band] : NaN);
+}}
+"""
+
+
+def mean_evalscript(variables, with_counts=False):
+    """
+    Mean of the valid orbits of every variable, one FLOAT32 band per variable.
+    with_counts=True appends one band per variable with its number of valid orbits.
+    """
+    variables = check_variables(variables)
+    n_bands = len(variables) * (2 if with_counts else 1)
+    result = "result.means.concat(result.counts)" if with_counts else "result.means"
+    return _header(variables) + f"""
+function setup() {{
+    return {{
+        input: [{{bands: VARIABLES.concat(["dataMask"])}}],
+        output: {{bands: {n_bands}, sampleType: "FLOAT32"}},
+        mosaicking: "ORBIT"
+    }};
+}}
+
+function evaluatePixel(samples) {{
+    const result = orbitMeans(samples);
+    return {result};
+}}
+"""
+
+
+def stat_evalscript(variables):
+    """
+    Statistical API evalscript with one output per variable (id and band = variable name).
+    The dataMask output keeps pixels where at least one variable has a valid orbit;
+    the variables without data in such a pixel are NaN and dropped by split_stats.
+    """
+    variables = check_variables(variables)
+    outputs = ",\n".join(
+        f'            {{id: "{v}", bands: ["{v}"], sampleType: "FLOAT32"}}' for v in variables)
+    returned = ", ".join(f"{v}: [result.means[{i}]]" for i, v in enumerate(variables))
+    return _header(variables) + f"""
+function setup() {{
+    return {{
+        input: [{{bands: VARIABLES.concat(["dataMask"])}}],
+        output: [
+{outputs},
+            {{id: "dataMask", bands: 1}}
+        ],
+        mosaicking: "ORBIT"
+    }};
+}}
+
+function evaluatePixel(samples) {{
+    const result = orbitMeans(samples);
+    const anyValid = result.counts.some(count => count > 0) ? 1 : 0;
+    return {{{returned}, dataMask: [anyValid]}};
+}}
+"""
+
+
+def split_bands(data, variables, with_counts=False):
+    """
+    Per-variable arrays {variable: (height, width)} of a raster from raw/mean_evalscript.
+    with_counts=True (for mean_evalscript(..., with_counts=True)) returns (means, counts).
+    """
+    variables = check_variables(variables)
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[..., np.newaxis]
+    expected = len(variables) * (2 if with_counts else 1)
+    if data.shape[-1] != expected:
+        raise ValueError(f"Expected {expected} bands for {variables}, got {data.shape[-1]}")
+    means = {v: data[..., i] for i, v in enumerate(variables)}
+    if not with_counts:
+        return means
+    counts = {v: data[..., len(variables) + i] for i, v in enumerate(variables)}
+    return means, counts
+
+
+def _missing(value):
+    if value is None:
+        return True
+    if isinstance(value, str):
+        return value.lower() == "nan"
+    return isinstance(value, float) and math.isnan(value)
+
+
+def split_stats(stats_data, variables):
+    """
+    Per-variable Statistical API responses {variable: response} of a stat_evalscript request.
+    Every response looks like one from the single-variable notebook evalscript (output
+    "default", band = variable), so stats_to_df gives the usual default_<VAR>_<stat> columns.
+    Intervals where a variable has no valid value are marked as no data for that variable.
+    """
+    variables = check_variables(variables)
+    split = {v: dict(stats_data, data=[]) for v in variables}
+    for entry in stats_data.get("data", []):
+        outputs = entry.get("outputs", {})
+        for variable in variables:
+            if variable not in outputs:
+                continue
+            band = outputs[variable]["bands"][variable]
+            stats = dict(band["stats"])
+            if _missing(stats.get("mean")):
+                stats["noDataCount"] = stats.get("sampleCount", 0)
+            output = {"bands": {variable: dict(band, stats=stats)}}
+            split[variable]["data"].append(dict(entry, outputs={"default": output}))
+    return split
+
+
+def assigned_variables(assignments_csv, student=None):
+    """
+    Variables of the assignment table (Student, Year, Variable_1, Variable_2):
+    those of one student, or the union over all students, in POLLUTANTS order.
+    """
+    variables = set()
+    with open(assignments_csv, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if student is None or row["Student"] == student:
+                variables.update(row[c].strip() for c in ("Variable_1", "Variable_2") if row.get(c))
+    if student is not None and not variables:
+        raise ValueError(f"Student {student!r} not found in {assignments_csv}")
+    return check_variables([v for v in POLLUTANTS if v in variables])
@@ -0,0 +1,238 @@
+"""Local compositing of daily S5P rasters into period and rolling means.
+
+``evalscript_mean_mosaic`` averages all orbits of a period on the server, so a
+month, a season and a year over the same days are three expensive requests.
+Here every day is fetched once (all variables in one request, with the number
+of valid orbits per pixel, see ``evalscripts.mean_evalscript``) and stored as
+per-day sum and count rasters:
+
+    <store>/grid.json                      bbox, CRS and shape shared by all days
+    <store>/<variable>/day/<YYYY-MM-DD>.npz     sum, count of that day
+    <store>/<variable>/prefix/<YYYY-MM-DD>.npz  running sum, count up to that day
+
+The running (prefix) sums make any period a difference of two prefixes:
+
+    mean(start..end) = (S[end] - S[start - 1]) / (C[end] - C[start - 1])
+
+so a period mean, or every step of a rolling mean, reads two files whatever
+its length. Adding a day only extends the prefixes from that day on; days that
+are already fetched are never requested again.
+
+Usage:
+    fetch_days(["NO2", "CO"], days, bbox, (5000, 3500), config)
+    january, counts = period_mean("NO2", "2023-01-01", "2023-01-31")
+    for day, mean in rolling_mean("NO2", days, window_days=30): ...
+"""
+import os
+import json
+import datetime
+
+import numpy as np
+
+try:
+    from .evalscripts import check_variables, mean_evalscript, split_bands
+    from .sh_cache import MAX_THREADS, cached_get_data
+except ImportError:
+    from evalscripts import check_variables, mean_evalscript, split_bands
+    from sh_cache import MAX_THREADS, cached_get_data
+
+STORE_DIR = "downloads/composite"
+DAY_FORMAT = "%Y-%m-%d"
+
+
+def _day(value):
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value, DAY_FORMAT).date()
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _day_path(store_dir, variable, kind, day):
+    return os.path.join(store_dir, variable, kind, f"{day.strftime(DAY_FORMAT)}.npz")
+
+
+def _save_npz(path, **arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+# ----------------------------
+# Daily store
+# ----------------------------
+def check_grid(store_dir, grid):
+    """Record the grid (bbox, crs, shape) of the store, or check that a new day uses the same one."""
+    path = os.path.join(store_dir, "grid.json")
+    grid = json.loads(json.dumps(grid))  # tuples -> lists, as stored
+    if not os.path.exists(path):
+        os.makedirs(store_dir, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(grid, f, indent=1)
+        return
+    with open(path) as f:
+        stored = json.load(f)
+    if stored != grid:
+        raise ValueError(f"Grid {grid} does not match the store grid {stored} in {store_dir}")
+
+
+def stored_days(variable, store_dir=STORE_DIR):
+    directory = os.path.join(store_dir, variable, "day")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(_day(name[:-4]) for name in os.listdir(directory) if name.endswith(".npz"))
+
+
+def add_day(variable, day, mean, count, store_dir=STORE_DIR):
+    """Store the sum and valid-count rasters of one day (mean is NaN where count is 0)."""
+    count = np.rint(np.nan_to_num(count)).astype(np.uint16)
+    total = np.where(count > 0, np.nan_to_num(mean) * count, 0.0)
+    _save_npz(_day_path(store_dir, variable, "day", _day(day)), sum=total, count=count)
+
+
+def fetch_days(variables, days, bbox, resolution, config, store_dir=STORE_DIR, max_threads=MAX_THREADS):
+    """
+    Download the days not stored yet for any of the variables, one request per day for all
+    variables, and update the prefixes. bbox is a sentinelhub BBox.
+    """
+    from sentinelhub import DataCollection, MimeType, SentinelHubRequest
+
+    variables = check_variables(variables)
+    check_grid(store_dir, {"bbox": [bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y],
+                           "crs": bbox.crs.epsg, "resolution": list(resolution)})
+    days = sorted({_day(d) for d in days})
+    have = {v: set(stored_days(v, store_dir)) for v in variables}
+    missing = [d for d in days if any(d not in have[v] for v in variables)]
+    print(f"Composite store: {len(days) - len(missing)} of {len(days)} days already stored")
+    if not missing:
+        return
+
+    data_5p = DataCollection.SENTINEL5P.define_from("5p", service_url=config.sh_base_url)
+    evalscript = mean_evalscript(variables, with_counts=True)
+    requests = [SentinelHubRequest(
+        evalscript=evalscript,
+        input_data=[SentinelHubRequest.input_data(
+            data_collection=data_5p,
+            time_interval=(f"{d.strftime(DAY_FORMAT)}T00:00:00Z", f"{d.strftime(DAY_FORMAT)}T23:59:59Z"),
+        )],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=bbox,
+        resolution=resolution,
+        config=config,
+    ) for d in missing]
+
+    data = cached_get_data(requests, config=config, max_threads=max_threads)
+    for day, (raster,) in zip(missing, data):
+        if raster is None:
+            continue
+        means, counts = split_bands(raster, variables, with_counts=True)
+        for variable in variables:
+            add_day(variable, day, means[variable], counts[variable], store_dir)
+    for variable in variables:
+        update_prefixes(variable, store_dir)
+
+
+# ----------------------------
+# Prefix sums
+# ----------------------------
+def update_prefixes(variable, store_dir=STORE_DIR):
+    """
+    Bring the running sums up to date: recompute from the first day whose prefix is
+    missing, built from a different number of days, or older than its day file.
+    """
+    days = stored_days(variable, store_dir)
+    first_stale = None
+    for i, day in enumerate(days):
+        prefix_path = _day_path(store_dir, variable, "prefix", day)
+        if not os.path.exists(prefix_path) or \
+                os.path.getmtime(prefix_path) < os.path.getmtime(_day_path(store_dir, variable, "day", day)):
+            first_stale = i
+            break
+        with np.load(prefix_path) as prefix:
+            if int(prefix["n_days"]) != i + 1:
+                first_stale = i
+                break
+    if first_stale is None:
+        return 0
+
+    if first_stale == 0:
+        total = count = None
+    else:
+        with np.load(_day_path(store_dir, variable, "prefix", days[first_stale - 1])) as prefix:
+            total, count = prefix["sum"], prefix["count"]
+    for i in range(first_stale, len(days)):
+        with np.load(_day_path(store_dir, variable, "day", days[i])) as daily:
+            if total is None:
+                total = daily["sum"].astype(np.float64)
+                count = daily["count"].astype(np.int64)
+            else:
+                total = total + daily["sum"]
+                count = count + daily["count"]
+        _save_npz(_day_path(store_dir, variable, "prefix", days[i]), sum=total, count=count, n_days=i + 1)
+    # Prefixes of days that were removed from the store
+    prefix_dir = os.path.join(store_dir, variable, "prefix")
+    kept = {f"{d.strftime(DAY_FORMAT)}.npz" for d in days}
+    for name in os.listdir(prefix_dir):
+        if name.endswith(".npz") and name not in kept:
+            os.remove(os.path.join(prefix_dir, name))
+    return len(days) - first_stale
+
+
+def _prefix_before(days, day):
+    # Last stored day <= day, None if there is none
+    index = int(np.searchsorted(np.array(days, dtype="datetime64[D]"), np.datetime64(day, "D"), side="right"))
+    return days[index - 1] if index > 0 else None
+
+
+def _prefix(variable, day, store_dir):
+    with np.load(_day_path(store_dir, variable, "prefix", day)) as prefix:
+        return prefix["sum"], prefix["count"]
+
+
+def period_sum(variable, start, end, store_dir=STORE_DIR, days=None):
+    """(sum, count) rasters of the stored days in [start, end], from two prefixes."""
+    days = stored_days(variable, store_dir) if days is None else days
+    start, end = _day(start), _day(end)
+    upper = _prefix_before(days, end)
+    lower = _prefix_before(days, start - datetime.timedelta(days=1))
+    if upper is None or (lower is not None and lower >= upper):
+        raise ValueError(f"No stored {variable} days between {start} and {end}")
+    total, count = _prefix(variable, upper, store_dir)
+    if lower is not None:
+        lower_total, lower_count = _prefix(variable, lower, store_dir)
+        total, count = total - lower_total, count - lower_count
+    return total, count
+
+
+def period_mean(variable, start, end, store_dir=STORE_DIR):
+    """
+    Mean of all valid orbits of the stored days in [start, end] (NaN without data) and the
+    number of valid orbits. Days missing from the store are reported and left out.
+    """
+    update_prefixes(variable, store_dir)
+    days = stored_days(variable, store_dir)
+    start, end = _day(start), _day(end)
+    n_stored = sum(start <= d <= end for d in days)
+    n_days = (end - start).days + 1
+    if n_stored < n_days:
+        print(f"Composite {variable} {start}..{end}: {n_days - n_stored} of {n_days} days not stored")
+    total, count = period_sum(variable, start, end, store_dir, days)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+    return mean, count
+
+
+def rolling_mean(variable, end_days, window_days, store_dir=STORE_DIR):
+    """Yield (day, mean) of the window_days days ending at each day of end_days."""
+    update_prefixes(variable, store_dir)
+    days = stored_days(variable, store_dir)
+    for end in end_days:
+        end = _day(end)
+        start = end - datetime.timedelta(days=window_days - 1)
+        try:
+            total, count = period_sum(variable, start, end, store_dir, days)
+        except ValueError:
+            continue
+        with np.errstate(invalid="ignore", divide="ignore"):
+            yield end, np.where(count > 0, total / count, np.nan)
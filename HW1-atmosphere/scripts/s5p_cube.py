@@ -0,0 +1,219 @@
+"""Memory-mapped time x y x x cube of S5P rasters on one grid.
+
+Every HW1 product is a loose GeoTIFF that is reopened with ``rasterio.open`` for
+each plot or statistic. A cube gathers the rasters of one grid into a single
+float32 array on disk, with the georeferencing and the time index stored once:
+
+    <cube_dir>/cube.json   transform, crs, shape, capacity and the time of every slot
+    <cube_dir>/values.f32  np.memmap (capacity, height, width), grown by doubling
+
+Reads are slices of the memmap, so only the touched pages are read from disk:
+
+- ``read_bbox`` / ``read_mask``: a (time, rows, cols) window of a bbox or of a
+  mask such as a country from ``zonal_stats.rasterize_zones``;
+- ``pixel_series``: the time series of one point;
+- ``zone_series``: the mean of one zone at every time step.
+
+Usage:
+    cube = create_cube("downloads/cube_no2", affine, "EPSG:3857", (height, width))
+    add_geotiff("downloads/cube_no2", path, "2023-01-01")
+    values, times, transform = read_mask(open_cube("downloads/cube_no2"), country_array == 5)
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+META_FILENAME = "cube.json"
+VALUES_FILENAME = "values.f32"
+DTYPE = np.float32
+INITIAL_CAPACITY = 16
+
+
+def _meta_path(cube_dir):
+    return os.path.join(cube_dir, META_FILENAME)
+
+
+def _save_meta(cube_dir, meta):
+    path = _meta_path(cube_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _time_key(time):
+    return pd.Timestamp(time).isoformat()
+
+
+def create_cube(cube_dir, transform, crs, shape, capacity=INITIAL_CAPACITY):
+    """New empty cube on a grid: transform (affine a..f, north-up), crs string, shape (height, width)."""
+    if os.path.exists(_meta_path(cube_dir)):
+        raise FileExistsError(f"Cube already exists in {cube_dir}")
+    os.makedirs(cube_dir, exist_ok=True)
+    meta = {"transform": [float(v) for v in tuple(transform)[:6]], "crs": str(crs),
+            "shape": [int(shape[0]), int(shape[1])], "capacity": capacity, "times": []}
+    with open(os.path.join(cube_dir, VALUES_FILENAME), "wb") as f:
+        f.truncate(capacity * shape[0] * shape[1] * np.dtype(DTYPE).itemsize)
+    _save_meta(cube_dir, meta)
+    return open_cube(cube_dir)
+
+
+def open_cube(cube_dir, mode="r"):
+    """Cube dict: meta, values (memmap of the filled slots), times (DatetimeIndex of the slots)."""
+    with open(_meta_path(cube_dir)) as f:
+        meta = json.load(f)
+    height, width = meta["shape"]
+    values = np.memmap(os.path.join(cube_dir, VALUES_FILENAME), dtype=DTYPE, mode=mode,
+                       shape=(meta["capacity"], height, width))
+    return {"dir": cube_dir, "meta": meta, "values": values[:len(meta["times"])],
+            "storage": values, "times": pd.DatetimeIndex(meta["times"])}
+
+
+def _grow(cube_dir, meta, capacity):
+    height, width = meta["shape"]
+    with open(os.path.join(cube_dir, VALUES_FILENAME), "r+b") as f:
+        f.truncate(capacity * height * width * np.dtype(DTYPE).itemsize)
+    meta["capacity"] = capacity
+
+
+def add_raster(cube_dir, time, array):
+    """Write the raster of a time step (replacing an existing one with the same time)."""
+    with open(_meta_path(cube_dir)) as f:
+        meta = json.load(f)
+    array = np.asarray(array)
+    if list(array.shape) != meta["shape"]:
+        raise ValueError(f"Raster shape {array.shape} does not match the cube {tuple(meta['shape'])}")
+    key = _time_key(time)
+    if key in meta["times"]:
+        slot = meta["times"].index(key)
+    else:
+        slot = len(meta["times"])
+        if slot >= meta["capacity"]:
+            _grow(cube_dir, meta, 2 * meta["capacity"])
+        meta["times"].append(key)
+    height, width = meta["shape"]
+    storage = np.memmap(os.path.join(cube_dir, VALUES_FILENAME), dtype=DTYPE, mode="r+",
+                        shape=(meta["capacity"], height, width))
+    storage[slot] = array
+    storage.flush()
+    del storage
+    _save_meta(cube_dir, meta)
+
+
+def add_geotiff(cube_dir, path, time, band=1):
+    """Add one band of a GeoTIFF, checking that it is on the cube grid."""
+    import rasterio
+
+    with open(_meta_path(cube_dir)) as f:
+        meta = json.load(f)
+    with rasterio.open(path) as src:
+        if not np.allclose(tuple(src.transform)[:6], meta["transform"]) or \
+                [src.height, src.width] != meta["shape"]:
+            raise ValueError(f"{path} is not on the cube grid of {cube_dir}")
+        add_raster(cube_dir, time, src.read(band))
+
+
+def gather(cube_dir, items, band=1):
+    """Create (if needed) and fill a cube from (time, GeoTIFF path) pairs of one grid."""
+    import rasterio
+
+    items = sorted(items, key=lambda item: pd.Timestamp(item[0]))
+    if not os.path.exists(_meta_path(cube_dir)):
+        with rasterio.open(items[0][1]) as src:
+            create_cube(cube_dir, src.transform, src.crs.to_string(), (src.height, src.width),
+                        capacity=max(INITIAL_CAPACITY, len(items)))
+    for time, path in items:
+        add_geotiff(cube_dir, path, time, band)
+    return open_cube(cube_dir)
+
+
+# ----------------------------
+# Reads
+# ----------------------------
+def _time_slots(cube, start, end):
+    # Slots in [start, end], in time order
+    times = cube["times"]
+    keep = np.ones(len(times), dtype=bool)
+    if start is not None:
+        keep &= times >= pd.Timestamp(start)
+    if end is not None:
+        keep &= times <= pd.Timestamp(end)
+    slots = np.flatnonzero(keep)
+    return slots[np.argsort(times[slots])]
+
+
+def xy_to_rowcol(cube, x, y):
+    a, _, c, _, e, f = cube["meta"]["transform"]
+    return int(np.floor((y - f) / e)), int(np.floor((x - c) / a))
+
+
+def _window_transform(cube, row0, col0):
+    a, b, c, d, e, f = cube["meta"]["transform"]
+    return [a, b, c + col0 * a, d, e, f + row0 * e]
+
+
+def _read(cube, rows, cols, start, end):
+    slots = _time_slots(cube, start, end)
+    # Slot order is insertion order; fancy indexing on the first axis reads only those slots
+    values = np.asarray(cube["values"][slots, rows, cols]) if len(slots) else \
+        np.empty((0, rows.stop - rows.start, cols.stop - cols.start), dtype=DTYPE)
+    return values, cube["times"][slots]
+
+
+def read_bbox(cube, bounds, start=None, end=None):
+    """
+    Values (time, rows, cols) inside bounds (min_x, min_y, max_x, max_y) in the cube CRS,
+    the times and the transform (a..f) of the window.
+    """
+    height, width = cube["meta"]["shape"]
+    a, _, c, _, e, f = cube["meta"]["transform"]
+    min_x, min_y, max_x, max_y = bounds
+    top, left = xy_to_rowcol(cube, min_x, max_y)
+    # Exclusive ends as in rasterio.windows.from_bounds: a bound on a pixel edge adds no pixel
+    bottom = int(np.ceil((min_y - f) / e))
+    right = int(np.ceil((max_x - c) / a))
+    top, left = max(top, 0), max(left, 0)
+    bottom, right = min(bottom, height), min(right, width)
+    if top >= bottom or left >= right:
+        raise ValueError(f"Bounds {bounds} do not overlap the cube")
+    values, times = _read(cube, slice(top, bottom), slice(left, right), start, end)
+    return values, times, _window_transform(cube, top, left)
+
+
+def read_mask(cube, mask, start=None, end=None):
+    """
+    Values (time, rows, cols) of the bounding window of a boolean mask on the cube grid
+    (e.g. labels == country_id), NaN outside the mask; the times and the window transform.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError("Empty mask")
+    row_slice = slice(rows[0], rows[-1] + 1)
+    col_slice = slice(cols[0], cols[-1] + 1)
+    values, times = _read(cube, row_slice, col_slice, start, end)
+    values = np.where(mask[row_slice, col_slice], values, np.nan)
+    return values, times, _window_transform(cube, rows[0], cols[0])
+
+
+def pixel_series(cube, x, y, start=None, end=None):
+    """Time series of the pixel containing (x, y) in the cube CRS."""
+    row, col = xy_to_rowcol(cube, x, y)
+    height, width = cube["meta"]["shape"]
+    if not (0 <= row < height and 0 <= col < width):
+        raise ValueError(f"Point ({x}, {y}) is outside the cube")
+    values, times = _read(cube, slice(row, row + 1), slice(col, col + 1), start, end)
+    return pd.Series(values[:, 0, 0], index=times, name="value")
+
+
+def zone_series(cube, labels, zone_id, start=None, end=None):
+    """Mean of the valid pixels of one zone of a label raster at every time step."""
+    values, times, _ = read_mask(cube, labels == zone_id, start, end)
+    flat = values.reshape(len(times), -1)
+    valid = np.isfinite(flat)
+    count = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, flat, 0).sum(axis=1) / count
+    return pd.DataFrame({"mean": mean, "count": count}, index=times)
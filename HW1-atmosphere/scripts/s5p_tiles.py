@@ -0,0 +1,211 @@
+"""Tiled Sentinel-5P retrieval at native resolution, mosaicked into one GeoTIFF.
+
+The notebook requests all of Europe as a single raster, which has to stay below
+the Process API output limit (2500 x 2500 px) and therefore uses a coarse
+resolution. Here the area of interest is requested at the native S5P
+resolution (``native_resolution``) and split into a grid of tiles that share
+one pixel grid:
+
+- every tile is requested with an explicit ``size`` on a bbox aligned to the
+  global grid, so the tiles fit together without resampling;
+- tiles go through ``sh_cache`` (content-addressed cache, batched parallel
+  downloads), so re-runs and overlapping areas fetch nothing twice;
+- ``write_mosaic`` copies the tiles one at a time into their windows of a tiled,
+  compressed GeoTIFF and builds overviews, so the full mosaic is never held in
+  memory;
+- ``read_window`` reads only the window of a bbox or geometry (optionally from
+  an overview), e.g. one country for ``zonal_stats`` or a preview for a plot.
+
+Usage:
+    path = fetch_mosaic(evalscript_mean_mosaic, bbox, ("2023-01-01", "2023-02-01"),
+                        "outputs/no2_2023_01.tif", config)
+    values, transform = read_window(path, geometry=countries.geometry[0])
+"""
+import os
+import math
+
+import numpy as np
+
+try:
+    from .sh_cache import MAX_THREADS, cached_paths
+except ImportError:
+    from sh_cache import MAX_THREADS, cached_paths
+
+# Process API output limit is 2500 x 2500 px per request. Even at native resolution Europe is
+# only ~900 x 600 px, so tiles are smaller than the limit: several tiles download in parallel,
+# stay small in memory and are reused by the cache for overlapping areas.
+MAX_TILE_PIXELS = 2500
+TILE_PIXELS = 512
+# S5P pixels are 3.5 km across track (x) x 5.5 km along track (y) at nadir (since Aug 2019),
+# in ground metres
+NATIVE_RESOLUTION = (3500, 5500)
+WEB_MERCATOR_EPSG = 3857
+EARTH_RADIUS_M = 6378137.0  # WGS84 semi-major axis, the Web-Mercator sphere
+OVERVIEW_LEVELS = (2, 4, 8, 16)
+BLOCK_SIZE = 256
+CACHE_DIR = "downloads/cache"
+
+
+def native_resolution(bbox, ground_resolution=NATIVE_RESOLUTION):
+    """
+    (x, y) pixel size in Web-Mercator units of the native S5P footprint at the latitude
+    of the centre of a Web-Mercator bbox (min_x, min_y, max_x, max_y). A Mercator unit is
+    cos(lat) ground metres, so ground sizes are divided by cos(lat).
+    """
+    _, min_y, _, max_y = bbox
+    lat = 2 * math.atan(math.exp((min_y + max_y) / 2 / EARTH_RADIUS_M)) - math.pi / 2
+    scale = math.cos(lat)
+    return tuple(size / scale for size in ground_resolution)
+
+
+def bbox_resolution(bbox, resolution=None):
+    """The given resolution, or native_resolution for a Web-Mercator sentinelhub BBox."""
+    if resolution is not None:
+        return resolution
+    if bbox.crs.epsg != WEB_MERCATOR_EPSG:
+        raise ValueError(f"Native resolution is defined for EPSG:{WEB_MERCATOR_EPSG} bboxes, "
+                         f"got EPSG:{bbox.crs.epsg}; pass resolution explicitly")
+    return native_resolution((bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y))
+
+
+def tile_grid(bbox, resolution, tile_pixels=TILE_PIXELS):
+    """
+    Pixel grid of a bbox split into tiles.
+    Returns (width, height, tiles) where every tile is (col_off, row_off, width, height, bounds)
+    and bounds = (min_x, min_y, max_x, max_y) aligned to the global grid.
+    The grid starts at the upper-left corner of the bbox and covers it with whole pixels.
+    """
+    if tile_pixels > MAX_TILE_PIXELS:
+        raise ValueError(f"tile_pixels={tile_pixels} exceeds the Process API limit of {MAX_TILE_PIXELS}")
+    min_x, min_y, max_x, max_y = bbox
+    res_x, res_y = resolution
+    width = math.ceil((max_x - min_x) / res_x)
+    height = math.ceil((max_y - min_y) / res_y)
+    tiles = []
+    for row_off in range(0, height, tile_pixels):
+        for col_off in range(0, width, tile_pixels):
+            w = min(tile_pixels, width - col_off)
+            h = min(tile_pixels, height - row_off)
+            bounds = (min_x + col_off * res_x, max_y - (row_off + h) * res_y,
+                      min_x + (col_off + w) * res_x, max_y - row_off * res_y)
+            tiles.append((col_off, row_off, w, h, bounds))
+    return width, height, tiles
+
+
+def tile_requests(evalscript, bbox, time_interval, config, resolution=None, tile_pixels=TILE_PIXELS):
+    """
+    SentinelHubRequests of all tiles of a bbox (sentinelhub BBox) and the grid from tile_grid.
+    resolution defaults to the native S5P resolution (bbox_resolution).
+    """
+    from sentinelhub import BBox, DataCollection, MimeType, SentinelHubRequest
+
+    data_5p = DataCollection.SENTINEL5P.define_from("5p", service_url=config.sh_base_url)
+    resolution = bbox_resolution(bbox, resolution)
+    width, height, tiles = tile_grid((bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y), resolution, tile_pixels)
+    requests = []
+    for _, _, w, h, bounds in tiles:
+        requests.append(SentinelHubRequest(
+            evalscript=evalscript,
+            input_data=[SentinelHubRequest.input_data(data_collection=data_5p, time_interval=time_interval)],
+            responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+            bbox=BBox(bounds, crs=bbox.crs),
+            size=(w, h),
+            config=config,
+        ))
+    return requests, (width, height, tiles)
+
+
+def mosaic_nodata(dtype, source_nodata=None):
+    """Nodata value of the mosaic: the tiles' own one, else NaN for floats and the dtype maximum for integers."""
+    if source_nodata is not None:
+        return source_nodata
+    dtype = np.dtype(dtype)
+    return np.nan if dtype.kind == "f" else np.iinfo(dtype).max
+
+
+def write_mosaic(tile_paths, grid, crs, resolution, out_path, overview_levels=OVERVIEW_LEVELS):
+    """
+    Copy tile GeoTIFFs into their windows of one tiled GeoTIFF, one tile in memory at a time.
+    Missing tiles (None) are filled with the nodata value (mosaic_nodata). Overviews are
+    built with average resampling.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    width, height, tiles = grid
+    first = next((p for p in tile_paths if p is not None), None)
+    if first is None:
+        raise RuntimeError("No tile was downloaded, nothing to mosaic")
+    with rasterio.open(first) as src:
+        count, dtype = src.count, src.dtypes[0]
+        nodata = mosaic_nodata(dtype, src.nodata)
+
+    # Grid origin = upper-left corner of the first tile
+    min_x, _, _, max_y = tiles[0][4]
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": count, "dtype": dtype,
+        "crs": crs, "transform": from_origin(min_x, max_y, *resolution), "nodata": nodata,
+        "tiled": True, "blockxsize": BLOCK_SIZE, "blockysize": BLOCK_SIZE,
+        "compress": "deflate", "predictor": 3 if np.dtype(dtype).kind == "f" else 2,
+        "BIGTIFF": "IF_SAFER",
+    }
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = out_path + ".tmp.tif"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        for (col_off, row_off, w, h, _), path in zip(tiles, tile_paths):
+            window = Window(col_off, row_off, w, h)
+            if path is None:
+                dst.write(np.full((count, h, w), nodata, dtype=dtype), window=window)
+                continue
+            with rasterio.open(path) as src:
+                dst.write(src.read(), window=window)
+    with rasterio.open(tmp_path, "r+") as dst:
+        levels = [level for level in overview_levels if min(width, height) // level >= 1]
+        dst.build_overviews(levels, Resampling.average)
+        dst.update_tags(ns="rio_overview", resampling="average")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def fetch_mosaic(evalscript, bbox, time_interval, out_path, config, resolution=None,
+                 tile_pixels=TILE_PIXELS, cache_dir=CACHE_DIR, max_threads=MAX_THREADS,
+                 overview_levels=OVERVIEW_LEVELS):
+    """
+    Download all tiles of a bbox concurrently (through the cache) and mosaic them into out_path.
+    resolution defaults to the native S5P resolution (bbox_resolution).
+    """
+    resolution = bbox_resolution(bbox, resolution)
+    requests, grid = tile_requests(evalscript, bbox, time_interval, config, resolution, tile_pixels)
+    print(f"S5P mosaic: {grid[0]} x {grid[1]} px in {len(requests)} tiles")
+    # One batch per round of threads, so at most max_threads tile responses are held in memory
+    tile_paths = cached_paths(requests, cache_dir=cache_dir, config=config, max_threads=max_threads,
+                              batch_size=max_threads)
+    return write_mosaic(tile_paths, grid, f"EPSG:{bbox.crs.epsg}", resolution, out_path, overview_levels)
+
+
+def read_window(path, bounds=None, geometry=None, band=1, decimation=1):
+    """
+    Values of one band inside bounds (min_x, min_y, max_x, max_y) or the bounds of a
+    geometry, in the mosaic CRS. decimation > 1 reads a reduced grid (served from the
+    overviews). Returns (values, transform of the returned array).
+    """
+    import rasterio
+    from rasterio.transform import Affine
+    from rasterio.windows import Window, from_bounds
+
+    with rasterio.open(path) as src:
+        if geometry is not None:
+            bounds = geometry.bounds
+        if bounds is None:
+            window = Window(0, 0, src.width, src.height)
+        else:
+            window = from_bounds(*bounds, transform=src.transform)
+            window = window.round_offsets().round_lengths().intersection(
+                Window(0, 0, src.width, src.height))
+        out_shape = (max(1, int(window.height) // decimation), max(1, int(window.width) // decimation))
+        values = src.read(band, window=window, out_shape=out_shape)
+        transform = src.window_transform(window) * Affine.scale(
+            window.width / out_shape[1], window.height / out_shape[0])
+    return values, transform
@@ -0,0 +1,216 @@
+"""Content-addressed local cache and parallel batcher for Sentinel Hub process requests.
+
+Every process request is identified by a hash of what determines its result:
+endpoint, evalscript, data collection, bbox, CRS, output size/resolution and
+time interval (all taken from the request payload that sentinelhub-py builds).
+Responses are stored as ``<cache_dir>/<key[:2]>/<key>.<ext>`` next to a JSON
+copy of the payload, so
+
+- re-running a notebook cell, or a month-by-month multi-year loop, only
+  downloads requests whose key is not in the cache yet;
+- cache misses are sent through one ``SentinelHubDownloadClient`` in batches
+  with bounded concurrency (``max_threads``);
+- hits are decoded from disk without contacting the API (no token request).
+
+``serve_stub`` starts a local server that answers the OAuth token and process
+endpoints with small GeoTIFFs and counts the requests, and ``stub_config``
+points an ``SHConfig`` at it, so the cache can be tested offline:
+
+    server, url = serve_stub()
+    config = stub_config(url)
+    data = cached_get_data(requests, cache_dir="downloads/cache", config=config)
+    server.process_count  # process requests that actually reached the server
+"""
+import os
+import io
+import json
+import hashlib
+import threading
+
+MAX_THREADS = 5
+BATCH_SIZE = 50
+CACHE_DIR = "downloads/cache"
+# Decimals of bbox coordinates and resolutions kept in the cache key (sub-mm in metres)
+KEY_DECIMALS = 6
+
+_EXTENSIONS = {
+    "image/tiff": "tiff",
+    "application/json": "json",
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "application/x-tar": "tar",
+}
+
+
+def _normalize(value):
+    # Round floats so that equal requests built from reprojected bboxes hash the same
+    if isinstance(value, float):
+        return round(value, KEY_DECIMALS)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def request_key(download_request):
+    """Hash of the endpoint and payload (evalscript, collection, bbox, CRS, size, time) of a request."""
+    payload = {"url": download_request.url, "post_values": _normalize(download_request.post_values)}
+    blob = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()
+
+
+def _mime(download_request):
+    data_type = download_request.data_type
+    return getattr(data_type, "get_string", lambda: str(data_type))()
+
+
+def cache_path(cache_dir, key, download_request):
+    extension = _EXTENSIONS.get(_mime(download_request), "bin")
+    return os.path.join(cache_dir, key[:2], f"{key}.{extension}")
+
+
+def _store(path, content, download_request):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    with open(os.path.splitext(path)[0] + ".json", "w") as f:
+        json.dump({"url": download_request.url, "post_values": download_request.post_values}, f,
+                  default=str, indent=1)
+
+
+def _decode(path, download_request):
+    from sentinelhub.decoding import decode_data
+
+    with open(path, "rb") as f:
+        return decode_data(f.read(), download_request.data_type)
+
+
+def cached_download(download_requests, cache_dir=CACHE_DIR, config=None, max_threads=MAX_THREADS,
+                    batch_size=BATCH_SIZE, decode=True):
+    """
+    Data of every DownloadRequest, from the cache or downloaded in batches.
+    Failed downloads are returned as None and are not cached.
+    """
+    keys = [request_key(r) for r in download_requests]
+    paths = [cache_path(cache_dir, k, r) for k, r in zip(keys, download_requests)]
+
+    # One download per distinct key, even if the same request appears twice
+    misses = {}
+    for request, path in zip(download_requests, paths):
+        if not os.path.exists(path) and path not in misses:
+            misses[path] = request
+    print(f"Sentinel Hub cache: {len(download_requests) - len(misses)} hits, {len(misses)} to download")
+
+    if misses:
+        from sentinelhub import SentinelHubDownloadClient
+
+        client = SentinelHubDownloadClient(config=config, raise_download_errors=False)
+        items = list(misses.items())
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            for request in (r for _, r in batch):
+                request.save_response = False  # the cache is the only copy
+            responses = client.download([r for _, r in batch], max_threads=max_threads, decode_data=False)
+            for (path, request), response in zip(batch, responses):
+                if response is None:
+                    print(f"Download failed, not cached: {path}")
+                    continue
+                _store(path, getattr(response, "content", response), request)
+            print(f"  downloaded {min(start + batch_size, len(items))}/{len(items)}")
+
+    results = []
+    for request, path in zip(download_requests, paths):
+        if not os.path.exists(path):
+            results.append(None)
+        else:
+            results.append(_decode(path, request) if decode else path)
+    return results
+
+
+def cached_get_data(requests, cache_dir=CACHE_DIR, config=None, max_threads=MAX_THREADS, batch_size=BATCH_SIZE):
+    """Like ``[r.get_data() for r in requests]`` for SentinelHubRequests, served through the cache."""
+    download_requests = [d for r in requests for d in r.download_list]
+    data = cached_download(download_requests, cache_dir, config, max_threads, batch_size)
+    out = []
+    position = 0
+    for request in requests:
+        n = len(request.download_list)
+        out.append(data[position:position + n])
+        position += n
+    return out
+
+
+def cached_paths(requests, cache_dir=CACHE_DIR, config=None, max_threads=MAX_THREADS, batch_size=BATCH_SIZE):
+    """Cached file paths (e.g. GeoTIFFs for rasterio.open) of the first response of every request."""
+    download_requests = [r.download_list[0] for r in requests]
+    return cached_download(download_requests, cache_dir, config, max_threads, batch_size, decode=False)
+
+
+# ----------------------------
+# Local stub server
+# ----------------------------
+def _stub_tiff(width, height, n_bands, seed):
+    # Small deterministic float32 GeoTIFF-like TIFF, as the process API would return
+    import numpy as np
+    import tifffile
+
+    rng = np.random.default_rng(seed)
+    data = rng.random((height, width, n_bands) if n_bands > 1 else (height, width), dtype=np.float32)
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, data)
+    return buffer.getvalue()
+
+
+def serve_stub(host="127.0.0.1", port=0, n_bands=1):
+    """Local stand-in for the CDSE token and process endpoints. Returns (server, base_url)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, content_type, payload):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.endswith("/token"):
+                token = {"access_token": "stub", "token_type": "Bearer", "expires_in": 3600}
+                self._reply(200, "application/json", json.dumps(token).encode())
+                return
+            if self.path.endswith("/api/v1/process"):
+                with self.server.lock:
+                    self.server.process_count += 1
+                payload = json.loads(body)
+                output = payload.get("output", {})
+                width = int(output.get("width") or 8)
+                height = int(output.get("height") or 8)
+                seed = int(hashlib.sha256(body).hexdigest()[:8], 16)
+                self._reply(200, "image/tiff", _stub_tiff(width, height, n_bands, seed))
+                return
+            self._reply(404, "text/plain", b"not found")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.process_count = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def stub_config(base_url):
+    """SHConfig pointing at a stub server from serve_stub."""
+    from sentinelhub import SHConfig
+
+    config = SHConfig()
+    config.sh_client_id = "stub"
+    config.sh_client_secret = "stub"
+    config.sh_base_url = base_url
+    config.sh_token_url = f"{base_url}/oauth/token"
+    return config
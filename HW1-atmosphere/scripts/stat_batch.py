@@ -0,0 +1,249 @@
+"""Statistical API batches over geometries x variables x years.
+
+The notebook builds one ``SentinelHubStatistical`` request per capital for one
+variable and year, downloads them with a fixed ``max_threads=5`` and flattens
+every response with nested loops (``stats_to_df``). Here
+
+- ``plan`` lists the (geometry, year) requests still needed: all variables of a
+  geometry-year go into one request (``evalscripts.stat_evalscript``), and the
+  variables whose results are already cached are left out;
+- ``download_adaptive`` runs the requests in rounds whose concurrency grows
+  while rounds succeed and halves when requests fail (rate limits), retrying
+  the failed ones;
+- finished results are cached per (geometry, year, variable) as JSON in
+  ``cache_dir``, so later runs with other variables or more years only fetch
+  what is new;
+- ``flatten_stats`` turns all responses into one long, typed table with a
+  single ``pd.json_normalize`` pass; ``stats_to_df`` is a drop-in vectorized
+  replacement of the notebook helper.
+
+Usage:
+    table = run_batch(capitals.geometry, capitals["name"], ["NO2", "CO"], [2022, 2023],
+                      config, crs=capitals.crs)
+    table.loc[table["variable"] == "NO2"]  # name, interval_from, interval_to, mean, ...
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .evalscripts import check_variables, split_stats, stat_evalscript
+except ImportError:
+    from evalscripts import check_variables, split_stats, stat_evalscript
+
+CACHE_DIR = "downloads/stat_cache"
+AGGREGATION_INTERVAL = "P1D"
+SIZE = (1, 1)
+START_THREADS = 3
+MAX_THREADS = 10
+# Requests per round = ROUND_FACTOR * current thread count
+ROUND_FACTOR = 4
+# Consecutive failing rounds before giving up on the remaining requests
+MAX_FAILED_ROUNDS = 5
+
+STAT_COLUMNS = ["min", "max", "mean", "stDev", "sampleCount", "noDataCount"]
+
+
+# ----------------------------
+# Cache
+# ----------------------------
+def geometry_key(geometry):
+    return hashlib.sha1(geometry.wkb).hexdigest()[:16]
+
+
+def cache_path(cache_dir, geometry, year, variable, aggregation_interval=AGGREGATION_INTERVAL, size=SIZE):
+    key = f"{geometry_key(geometry)}_{year}_{variable}_{aggregation_interval}_{size[0]}x{size[1]}"
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def _store(path, response):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(response, f)
+    os.replace(tmp_path, path)
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# ----------------------------
+# Planning
+# ----------------------------
+def plan(geometries, names, variables, years, cache_dir=CACHE_DIR,
+         aggregation_interval=AGGREGATION_INTERVAL, size=SIZE):
+    """
+    Requests still needed: a list of (name, geometry, year, missing variables),
+    one per geometry-year that is not fully cached.
+    """
+    variables = check_variables(variables)
+    jobs = []
+    for name, geometry in zip(names, geometries):
+        for year in years:
+            missing = [v for v in variables if not os.path.exists(
+                cache_path(cache_dir, geometry, year, v, aggregation_interval, size))]
+            if missing:
+                jobs.append((name, geometry, year, missing))
+    return jobs
+
+
+def build_request(geometry, crs, year, variables, config, aggregation_interval=AGGREGATION_INTERVAL, size=SIZE):
+    """SentinelHubStatistical request of all variables of one geometry over one calendar year."""
+    from sentinelhub import CRS, DataCollection, Geometry, SentinelHubStatistical
+
+    aggregation = SentinelHubStatistical.aggregation(
+        evalscript=stat_evalscript(variables),
+        time_interval=(f"{year}-01-01", f"{year}-12-31"),
+        aggregation_interval=aggregation_interval,
+        size=size,
+    )
+    input_data = SentinelHubStatistical.input_data(
+        DataCollection.SENTINEL5P.define_from("5p", service_url=config.sh_base_url)
+    )
+    return SentinelHubStatistical(
+        aggregation=aggregation,
+        input_data=[input_data],
+        geometry=Geometry(geometry, crs=CRS(crs)),
+        config=config,
+    )
+
+
+# ----------------------------
+# Download
+# ----------------------------
+def download_adaptive(download_requests, config, start_threads=START_THREADS, max_threads=MAX_THREADS,
+                      on_result=None):
+    """
+    Download Statistical API requests in rounds with adaptive concurrency.
+    A round without failures raises the thread count by one (up to max_threads);
+    a round with failures halves it and the failed requests are retried.
+    on_result(index, response) is called as soon as a request succeeds.
+    Returns the responses (None for requests that kept failing).
+    """
+    from sentinelhub import SentinelHubStatisticalDownloadClient
+
+    client = SentinelHubStatisticalDownloadClient(config=config, raise_download_errors=False)
+    results = [None] * len(download_requests)
+    pending = list(range(len(download_requests)))
+    threads = start_threads
+    failed_rounds = 0
+    while pending and failed_rounds < MAX_FAILED_ROUNDS:
+        batch = pending[:threads * ROUND_FACTOR]
+        responses = client.download([download_requests[i] for i in batch], max_threads=threads)
+        failed = []
+        for i, response in zip(batch, responses):
+            if response is None:
+                failed.append(i)
+                continue
+            results[i] = response
+            if on_result is not None:
+                on_result(i, response)
+        if failed:
+            failed_rounds += 1
+            threads = max(1, threads // 2)
+        else:
+            failed_rounds = 0
+            threads = min(max_threads, threads + 1)
+        pending = failed + pending[len(batch):]
+        print(f"Statistical batch: {len(download_requests) - len(pending)}/{len(download_requests)} done, "
+              f"{len(failed)} failed in round, next round with {threads} threads")
+    if pending:
+        print(f"Statistical batch: giving up on {len(pending)} requests")
+    return results
+
+
+def run_batch(geometries, names, variables, years, config, crs="EPSG:4326", cache_dir=CACHE_DIR,
+              aggregation_interval=AGGREGATION_INTERVAL, size=SIZE, max_threads=MAX_THREADS):
+    """
+    Statistics of every geometry x variable x year, downloading only what is not cached.
+    Returns the long table of flatten_stats (invalid intervals dropped).
+    """
+    variables = check_variables(variables)
+    geometries = list(geometries)
+    names = list(names)
+    jobs = plan(geometries, names, variables, years, cache_dir, aggregation_interval, size)
+    print(f"Statistical batch: {len(jobs)} of {len(geometries) * len(years)} geometry-years to download")
+
+    if jobs:
+        requests = [build_request(geometry, crs, year, missing, config, aggregation_interval, size)
+                    for _, geometry, year, missing in jobs]
+
+        def store(i, response):
+            _, geometry, year, missing = jobs[i]
+            for variable, split in split_stats(response, missing).items():
+                _store(cache_path(cache_dir, geometry, year, variable, aggregation_interval, size), split)
+
+        download_adaptive([r.download_list[0] for r in requests], config,
+                          max_threads=max_threads, on_result=store)
+
+    responses, keys = [], []
+    for name, geometry in zip(names, geometries):
+        for year in years:
+            for variable in variables:
+                path = cache_path(cache_dir, geometry, year, variable, aggregation_interval, size)
+                if os.path.exists(path):
+                    responses.append(_load(path))
+                    keys.append({"name": name, "variable": variable, "year": year})
+    return flatten_stats(responses, keys)
+
+
+# ----------------------------
+# Flattening
+# ----------------------------
+def flatten_stats(responses, keys):
+    """
+    One long table of single-variable Statistical API responses (split_stats output).
+    keys holds the identifying columns of every response (e.g. name, variable, year).
+    Columns: the key columns, interval_from, interval_to (dates), min, max, mean, stDev,
+    sampleCount, noDataCount and percentiles_<p> if requested. Intervals without
+    valid pixels are dropped, as in stats_to_df.
+    """
+    records = []
+    for key, response in zip(keys, responses):
+        for entry in response.get("data", []):
+            # split_stats responses have one output ("default") with one band
+            band = next(iter(entry["outputs"]["default"]["bands"].values()))
+            records.append({**key, "interval": entry["interval"], "stats": band["stats"]})
+    if not records:
+        key_columns = list(keys[0]) if keys else []
+        return pd.DataFrame(columns=key_columns + ["interval_from", "interval_to"] + STAT_COLUMNS)
+
+    df = pd.json_normalize(records, sep="_")
+    df.columns = [c[len("stats_"):] if c.startswith("stats_") else c for c in df.columns]
+    for column in ("interval_from", "interval_to"):
+        df[column] = pd.to_datetime(df[column], utc=True).dt.date
+    for column in df.columns:
+        if column in ("sampleCount", "noDataCount"):
+            df[column] = df[column].astype(np.int64)
+        elif column in ("min", "max", "mean", "stDev") or column.startswith("percentiles_"):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+    for column in keys[0]:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype("category")
+    return df.loc[df["sampleCount"] != df["noDataCount"]].reset_index(drop=True)
+
+
+def stats_to_df(stats_data):
+    """Transform Statistical API response into a pandas.DataFrame (vectorized, same columns as the notebook helper)"""
+    # Failed intervals come back as {"interval": ..., "error": ...} without outputs
+    data = [entry for entry in stats_data.get("data") or [] if "error" not in entry]
+    if not data:
+        return pd.DataFrame()
+    df = pd.json_normalize(data, sep="_")
+    df = df[[c for c in df.columns if c.startswith(("interval_", "outputs_"))]]
+    # outputs_<output>_bands_<band>_stats_<stat> -> <output>_<band>_<stat>
+    df.columns = [c.replace("outputs_", "", 1).replace("_bands_", "_", 1).replace("_stats_", "_", 1)
+                  for c in df.columns]
+    valid = np.ones(len(df), dtype=bool)
+    for column in [c for c in df.columns if c.endswith("_sampleCount")]:
+        # NaN != NaN is True, so a missing count has to be excluded explicitly
+        count = df[column]
+        valid &= (count.notna() & (count != df[column[:-len("sampleCount")] + "noDataCount"])).to_numpy()
+    for column in ("interval_from", "interval_to"):
+        df[column] = pd.to_datetime(df[column], utc=True).dt.date
+    return df.loc[valid].reset_index(drop=True)
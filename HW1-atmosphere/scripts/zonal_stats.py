@@ -0,0 +1,159 @@
+"""One-pass zonal statistics of S5P rasters over country (or any other) zones.
+
+The zones are burnt into a label raster once with ``rasterio.features.rasterize``;
+the label raster is cached per (transform, shape, geometry set), in memory and
+optionally on disk, so every later raster on the same grid reuses it.
+
+``zonal_stats`` then computes count, mean, std, min, max and quantiles for all
+zones together: sums come from ``np.bincount`` and quantiles from a single
+sort of the valid pixels by (zone, value). A whole stack of rasters
+(time, y, x), e.g. twelve monthly means, is handled in the same pass, so the
+cost is one sort of the valid pixels instead of one full-raster mask per zone,
+statistic and month.
+
+Usage:
+    labels = rasterize_zones(countries.geometry, countries["ID"], affine, raster.shape)
+    stats = zonal_stats(raster, labels, n_zones=len(countries), with_arrays=True)
+    countries["mean"] = stats["mean"]
+"""
+import os
+import hashlib
+import numpy as np
+
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75)
+NO_ZONE = -1
+
+_label_cache = {}
+
+
+def zones_key(geometries, ids, transform, shape):
+    # Hash of the grid and the (geometry, id) set identifying a label raster
+    digest = hashlib.sha1()
+    digest.update(np.asarray(tuple(transform)[:6], dtype=np.float64).tobytes())
+    digest.update(np.asarray(shape, dtype=np.int64).tobytes())
+    for geometry, zone_id in zip(geometries, ids):
+        digest.update(geometry.wkb)
+        digest.update(str(zone_id).encode())
+    return digest.hexdigest()[:20]
+
+
+def rasterize_zones(geometries, ids, transform, shape, cache_dir=None):
+    """Label raster (int32, NO_ZONE outside all zones) of geometries on a raster grid, cached."""
+    geometries = list(geometries)
+    ids = list(ids)
+    key = zones_key(geometries, ids, transform, shape)
+    if key in _label_cache:
+        return _label_cache[key]
+
+    path = None if cache_dir is None else os.path.join(cache_dir, f"zones_{key}.npy")
+    if path is not None and os.path.exists(path):
+        labels = np.load(path)
+    else:
+        from rasterio import features
+
+        labels = features.rasterize(
+            list(zip(geometries, ids)), transform=transform, out_shape=shape, fill=NO_ZONE, dtype="int32"
+        )
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, labels)
+    labels.flags.writeable = False  # shared through the cache
+    _label_cache[key] = labels
+    return labels
+
+
+def _sorted_zone_values(values, labels, n_zones):
+    # Valid pixels sorted by (group, value); group = layer * n_zones + zone
+    stack = values.reshape(-1, labels.size)
+    n_layers = stack.shape[0]
+    flat_labels = labels.ravel()
+    in_zone = (flat_labels >= 0) & (flat_labels < n_zones)
+
+    groups = []
+    vals = []
+    for layer in range(n_layers):
+        layer_values = stack[layer]
+        valid = in_zone & np.isfinite(layer_values)
+        groups.append(layer * n_zones + flat_labels[valid].astype(np.int64))
+        vals.append(layer_values[valid].astype(np.float64))
+    groups = np.concatenate(groups)
+    vals = np.concatenate(vals)
+    order = np.lexsort((vals, groups))
+    return n_layers, groups[order], vals[order]
+
+
+def zonal_stats(values, labels, n_zones=None, quantiles=DEFAULT_QUANTILES, with_arrays=False):
+    """
+    Statistics of every zone for a raster (y, x) or a stack (time, y, x).
+
+    Returns a dict of arrays shaped (n_zones,) for one raster or
+    (time, n_zones) for a stack: count, mean, std (ddof=0, like np.nanstd),
+    min, max and q<quantile> (linear interpolation, like np.nanquantile).
+    NaN pixels are ignored; zones without valid pixels get NaN (count 0).
+    with_arrays=True adds "arrays": the valid values of every zone, sorted,
+    as a list (or a list per layer) for box plots.
+    """
+    values = np.asarray(values)
+    if values.shape[-2:] != labels.shape:
+        raise ValueError(f"Raster shape {values.shape[-2:]} does not match the zones {labels.shape}")
+    if n_zones is None:
+        n_zones = int(labels.max()) + 1
+    n_layers, groups, vals = _sorted_zone_values(values, labels, n_zones)
+    n_groups = n_layers * n_zones
+
+    count = np.bincount(groups, minlength=n_groups)
+    total = np.bincount(groups, weights=vals, minlength=n_groups)
+    has = count > 0
+    safe_count = np.where(has, count, 1)
+    mean = np.where(has, total / safe_count, np.nan)
+    # Second moment around the mean to avoid cancellation
+    deviation = vals - mean[groups]
+    var = np.bincount(groups, weights=deviation * deviation, minlength=n_groups) / safe_count
+    std = np.where(has, np.sqrt(var), np.nan)
+
+    # Group boundaries in the sorted values; empty groups pick the NaN appended at the end
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    padded = np.append(vals, np.nan)
+
+    def pick(index):
+        return padded[np.where(has, index, len(vals))]
+
+    stats = {
+        "count": count,
+        "mean": mean,
+        "std": std,
+        "min": pick(starts),
+        "max": pick(starts + count - 1),
+    }
+    for q in quantiles:
+        position = q * (count - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, count - 1)
+        lo = pick(starts + lower)
+        stats[f"q{q * 100:g}"] = lo + (pick(starts + upper) - lo) * (position - lower)
+
+    out_shape = (n_zones,) if values.ndim == 2 else (n_layers, n_zones)
+    stats = {name: stat.reshape(out_shape) for name, stat in stats.items()}
+    if with_arrays:
+        arrays = np.split(vals, np.cumsum(count)[:-1])
+        stats["arrays"] = arrays if values.ndim == 2 else [
+            arrays[layer * n_zones:(layer + 1) * n_zones] for layer in range(n_layers)]
+    return stats
+
+
+def zonal_stats_frame(values, labels, zone_names, times=None, quantiles=DEFAULT_QUANTILES):
+    """Long-format DataFrame (zone[, time], count, mean, std, min, max, quantiles) of zonal_stats."""
+    import pandas as pd
+
+    stats = zonal_stats(values, labels, n_zones=len(zone_names), quantiles=quantiles)
+    columns = [name for name in stats if name != "arrays"]
+    if np.asarray(values).ndim == 2:
+        df = pd.DataFrame({name: stats[name] for name in columns})
+        df.insert(0, "zone", list(zone_names))
+        return df
+    n_layers = stats["count"].shape[0]
+    times = list(range(n_layers)) if times is None else list(times)
+    df = pd.DataFrame({name: stats[name].ravel() for name in columns})
+    df.insert(0, "time", np.repeat(times, len(zone_names)))
+    df.insert(0, "zone", list(zone_names) * n_layers)
+    return df
@@ -0,0 +1,38 @@
+"""Helper scripts for the HW2 radar workflow.
+
+Submodules are imported on first attribute access (``scripts.radar_extract``)
+and defer their heavy dependencies (xradar, wradlib, cartopy, matplotlib,
+joblib, requests) to the functions that use them, so importing a helper or
+starting a worker stays cheap. ``import_budget.py`` checks the import cost.
+"""
+import importlib
+
+__all__ = [
+    "batch_assignments",
+    "gauge_interpolation",
+    "http_metrics",
+    "measurement_download_parallel",
+    "measurement_resample",
+    "radar_climatology",
+    "radar_clutter",
+    "radar_composite",
+    "radar_clean_raw_files",
+    "radar_download",
+    "radar_extract",
+    "radar_follow",
+    "radar_plot",
+    "radar_reflectivity_to_rainfall",
+    "radar_scheduler",
+    "radar_staging",
+    "radar_storage",
+    "radar_summary",
+    "radar_tiles",
+    "radar_unzip",
+    "radar_workers",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
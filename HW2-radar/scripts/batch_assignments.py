@@ -0,0 +1,299 @@
+"""
+Batch run of the HW2 pipeline over the assignment table
+- Reads hw2_assignments_2026.csv and collects every distinct main/backup
+  (station, year) pair
+- Fetches PR1H once per year for all stations of that year
+- Picks an event window per pair with the notebook's 8 h rolling score
+  (fallback: highest 8 h rolling std)
+- Merges overlapping radar windows into one download and processing plan,
+  so SUR volumes shared by nearby stations are downloaded and converted once
+- Extracts every station's hourly radar series from the shared products and
+  compares it with the gauge (Pearson r, RMSD)
+
+Station coordinates come from hw2_station_coords.csv next to the assignment
+table (columns Station, Latitude, Longitude in WGS84 degrees, station names as
+in possible_stations; https://www.ilmateenistus.ee/meist/vaatlusvork/), which
+covers every station of the table. A station added to the table needs a row
+there (or in an extra station_coords_csv); run_batch raises before downloading
+anything if a station has no coordinates.
+"""
+
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .measurement_download_parallel import MAX_WORKERS, fetch_data_for_parameters_parallel
+    from .radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+    from .radar_extract import station_indices
+except ImportError:
+    from measurement_download_parallel import MAX_WORKERS, fetch_data_for_parameters_parallel
+    from radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+    from radar_extract import station_indices
+
+ASSIGNMENTS_CSV = Path(__file__).resolve().parents[2] / "hw2_assignments_2026.csv"
+STATION_COORDS_CSV = Path(__file__).resolve().parents[2] / "hw2_station_coords.csv"
+OUT_DIR = Path("data/batch")
+RAINFALL_INTENSITIES_DIR = "data/radar_rainfall/rainfall_intensities"
+ACCUMULATED_1H_DIR = "data/radar_rainfall/accumulated_rainfall/1h"
+
+# (lat, lon) of the stations used in the notebook; all stations of the assignment table are
+# in STATION_COORDS_CSV
+STATION_COORDS = {
+    'Türi': (58.808708, 25.409156),
+    'Jõgeva': (58.749836, 26.415006),
+}
+
+WINDOW_HOURS = 8
+# Windows closer than this are downloaded as one range
+MERGE_GAP = timedelta(hours=1)
+
+# Radar download batching / API limits (as in the notebook)
+INTERVAL_HOUR = 1
+DAYS_PER_HOUR = 12
+
+
+def log(msg: str) -> None:
+    print(msg, flush=True)
+
+
+# ---------------- Assignments ----------------
+def load_assignments(csv_path=ASSIGNMENTS_CSV) -> pd.DataFrame:
+    """Distinct (station, year) pairs with the students and roles that use them."""
+    table = pd.read_csv(csv_path)
+    pairs = pd.concat([
+        table[["Student", "Main_Station", "Main_Year"]].set_axis(["student", "station", "year"], axis=1)
+        .assign(role="main"),
+        table[["Student", "Backup_Station", "Backup_Year"]].set_axis(["student", "station", "year"], axis=1)
+        .assign(role="backup"),
+    ], ignore_index=True)
+    pairs["year"] = pairs["year"].astype(int)
+    return (pairs.groupby(["station", "year"])
+            .agg(students=("student", lambda s: "; ".join(s)), roles=("role", lambda s: "; ".join(s)))
+            .reset_index())
+
+
+def load_station_coords(csv_path=None) -> Dict[str, Tuple[float, float]]:
+    """Built-in and STATION_COORDS_CSV coordinates, extended/overridden by an optional CSV."""
+    coords = dict(STATION_COORDS)
+    for path in (STATION_COORDS_CSV, csv_path):
+        if path is None or not os.path.exists(path):
+            continue
+        for _, row in pd.read_csv(path).iterrows():
+            coords[row["Station"]] = (float(row["Latitude"]), float(row["Longitude"]))
+    return coords
+
+
+def require_station_coords(stations, csv_path=None) -> Dict[str, Tuple[float, float]]:
+    """Coordinates of the given stations; ValueError naming every station without a CSV row."""
+    coords = load_station_coords(csv_path)
+    missing = sorted(set(stations) - set(coords))
+    if missing:
+        raise ValueError(f"No coordinates for {len(missing)} station(s): {', '.join(missing)}. "
+                         f"Add them to {STATION_COORDS_CSV.name} or pass station_coords_csv with "
+                         f"columns Station, Latitude, Longitude (got {csv_path!r}).")
+    return {name: coords[name] for name in stations}
+
+
+# ---------------- Window selection ----------------
+def candidate_windows(series: pd.Series, window_h: int = WINDOW_HOURS, n: int = 10) -> pd.DataFrame:
+    """Top scored 'mixed rainfall' windows (same features and score as the notebook)."""
+    s = series.astype(float).copy()
+    s.index = pd.to_datetime(s.index)
+    W = window_h
+
+    feat = pd.DataFrame(index=s.index)
+    feat["std"] = s.rolling(W, min_periods=W).std()
+    feat["mean"] = s.rolling(W, min_periods=W).mean()
+    feat["max"] = s.rolling(W, min_periods=W).max()
+    feat["nonzero_frac"] = s.gt(0).rolling(W, min_periods=W).mean()
+    feat["mid_frac"] = s.between(0.5, 5.0).rolling(W, min_periods=W).mean()
+
+    cand = feat.dropna().query(
+        "nonzero_frac >= 0.5 and mid_frac >= 0.4 and mean >= 0.3 and max <= 12"
+    ).copy()
+    if cand.empty:
+        return pd.DataFrame(columns=["start", "end", "score", "std", "mid_frac", "nonzero_frac"])
+
+    cand["score"] = (
+        0.45 * (cand["std"] / cand["std"].max()) +
+        0.35 * cand["mid_frac"] +
+        0.20 * cand["nonzero_frac"]
+    )
+    top = cand.sort_values("score", ascending=False).head(n)
+    return pd.DataFrame({
+        "start": [end_ts.floor("h") - pd.Timedelta(hours=W - 1) for end_ts in top.index],
+        "end": [end_ts.replace(minute=59, second=0, microsecond=0) for end_ts in top.index],
+        "score": top["score"].to_numpy(),
+        "std": top["std"].to_numpy(),
+        "mid_frac": top["mid_frac"].to_numpy(),
+        "nonzero_frac": top["nonzero_frac"].to_numpy(),
+    })
+
+
+def select_window(series: pd.Series, window_h: int = WINDOW_HOURS) -> Optional[Tuple[datetime, datetime, str]]:
+    """(start, end, method) of the best window, or None when the series has no rain."""
+    cand = candidate_windows(series, window_h, n=1)
+    if not cand.empty:
+        return cand["start"].iloc[0].to_pydatetime(), cand["end"].iloc[0].to_pydatetime(), "score"
+
+    # Fallback: highest 8 h rolling std, as in the first notebook cell
+    s = series.astype(float).copy()
+    s.index = pd.to_datetime(s.index)
+    rolling_std = s.rolling(window=window_h, min_periods=window_h).std()
+    if rolling_std.dropna().empty or not rolling_std.max() > 0:
+        return None
+    best_end = rolling_std.idxmax()
+    best_start = best_end - pd.Timedelta(hours=window_h - 1)
+    return (best_start.to_pydatetime().replace(minute=0, second=0, microsecond=0),
+            best_end.to_pydatetime().replace(minute=59, second=0, microsecond=0), "max_std")
+
+
+def merge_windows(windows: List[Tuple[datetime, datetime]], max_gap: timedelta = MERGE_GAP
+                  ) -> List[Tuple[datetime, datetime]]:
+    """Union of overlapping (or nearly touching) radar windows, sorted."""
+    merged: List[List[datetime]] = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1] + max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+# ---------------- Batch ----------------
+def fetch_gauge_series(pairs: pd.DataFrame, max_workers: int = MAX_WORKERS) -> Dict[Tuple[str, int], pd.Series]:
+    """PR1H for every (station, year), one fetch per year covering all its stations."""
+    series = {}
+    for year, group in pairs.groupby("year"):
+        stations = sorted(group["station"].unique())
+        frames = fetch_data_for_parameters_parallel(
+            ['1h precipitation sum (mm)'], stations,
+            f"{year}-01-01 00:00:00", f"{year}-12-31 23:59:59", max_workers=max_workers)
+        for station in stations:
+            if station in frames and "PR1H" in frames[station].columns:
+                series[(station, int(year))] = frames[station]["PR1H"]
+            else:
+                log(f"No PR1H for {station} {year}")
+    return series
+
+
+def extract_station_series(coords: Tuple[float, float], start: datetime, end: datetime,
+                           accum_dir=ACCUMULATED_1H_DIR,
+                           geometry_dir=RAINFALL_INTENSITIES_DIR) -> pd.DataFrame:
+    """Hourly radar rainfall at the station pixel for frames stamped within [start, end + 1 min]
+    (an end at HH:59 includes the accumulation ending at the next full hour)."""
+    index = station_indices(geometry_dir, {"station": coords})["station"]
+
+    rows = []
+    for fp in list_rainfall_files(accum_dir):
+        ts = timestamp_from_path(fp)
+        if start <= ts <= end + timedelta(minutes=1):
+            rows.append((ts, float(sample_frame(load_rainfall(fp, dense=False), index))))
+    radar_df = pd.DataFrame(rows, columns=['datetime', 'radar_rain_amount'])
+    return radar_df.set_index('datetime').sort_index()
+
+
+def compare(gauge: pd.Series, radar_df: pd.DataFrame) -> Tuple[pd.DataFrame, dict]:
+    """Aligned gauge/radar table and its statistics (as in the notebook)."""
+    meas = gauge.rename("measured_rain_amount").to_frame()
+    meas.index = pd.to_datetime(meas.index)
+    comparison = meas.join(radar_df, how="inner").dropna()
+    stats = {"n_points": len(comparison), "pearson_r": np.nan, "rmsd_mm": np.nan}
+    if len(comparison) >= 2:
+        x = comparison["measured_rain_amount"].to_numpy(dtype=float)
+        y = comparison["radar_rain_amount"].to_numpy(dtype=float)
+        if x.std() > 0 and y.std() > 0:
+            stats["pearson_r"] = float(np.corrcoef(x, y)[0, 1])
+        stats["rmsd_mm"] = float(np.sqrt(np.mean((y - x) ** 2)))
+    return comparison, stats
+
+
+def run_batch(assignments_csv=ASSIGNMENTS_CSV, station_coords_csv=None, out_dir: Path = OUT_DIR,
+              a: float = 300.0, b: float = 1.5, max_workers: int = MAX_WORKERS,
+              interval_hour: int = INTERVAL_HOUR, days_per_hour: int = DAYS_PER_HOUR,
+              staging_budget_gb: Optional[float] = None, download: bool = True) -> pd.DataFrame:
+    """
+    Select windows for all assignment pairs, download and process the merged
+    radar plan once and extract every pair's series. station_coords_csv adds stations
+    that are not in STATION_COORDS_CSV.
+    RETURNS: one row per (station, year) with window, students and statistics.
+    """
+    try:
+        from .radar_download import download_radar_data_with_limit, hourly_limiter
+        from .radar_unzip import extract_all_zips
+        from .radar_reflectivity_to_rainfall import main as process_radar_rainfall
+        from .radar_staging import pinned
+    except ImportError:
+        from radar_download import download_radar_data_with_limit, hourly_limiter
+        from radar_unzip import extract_all_zips
+        from radar_reflectivity_to_rainfall import main as process_radar_rainfall
+        from radar_staging import pinned
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    pairs = load_assignments(assignments_csv)
+    coords = require_station_coords(pairs["station"].unique(), station_coords_csv)
+    log(f"{len(pairs)} distinct station-year pairs in {assignments_csv}")
+
+    # 1. Gauges and windows
+    gauges = fetch_gauge_series(pairs, max_workers)
+    rows = []
+    for _, pair in pairs.iterrows():
+        key = (pair["station"], int(pair["year"]))
+        row = pair.to_dict()
+        row.update({"radar_start": None, "radar_end": None, "method": None})
+        window = select_window(gauges[key]) if key in gauges else None
+        if window is None:
+            log(f"  {key[0]} {key[1]}: no rain window")
+        else:
+            row["radar_start"], row["radar_end"], row["method"] = window
+        rows.append(row)
+    plan = pd.DataFrame(rows)
+    plan.to_csv(out_dir / "windows.csv", index=False)
+
+    # 2. One merged radar plan
+    windows = [(r["radar_start"], r["radar_end"]) for r in rows if r["radar_start"] is not None]
+    merged = merge_windows(windows)
+    n_hours = sum((end - start).total_seconds() / 3600 for start, end in merged)
+    log(f"{len(windows)} radar windows -> {len(merged)} merged ranges ({n_hours:.0f} h of volumes)")
+    # The merged ranges stay pinned until their frames exist, so no budget enforcement
+    # (this run's or another one's) evicts volumes that are still to be processed
+    with pinned(merged, "batch"):
+        if download:
+            # One hourly budget for the whole plan, not one per merged range
+            limiter = hourly_limiter()
+            for start, end in merged:
+                download_radar_data_with_limit(start, end, interval_hour, days_per_hour, raw=True,
+                                               staging_budget_gb=staging_budget_gb, limiter=limiter)
+            extract_all_zips()
+        if merged:
+            process_radar_rainfall(a=a, b=b, intervals=(1,))
+
+    # 3. Per-pair extraction from the shared products
+    results = []
+    for row in rows:
+        stats = {"n_points": 0, "pearson_r": np.nan, "rmsd_mm": np.nan}
+        if row["radar_start"] is not None:
+            radar_df = extract_station_series(coords[row["station"]], row["radar_start"], row["radar_end"])
+            comparison, stats = compare(gauges[(row["station"], int(row["year"]))], radar_df)
+            name = f"{row['station'].replace(' ', '_')}_{row['year']}"
+            comparison.to_csv(out_dir / f"{name}_comparison.csv")
+            log(f"  {row['station']} {row['year']}: {stats['n_points']} points, "
+                f"r={stats['pearson_r']:.3f}, RMSD={stats['rmsd_mm']:.3f} mm")
+        results.append({**row, **stats})
+    summary = pd.DataFrame(results)
+    summary.to_csv(out_dir / "summary.csv", index=False)
+    log(f"Saved → {out_dir / 'summary.csv'}")
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python batch_assignments.py [extra_station_coords.csv]
+    run_batch(station_coords_csv=sys.argv[1] if len(sys.argv) > 1 else None)
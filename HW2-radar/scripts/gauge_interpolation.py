@@ -0,0 +1,304 @@
+"""
+Gauge fields on the radar grid and mean-field bias adjustment
+- Gauge series (PR1H from fetch_data_for_parameters_parallel) become one
+  hours x gauges matrix
+- Inverse-distance ('idw') or nearest-k ('nearest') weights from the gauges to
+  every radar bin are built once as a scipy.sparse matrix (bins x gauges) and
+  cached on disk by gauge set, method and sweep geometry
+- Gauge fields of many hours are one sparse product W @ G; gauges without a
+  value in an hour are left out and the weights renormalised
+  (W @ values / W @ valid), so a missing gauge never reads as 0 mm
+- Mean-field bias: sum(gauge) / sum(radar) over the gauge pixels in a trailing
+  window, applied to the hourly radar accumulations (adjust_accumulations)
+- run() writes the hourly gauge fields of a year to GAUGE_FIELDS_DIR and
+  adjusts the radar accumulations; by default it uses every station of the
+  shipped coordinate table (batch_assignments.STATION_COORDS_CSV), a gauge
+  without coordinates is an error instead of being left out of the field
+"""
+
+import os
+import hashlib
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .measurement_download_parallel import MAX_WORKERS, fetch_data_for_parameters_parallel, possible_stations
+    from .radar_storage import (DEFAULT_ENCODING, SparseFrame, list_rainfall_files, load_rainfall, sample_frame,
+                                save_rainfall, timestamp_from_path)
+    from .radar_workers import shared_coords
+    from .radar_tiles import geometry_hash
+    from .batch_assignments import load_station_coords, require_station_coords
+except ImportError:
+    from measurement_download_parallel import MAX_WORKERS, fetch_data_for_parameters_parallel, possible_stations
+    from radar_storage import (DEFAULT_ENCODING, SparseFrame, list_rainfall_files, load_rainfall, sample_frame,
+                               save_rainfall, timestamp_from_path)
+    from radar_workers import shared_coords
+    from radar_tiles import geometry_hash
+    from batch_assignments import load_station_coords, require_station_coords
+
+RAINFALL_INTENSITIES_DIR = "data/radar_rainfall/rainfall_intensities"
+ACCUMULATED_1H_DIR = "data/radar_rainfall/accumulated_rainfall/1h"
+GAUGE_FIELDS_DIR = "data/radar_rainfall/gauge_fields/1h"
+WEIGHTS_DIR = "data/gauge_weights"
+
+KM_PER_DEG = 111.195  # spherical earth, R = 6371 km as in radar_extract.get_coords_arr
+DEFAULT_K = 4
+DEFAULT_POWER = 2.0
+MIN_DISTANCE_KM = 0.1  # a bin on top of a gauge gets the gauge value, not 1 / 0
+
+# Mean-field bias: pairs need rain on both sides, and enough of them in the window
+MIN_RAIN_MM = 0.1
+MIN_PAIRS = 3
+BIAS_WINDOW_H = 24
+BIAS_LIMITS = (0.1, 10.0)
+
+
+# ---------------- Geometry ----------------
+def load_geometry(geometry_dir=RAINFALL_INTENSITIES_DIR) -> Tuple[np.ndarray, np.ndarray, str]:
+    """(lat, lon) fields of the sweep and the geometry hash used in the weight cache key."""
+    azims = np.load(os.path.join(geometry_dir, "azimuths.npy"))
+    ranges = np.load(os.path.join(geometry_dir, "ranges.npy"))
+    meta = np.load(os.path.join(geometry_dir, "radar_metadata.npy")).astype(float)
+    latarr, lonarr = shared_coords(geometry_dir)
+    return latarr, lonarr, geometry_hash(ranges, azims, meta[0], meta[1])
+
+
+def local_xy_km(lat, lon, lat0: float, lon0: float) -> np.ndarray:
+    """Equirectangular (x, y) in km around (lat0, lon0), shape (..., 2)."""
+    x = (np.asarray(lon) - lon0) * np.cos(np.radians(lat0)) * KM_PER_DEG
+    y = (np.asarray(lat) - lat0) * KM_PER_DEG
+    return np.stack([x, y], axis=-1)
+
+
+# ---------------- Weights ----------------
+def build_weights(gauge_coords: Sequence[Tuple[float, float]], latarr: np.ndarray, lonarr: np.ndarray,
+                  method: str = "idw", k: int = DEFAULT_K, power: float = DEFAULT_POWER,
+                  max_distance_km: Optional[float] = None):
+    """
+    Sparse (bins x gauges) CSR matrix of non-normalised weights.
+    'idw': 1 / d**power over the k nearest gauges; 'nearest': weight 1 for the nearest
+    gauge (k is ignored). Bins without a gauge within max_distance_km get no weights.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.spatial import cKDTree
+
+    if method not in ("idw", "nearest"):
+        raise ValueError(f"Unknown method '{method}', expected 'idw' or 'nearest'")
+    lat0, lon0 = float(np.mean(latarr)), float(np.mean(lonarr))
+    gauges = np.array([local_xy_km(lat, lon, lat0, lon0) for lat, lon in gauge_coords])
+    bins = local_xy_km(latarr, lonarr, lat0, lon0).reshape(-1, 2)
+    n_gauges = len(gauges)
+    k = 1 if method == "nearest" else min(k, n_gauges)
+
+    distance, index = cKDTree(gauges).query(
+        bins, k=k, distance_upper_bound=np.inf if max_distance_km is None else max_distance_km)
+    distance = distance.reshape(len(bins), k)
+    index = index.reshape(len(bins), k)
+    found = index < n_gauges  # missing neighbours come back as index n_gauges, distance inf
+    if method == "nearest":
+        weights = found.astype(np.float64)
+    else:
+        weights = np.where(found, 1.0 / np.maximum(distance, MIN_DISTANCE_KM) ** power, 0.0)
+
+    matrix = csr_matrix((weights.ravel(), np.where(found, index, 0).ravel(),
+                         np.arange(0, len(bins) * k + 1, k)), shape=(len(bins), n_gauges))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def weights_key(gauge_coords: Dict[str, Tuple[float, float]], geometry: str, method: str, k: int,
+                power: float, max_distance_km: Optional[float]) -> str:
+    digest = hashlib.sha1()
+    for name in sorted(gauge_coords):
+        lat, lon = gauge_coords[name]
+        digest.update(f"{name}:{lat:.6f}:{lon:.6f};".encode())
+    digest.update(f"{geometry}:{method}:{k}:{power}:{max_distance_km}".encode())
+    return digest.hexdigest()[:16]
+
+
+@lru_cache(maxsize=8)
+def _cached_weights(path: str):
+    from scipy.sparse import load_npz
+
+    return load_npz(path).tocsr()
+
+
+def load_weights(gauge_coords: Dict[str, Tuple[float, float]], geometry_dir=RAINFALL_INTENSITIES_DIR,
+                 method: str = "idw", k: int = DEFAULT_K, power: float = DEFAULT_POWER,
+                 max_distance_km: Optional[float] = None, cache_dir=WEIGHTS_DIR):
+    """
+    (weights, gauge names in column order) for a gauge set, built once per
+    gauge set / method / geometry and then read from cache_dir.
+    """
+    from scipy.sparse import save_npz
+
+    names = sorted(gauge_coords)
+    latarr, lonarr, geometry = load_geometry(geometry_dir)
+    key = weights_key(gauge_coords, geometry, method, k, power, max_distance_km)
+    path = os.path.join(cache_dir, f"weights_{key}.npz")
+    if not os.path.exists(path):
+        matrix = build_weights([gauge_coords[n] for n in names], latarr, lonarr, method, k, power,
+                               max_distance_km)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        save_npz(tmp_path, matrix)
+        os.replace(tmp_path, path)
+        print(f"Built {method} weights for {len(names)} gauges: {matrix.nnz} non-zeros -> {path}")
+    return _cached_weights(path), names
+
+
+# ---------------- Fields ----------------
+def gauge_matrix(series: Dict[str, pd.Series], names: List[str]) -> pd.DataFrame:
+    """Hours x gauges frame (columns in weight order, NaN where a gauge has no value)."""
+    df = pd.DataFrame({name: series.get(name, pd.Series(dtype=float)) for name in names})
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index().astype(float)
+
+
+def gauge_fields(weights, values: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Interpolated fields (hours, *shape) of a (hours x gauges) value block.
+    Missing gauge values are left out per hour; bins without a valid gauge are NaN.
+    """
+    values = np.atleast_2d(values)
+    valid = np.isfinite(values)
+    numerator = weights @ np.where(valid, values, 0.0).T
+    denominator = weights @ valid.T.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fields = np.where(denominator > 0, numerator / denominator, np.nan)
+    return fields.T.reshape((len(values),) + tuple(shape)).astype(np.float32)
+
+
+def iter_gauge_fields(weights, gauges: pd.DataFrame, shape: Tuple[int, int],
+                      chunk_hours: int = 168) -> Iterator[Tuple[pd.Timestamp, np.ndarray]]:
+    """Yield (hour, field) for every row of gauges, one sparse product per chunk of hours."""
+    values = gauges.to_numpy(dtype=float)
+    for start in range(0, len(values), chunk_hours):
+        fields = gauge_fields(weights, values[start:start + chunk_hours], shape)
+        for hour, field in zip(gauges.index[start:start + chunk_hours], fields):
+            yield hour, field
+
+
+def save_gauge_fields(weights, gauges: pd.DataFrame, shape: Tuple[int, int], out_dir=GAUGE_FIELDS_DIR,
+                      encoding=DEFAULT_ENCODING) -> int:
+    """Write the field of every hour of gauges as a rainfall frame. Returns frames written."""
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    for hour, field in iter_gauge_fields(weights, gauges, shape):
+        save_rainfall(out_dir, hour.strftime("%Y%m%d%H%M"), field, encoding=encoding)
+        written += 1
+    print(f"Wrote {written} gauge fields to {out_dir}")
+    return written
+
+
+# ---------------- Bias adjustment ----------------
+def gauge_pixels(gauge_coords: Dict[str, Tuple[float, float]], names: List[str],
+                 geometry_dir=RAINFALL_INTENSITIES_DIR) -> np.ndarray:
+    """Flat index of the bin nearest to every gauge (same order as names)."""
+    from scipy.spatial import cKDTree
+
+    latarr, lonarr, _ = load_geometry(geometry_dir)
+    lat0, lon0 = float(np.mean(latarr)), float(np.mean(lonarr))
+    tree = cKDTree(local_xy_km(latarr, lonarr, lat0, lon0).reshape(-1, 2))
+    points = np.array([local_xy_km(*gauge_coords[name], lat0, lon0) for name in names])
+    return tree.query(points)[1].astype(np.int64)
+
+
+def radar_at_gauges(flat_indices: np.ndarray, names: List[str], accum_dir=ACCUMULATED_1H_DIR,
+                    start: Optional[datetime] = None, end: Optional[datetime] = None) -> pd.DataFrame:
+    """Hours x gauges radar accumulations at the gauge pixels, one read per frame."""
+    rows, times = [], []
+    for file in list_rainfall_files(accum_dir):
+        ts = timestamp_from_path(file)
+        if (start is not None and ts < start) or (end is not None and ts > end):
+            continue
+        rows.append(sample_frame(load_rainfall(file, dense=False), flat_indices))
+        times.append(ts)
+    return pd.DataFrame(np.asarray(rows, dtype=float).reshape(len(rows), len(names)),
+                        index=pd.DatetimeIndex(times), columns=names).sort_index()
+
+
+def mean_field_bias(gauges: pd.DataFrame, radar: pd.DataFrame, window_h: int = BIAS_WINDOW_H,
+                    min_rain: float = MIN_RAIN_MM, min_pairs: int = MIN_PAIRS) -> pd.DataFrame:
+    """
+    Hourly mean-field bias sum(gauge) / sum(radar) over the gauge-radar pairs of the
+    trailing window_h hours where both have at least min_rain. Hours with fewer than
+    min_pairs pairs get bias 1 (no adjustment). Columns: bias, n_pairs.
+    """
+    gauges, radar = gauges.align(radar, join="inner")
+    g = gauges.to_numpy(dtype=float)
+    r = radar.to_numpy(dtype=float)
+    pair = np.isfinite(g) & np.isfinite(r) & (g >= min_rain) & (r >= min_rain)
+    hourly = pd.DataFrame({
+        "gauge": np.where(pair, g, 0.0).sum(axis=1),
+        "radar": np.where(pair, r, 0.0).sum(axis=1),
+        "n_pairs": pair.sum(axis=1),
+    }, index=gauges.index)
+    # Time-based window, so gaps in the record do not stretch it
+    window = hourly.rolling(f"{window_h}h").sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bias = np.clip(window["gauge"] / window["radar"], *BIAS_LIMITS)
+    bias = bias.where(window["n_pairs"] >= min_pairs, 1.0)
+    return pd.DataFrame({"bias": bias, "n_pairs": window["n_pairs"].astype(int)})
+
+
+def adjust_accumulations(bias: pd.Series, accum_dir=ACCUMULATED_1H_DIR, out_dir=None,
+                         encoding=DEFAULT_ENCODING) -> int:
+    """Write every accumulation frame multiplied by its hour's bias (1 where unknown). Returns frames written."""
+    out_dir = out_dir or os.path.join(os.path.dirname(os.path.normpath(accum_dir)), "1h_adjusted")
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    for file in list_rainfall_files(accum_dir):
+        ts = timestamp_from_path(file)
+        factor = float(bias.get(ts, 1.0))
+        frame = load_rainfall(file, dense=False)
+        if isinstance(frame, SparseFrame):
+            adjusted = frame._replace(values=(frame.values * factor).astype(np.float32), fill=frame.fill * factor)
+        else:
+            adjusted = frame * factor
+        save_rainfall(out_dir, ts.strftime("%Y%m%d%H%M"), adjusted, encoding=encoding)
+        written += 1
+    print(f"Wrote {written} bias-adjusted frames to {out_dir}")
+    return written
+
+
+# ---------------- Run ----------------
+def run(year: int, station_coords_csv=None, stations: Optional[Sequence[str]] = None, method: str = "idw",
+        k: int = DEFAULT_K, accum_dir=ACCUMULATED_1H_DIR, geometry_dir=RAINFALL_INTENSITIES_DIR,
+        max_workers: int = MAX_WORKERS, fields_dir=GAUGE_FIELDS_DIR) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    PR1H of the gauges (default: every station with coordinates, i.e. the shipped table
+    plus station_coords_csv) for one year, their hourly fields on the radar grid in
+    fields_dir, the mean-field bias against the radar accumulations and the adjusted
+    accumulations. Explicit stations must all have coordinates; a ValueError names the
+    missing ones before anything is fetched.
+    RETURNS: (gauges, bias) frames.
+    """
+    if stations is None:
+        stations = [name for name in load_station_coords(station_coords_csv) if name in possible_stations]
+    coords = require_station_coords(list(stations), station_coords_csv)
+    weights, names = load_weights(coords, geometry_dir, method, k)
+    frames = fetch_data_for_parameters_parallel(
+        ['1h precipitation sum (mm)'], names,
+        f"{year}-01-01 00:00:00", f"{year}-12-31 23:59:59", max_workers=max_workers)
+    series = {n: frames[n]["PR1H"] for n in names if n in frames and "PR1H" in frames[n].columns}
+    gauges = gauge_matrix(series, names)
+    save_gauge_fields(weights, gauges, shared_coords(geometry_dir)[0].shape, fields_dir)
+
+    radar = radar_at_gauges(gauge_pixels(coords, names, geometry_dir), names, accum_dir,
+                            datetime(year, 1, 1), datetime(year, 12, 31, 23, 59))
+    bias = mean_field_bias(gauges, radar)
+    adjust_accumulations(bias["bias"], accum_dir)
+    return gauges, bias
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python gauge_interpolation.py [extra_station_coords.csv]
+    gauges, bias = run(2023, sys.argv[1] if len(sys.argv) > 1 else None)
+    print(bias.describe())
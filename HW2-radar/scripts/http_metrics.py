@@ -0,0 +1,199 @@
+"""Shared HTTP instrumentation for the KAUR and radar download clients.
+
+A ``HttpStats`` object collects one record per HTTP request: latency, time to
+first byte, bytes, rows, retries, backoff and throttling time. It keeps a latency
+histogram and the effective concurrency (busy request-seconds per wall
+second), prints a one-line progress summary and can append every record as a
+JSON line to a log file, which is what MAX_WORKERS / MAX_PAGE_SIZE tuning
+should be based on.
+
+Usage:
+    with stats.track(url) as rec:
+        resp = session.get(url)
+        rec["ttfb_s"] = resp.elapsed.total_seconds()
+        rec["bytes"] = len(resp.content)
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bucket edges of the latency histogram (seconds)
+LATENCY_BUCKETS_S = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+def _json_safe(value):
+    # NaN / inf (e.g. percentiles of zero requests) -> None, so every log line is valid JSON
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    return value
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class HttpStats:
+    """Thread-safe collector of per-request HTTP metrics."""
+
+    def __init__(self, name, log_path=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._log_file = None
+        self.reset()
+        if log_path is not None:
+            self.open_log(log_path)
+
+    def reset(self):
+        with self._lock:
+            self.latencies_s = []
+            self.ttfb_s = []
+            self.histogram = [0] * len(LATENCY_BUCKETS_S)
+            self.requests = 0
+            self.errors = 0
+            self.bytes = 0
+            self.rows = 0
+            self.pages = 0
+            self.retries = 0
+            self.backoff_s = 0.0
+            self.throttle_s = 0.0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.busy_s = 0.0
+            self.first_start = None
+            self.last_end = None
+
+    def open_log(self, log_path):
+        # Append one JSON line per request (and per summary) to log_path
+        self.close_log()
+        self._log_file = open(log_path, "a", encoding="utf-8")
+
+    def close_log(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def _write(self, record):
+        if self._log_file is not None:
+            self._log_file.write(json.dumps(_json_safe(record), allow_nan=False) + "\n")
+            self._log_file.flush()
+
+    @contextmanager
+    def track(self, url, **fields):
+        """Time one request; the caller fills ttfb_s, bytes, rows and status into the yielded dict."""
+        record = {"client": self.name, "url": url, "ttfb_s": None, "bytes": 0, "rows": None,
+                  "status": None, "error": None}
+        record.update(fields)
+        start = time.perf_counter()
+        with self._lock:
+            if self.first_start is None:
+                self.first_start = start
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            record["in_flight"] = self.in_flight
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = repr(e)
+            raise
+        finally:
+            end = time.perf_counter()
+            latency = end - start
+            record["start_unix"] = time.time() - latency
+            record["latency_s"] = latency
+            with self._lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self.busy_s += latency
+                self.last_end = end
+                self.latencies_s.append(latency)
+                for i, edge in enumerate(LATENCY_BUCKETS_S):
+                    if latency <= edge:
+                        self.histogram[i] += 1
+                        break
+                if record["ttfb_s"] is not None:
+                    self.ttfb_s.append(record["ttfb_s"])
+                self.bytes += record["bytes"] or 0
+                if record["error"] is not None:
+                    self.errors += 1
+                else:
+                    if record["rows"] is not None:
+                        self.rows += record["rows"]
+                    self.pages += 1
+                self._write(record)
+
+    def record_retry(self, backoff_s, url=None, error=None):
+        # Count a retry and the time spent sleeping before it
+        with self._lock:
+            self.retries += 1
+            self.backoff_s += backoff_s
+            self._write({"client": self.name, "event": "retry", "url": url,
+                         "backoff_s": backoff_s, "error": error})
+
+    def record_throttle(self, wait_s, reason=None):
+        # Time spent waiting for a client-side rate limit
+        with self._lock:
+            self.throttle_s += wait_s
+            self._write({"client": self.name, "event": "throttle", "wait_s": wait_s, "reason": reason})
+
+    def summary(self):
+        """Aggregated metrics as a JSON-serialisable dict."""
+        with self._lock:
+            latencies = sorted(self.latencies_s)
+            ttfb = sorted(self.ttfb_s)
+            wall_s = 0.0 if self.first_start is None else (self.last_end or self.first_start) - self.first_start
+            return {
+                "client": self.name,
+                "requests": self.requests,
+                "errors": self.errors,
+                "pages": self.pages,
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "retries": self.retries,
+                "backoff_s": round(self.backoff_s, 3),
+                "throttle_s": round(self.throttle_s, 3),
+                "wall_s": round(wall_s, 3),
+                "latency_p50_s": _percentile(latencies, 50),
+                "latency_p95_s": _percentile(latencies, 95),
+                "latency_max_s": latencies[-1] if latencies else float("nan"),
+                "ttfb_p50_s": _percentile(ttfb, 50),
+                "ttfb_p95_s": _percentile(ttfb, 95),
+                "latency_histogram": {
+                    ("inf" if edge == float("inf") else f"{edge:g}"): count
+                    for edge, count in zip(LATENCY_BUCKETS_S, self.histogram)
+                },
+                "effective_concurrency": self.busy_s / wall_s if wall_s > 0 else 0.0,
+                "max_in_flight": self.max_in_flight,
+                "bytes_per_row": self.bytes / self.rows if self.rows else None,
+                "rows_per_s": self.rows / wall_s if wall_s > 0 else None,
+                "mbytes_per_s": self.bytes / 1e6 / wall_s if wall_s > 0 else None,
+            }
+
+    def summary_line(self):
+        """Short human-readable progress summary."""
+        s = self.summary()
+        line = (f"[{s['client']}] {s['requests']} req ({s['errors']} err), {s['pages']} pages, "
+                f"{s['bytes'] / 1e6:.1f} MB, latency p50 {s['latency_p50_s']:.2f}s p95 {s['latency_p95_s']:.2f}s, "
+                f"ttfb p50 {s['ttfb_p50_s']:.2f}s, retries {s['retries']} ({s['backoff_s']:.1f}s backoff), "
+                f"concurrency {s['effective_concurrency']:.1f} (max {s['max_in_flight']})")
+        if s["throttle_s"]:
+            line += f", throttled {s['throttle_s']:.0f}s"
+        if s["rows_per_s"]:
+            line += f", {s['rows_per_s']:.0f} rows/s"
+        return line
+
+    def write_summary(self):
+        # Append the aggregated summary to the JSON-lines log
+        summary = self.summary()
+        summary["event"] = "summary"
+        with self._lock:
+            self._write(summary)
+        return summary
@@ -0,0 +1,81 @@
+"""Import-time budget of the HW2 helper modules.
+
+Each module is imported in a fresh interpreter (as joblib workers do) and the
+wall time of the import statement is compared to its budget. Run from the
+HW2-radar folder:
+
+    python -m scripts.import_budget
+"""
+import os
+import subprocess
+import sys
+
+# Milliseconds on top of a bare interpreter; numpy alone takes ~60-100 ms,
+# pandas ~300-400 ms.
+IMPORT_BUDGET_MS = {
+    "scripts.radar_clean_raw_files": 20,
+    "scripts.http_metrics": 20,
+    "scripts.radar_scheduler": 20,
+    "scripts.radar_unzip": 30,
+    "scripts.radar_download": 30,
+    "scripts.radar_storage": 150,
+    "scripts.radar_staging": 150,
+    "scripts.radar_climatology": 150,
+    "scripts.radar_clutter": 150,
+    "scripts.radar_composite": 150,
+    "scripts.radar_summary": 150,
+    "scripts.radar_tiles": 150,
+    "scripts.radar_extract": 150,
+    "scripts.radar_follow": 150,
+    "scripts.radar_plot": 150,
+    "scripts.radar_reflectivity_to_rainfall": 150,
+    "scripts.radar_workers": 150,
+    "scripts.measurement_download_parallel": 600,
+    "scripts.measurement_resample": 600,
+    "scripts.batch_assignments": 600,
+    "scripts.gauge_interpolation": 600,
+}
+
+# Modules that must not be loaded as a side effect of importing any helper
+HEAVY_MODULES = ("xradar", "wradlib", "cartopy", "matplotlib", "joblib", "requests")
+
+_MEASURE = (
+    "import sys, time; t = time.perf_counter(); import {module}; "
+    "dt = (time.perf_counter() - t) * 1000; "
+    "heavy = [m for m in {heavy!r} if m in sys.modules]; "
+    "print(dt, ','.join(heavy))"
+)
+
+
+def measure_import_time(module, repeats=3):
+    # Best-of-N import time (ms) in a fresh interpreter and the heavy modules it pulled in
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    heavy = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", _MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=root, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        elapsed = float(out[0])
+        heavy = out[1].split(",") if len(out) > 1 else []
+        best = elapsed if best is None else min(best, elapsed)
+    return best, heavy
+
+
+def check_import_budget(budget=None):
+    # Print a table and return the modules that are over budget or import heavy dependencies
+    budget = budget or IMPORT_BUDGET_MS
+    failures = []
+    for module, limit in budget.items():
+        elapsed, heavy = measure_import_time(module)
+        ok = elapsed <= limit and not heavy
+        print(f"{module:45s} {elapsed:7.1f} ms / {limit:4d} ms  {'ok' if ok else 'OVER'}"
+              + (f"  (loads {', '.join(heavy)})" if heavy else ""))
+        if not ok:
+            failures.append(module)
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check_import_budget() else 0)
@@ -5,19 +5,25 @@ KAUR downloader — parallel by month + progress prints + per‑station CSVs
 - Datetime index is NAIVE (no timezone) and named "datetime (utc)"
 - Final index reindexed to strict 10‑minute frequency → gaps become NaN
 - Per‑station CSVs with columns as element codes (no station name)
+- Pages are requested as CSV (fallback JSON) and parsed column-wise
 
 Adjust MAX_WORKERS as needed to be polite to the API.
 """
 
+import io
 import time
 import threading
-import requests
 import pandas as pd
 from pathlib import Path
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Optional, Tuple
 
+try:
+    from .http_metrics import HttpStats
+except ImportError:
+    from http_metrics import HttpStats
+
 # ---------------- Dictionaries ----------------
 possible_minute_params = {
     '10 minute mean wind speed (m/s)': 'WS10MA',
@@ -98,6 +104,9 @@ BACKOFF_BASE = 1.8
 # Concurrency
 MAX_WORKERS = 6
 
+# Request metrics shared by all fetch threads (see http_metrics.py)
+HTTP_STATS = HttpStats("kaur")
+
 # --- Minimal column selection to reduce payload ---
 SELECT_COLS = {
     'minute': 'aasta,kuu,paev,tund,minut,vaartus',
@@ -105,13 +114,31 @@ SELECT_COLS = {
     '24h':    'aasta,kuu,paev,vaartus',
 }
 
+# --- Wire format ---
+# "csv" asks the PostgREST endpoint for text/csv (header once, no repeated keys,
+# gzip via Accept-Encoding) and parses pages with the pandas C reader;
+# "json" is the original list-of-dicts format. Endpoints that do not answer
+# with CSV (or refuse it with 406/415) fall back to JSON automatically.
+WIRE_FORMAT = "csv"
+ACCEPT_HEADERS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+# Statuses of a CSV request that mean "no CSV here" (Not Acceptable, Unsupported Media Type)
+CSV_UNSUPPORTED_STATUS = (406, 415)
+# Base URLs that answered a CSV request with something else
+_csv_unsupported = set()
+_csv_lock = threading.Lock()
+
 # --- Thread-local session ---
 _thread_local = threading.local()
-def get_session() -> requests.Session:
+def get_session() -> "requests.Session":
     s = getattr(_thread_local, "session", None)
     if s is None:
+        import requests  # only paid by threads that actually fetch
+
         s = requests.Session()
-        s.headers.update({"Accept": "application/json"})
+        s.headers.update({"Accept": ACCEPT_HEADERS[WIRE_FORMAT], "Accept-Encoding": "gzip, deflate"})
         _thread_local.session = s
     return s
 
@@ -158,19 +185,61 @@ def build_query(data_type: str, year: int, station_code: str, element_code: str,
     return base + "&".join(parts)
 
 
-def request_paged_json(base_qs: str) -> List[dict]:
-    """Fetch all rows for a given query using limit/offset pagination with retries."""
-    all_rows: List[dict] = []
-    offset = 0
+def _wire_bytes(resp) -> int:
+    """Bytes on the wire (compressed size when the server sent Content-Length)."""
+    try:
+        return int(resp.headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return len(resp.content)
+
 
+def _parse_page(resp, wire_format: str):
+    """Parse one response body: a columnar frame for CSV, the list of row dicts for JSON."""
+    content_type = resp.headers.get("Content-Type", "")
+    if wire_format == "csv" and content_type.startswith("text/csv"):
+        if not resp.content.strip():
+            return pd.DataFrame()
+        return pd.read_csv(io.BytesIO(resp.content))
+    return resp.json()
+
+
+def _mark_csv_unsupported(base_url: str) -> None:
+    with _csv_lock:
+        if base_url not in _csv_unsupported:
+            _csv_unsupported.add(base_url)
+            log(f"  {base_url} does not serve CSV, falling back to JSON")
+
+
+def _iter_pages(base_qs: str, wire_format: str = WIRE_FORMAT):
+    """Yield the parsed pages of a query (see _parse_page), negotiating CSV with JSON fallback."""
+    base_url = base_qs.split("?", 1)[0]
+    if base_url in _csv_unsupported:
+        wire_format = "json"
+
+    offset = 0
     while True:
         url = f"{base_qs}&limit={MAX_PAGE_SIZE}&offset={offset}"
         attempt = 0
         while True:
             try:
-                resp = get_session().get(url, timeout=REQUEST_TIMEOUT)
-                resp.raise_for_status()
-                page = resp.json()
+                with HTTP_STATS.track(url, attempt=attempt, format=wire_format) as rec:
+                    resp = get_session().get(url, timeout=REQUEST_TIMEOUT,
+                                             headers={"Accept": ACCEPT_HEADERS[wire_format]})
+                    rec["status"] = resp.status_code
+                    rec["ttfb_s"] = resp.elapsed.total_seconds()
+                    rec["bytes"] = _wire_bytes(resp)
+                    if wire_format == "csv" and resp.status_code in CSV_UNSUPPORTED_STATUS:
+                        # Not a failure: ask again in JSON right away, without a retry
+                        _mark_csv_unsupported(base_url)
+                        wire_format = "json"
+                        continue
+                    resp.raise_for_status()
+                    if wire_format == "csv" and not resp.headers.get("Content-Type", "").startswith("text/csv"):
+                        _mark_csv_unsupported(base_url)
+                        wire_format = "json"
+                        rec["format"] = wire_format
+                    page = _parse_page(resp, wire_format)
+                    rec["rows"] = len(page)
                 break
             except Exception as e:
                 attempt += 1
@@ -178,25 +247,38 @@ def request_paged_json(base_qs: str) -> List[dict]:
                     raise
                 sleep_s = (BACKOFF_BASE ** attempt) + (0.05 * attempt)
                 log(f"  retrying after error ({attempt}/{MAX_RETRIES}): {e}")
+                HTTP_STATS.record_retry(sleep_s, url=url, error=repr(e))
                 time.sleep(sleep_s)
 
-        if not page:
+        if len(page) == 0:
             break
 
-        all_rows.extend(page)
+        yield page
         if len(page) < MAX_PAGE_SIZE:
             break
         offset += MAX_PAGE_SIZE
 
+
+def request_paged(base_qs: str, wire_format: str = WIRE_FORMAT) -> List[pd.DataFrame]:
+    """Fetch all pages for a query as DataFrames, negotiating CSV with JSON fallback."""
+    return [page if isinstance(page, pd.DataFrame) else pd.DataFrame(page)
+            for page in _iter_pages(base_qs, wire_format)]
+
+
+def request_paged_json(base_qs: str) -> List[dict]:
+    """Fetch all rows for a given query using limit/offset pagination with retries."""
+    all_rows: List[dict] = []
+    for page in _iter_pages(base_qs, wire_format="json"):
+        all_rows.extend(page)
     return all_rows
 
 
-def rows_to_df(raw_data: List[dict], col_label: str, data_type: str) -> pd.DataFrame:
-    """Normalize KAUR rows → DataFrame with a single value column under col_label."""
-    if not raw_data:
+def frame_to_df(df: pd.DataFrame, col_label: str, data_type: str) -> pd.DataFrame:
+    """Normalize a columnar KAUR frame → DataFrame with a single value column under col_label."""
+    if df.empty:
         return pd.DataFrame(columns=["datetime", col_label])
 
-    df = pd.DataFrame(raw_data)
+    df = df.copy()
 
     # coerce date parts to int safely
     for c in ("aasta", "kuu", "paev", "tund", "minut"):
@@ -219,24 +301,54 @@ def rows_to_df(raw_data: List[dict], col_label: str, data_type: str) -> pd.DataF
     return df[["datetime", col_label]]
 
 
+def rows_to_df(raw_data: List[dict], col_label: str, data_type: str) -> pd.DataFrame:
+    """Normalize KAUR rows → DataFrame with a single value column under col_label."""
+    return frame_to_df(pd.DataFrame(raw_data), col_label, data_type)
+
+
 def fetch_month_chunk(station_code: str, element_code: str, data_type: str,
                       y: int, m: int, col_label: str, tag: str) -> pd.DataFrame:
     qs = build_query(data_type, y, station_code, element_code, month=m)
-    rows = request_paged_json(qs)
-    log(f"    [{tag}] {y}-{m:02d} fetched ({len(rows)} rows)")
-    return rows_to_df(rows, col_label, data_type)
+    pages = request_paged(qs)
+    n_rows = sum(len(p) for p in pages)
+    log(f"    [{tag}] {y}-{m:02d} fetched ({n_rows} rows)")
+    if not pages:
+        return frame_to_df(pd.DataFrame(), col_label, data_type)
+    return frame_to_df(pd.concat(pages, ignore_index=True), col_label, data_type)
+
+
+def benchmark_wire_formats(station_code: str, element_code: str, data_type: str,
+                           year: int, month: int) -> pd.DataFrame:
+    """Fetch one month in every wire format and report bytes/row and rows/s for each."""
+    qs = build_query(data_type, year, station_code, element_code, month=month)
+    results = []
+    for wire_format in ACCEPT_HEADERS:
+        HTTP_STATS.reset()
+        request_paged(qs, wire_format=wire_format)
+        summary = HTTP_STATS.summary()
+        results.append({
+            "format": wire_format,
+            "rows": summary["rows"],
+            "bytes": summary["bytes"],
+            "bytes_per_row": summary["bytes_per_row"],
+            "rows_per_s": summary["rows_per_s"],
+        })
+    return pd.DataFrame(results).set_index("format")
 
 
 def fetch_data_for_parameters_parallel(params_to_download: List[str],
                                        stations_to_download: List[str],
                                        start_date_str: str,
                                        end_date_str: str,
-                                       max_workers: int = MAX_WORKERS) -> Dict[str, pd.DataFrame]:
+                                       max_workers: int = MAX_WORKERS,
+                                       metrics_log: Optional[str] = None) -> Dict[str, pd.DataFrame]:
     """
     Parallel month fetching with final 10‑minute reindex for gaps.
     RETURNS: dict { station_name: DataFrame }.
     Each DF is indexed by naive UTC datetime (name: 'datetime (utc)')
     and columns are element codes only (no station names).
+    HTTP metrics are printed with the progress; metrics_log appends one
+    JSON line per request plus a final summary for tuning.
     """
     start_date = datetime.strptime(start_date_str, "%Y-%m-%d %H:%M:%S")
     end_date = datetime.strptime(end_date_str, "%Y-%m-%d %H:%M:%S")
@@ -244,102 +356,109 @@ def fetch_data_for_parameters_parallel(params_to_download: List[str],
         f"from {start_date_str} to {end_date_str} with {max_workers} workers.")
 
     station_frames: Dict[str, pd.DataFrame] = {}
+    HTTP_STATS.reset()
+    if metrics_log is not None:
+        HTTP_STATS.open_log(metrics_log)
+
+    try:
+        for station_name in stations_to_download:
+            station_code = possible_stations[station_name]
+            log(f"\nStation: {station_name} ({station_code})")
+
+            # We'll build a wide DF per station with element_code columns
+            station_df = pd.DataFrame()
+            station_data_types = set()
+
+            for param_fullname in params_to_download:
+                if param_fullname in possible_minute_params:
+                    data_type = "minute"
+                    element_code = possible_minute_params[param_fullname]
+                elif param_fullname in possible_hour_params:
+                    data_type = "hour"
+                    element_code = possible_hour_params[param_fullname]
+                elif param_fullname in possible_24h_params:
+                    data_type = "24h"
+                    element_code = possible_24h_params[param_fullname]
+                else:
+                    log(f"  Skipping unknown parameter: {param_fullname}")
+                    continue
 
-    for station_name in stations_to_download:
-        station_code = possible_stations[station_name]
-        log(f"\nStation: {station_name} ({station_code})")
-
-        # We'll build a wide DF per station with element_code columns
-        station_df = pd.DataFrame()
-        station_data_types = set()
-
-        for param_fullname in params_to_download:
-            if param_fullname in possible_minute_params:
-                data_type = "minute"
-                element_code = possible_minute_params[param_fullname]
-            elif param_fullname in possible_hour_params:
-                data_type = "hour"
-                element_code = possible_hour_params[param_fullname]
-            elif param_fullname in possible_24h_params:
-                data_type = "24h"
-                element_code = possible_24h_params[param_fullname]
-            else:
-                log(f"  Skipping unknown parameter: {param_fullname}")
-                continue
+                station_data_types.add(data_type)
+                col_label = element_code  # IMPORTANT: no station name in the header
 
-            station_data_types.add(data_type)
-            col_label = element_code  # IMPORTANT: no station name in the header
+                # Build month job list
+                month_jobs: List[Tuple[int,int]] = []
+                for (y, m) in iter_months(start_date, end_date):
+                    m_start, m_end = month_bounds(y, m)
+                    if m_end < start_date or m_start > end_date:
+                        continue
+                    month_jobs.append((y, m))
 
-            # Build month job list
-            month_jobs: List[Tuple[int,int]] = []
-            for (y, m) in iter_months(start_date, end_date):
-                m_start, m_end = month_bounds(y, m)
-                if m_end < start_date or m_start > end_date:
+                total = len(month_jobs)
+                if total == 0:
+                    log(f"  {param_fullname} → {element_code}: no months in range")
                     continue
-                month_jobs.append((y, m))
-
-            total = len(month_jobs)
-            if total == 0:
-                log(f"  {param_fullname} → {element_code}: no months in range")
-                continue
-
-            log(f"  Param: {param_fullname} → {element_code} [{data_type}], months: {total}")
-
-            frames: List[pd.DataFrame] = []
-            tag = f"{station_name} {element_code}"
-            done = 0
-
-            with ThreadPoolExecutor(max_workers=max_workers) as ex:
-                futs = [
-                    ex.submit(fetch_month_chunk, station_code, element_code, data_type, y, m, col_label, tag)
-                    for (y, m) in month_jobs
-                ]
-                for fut in as_completed(futs):
-                    try:
-                        df_m = fut.result()
-                        if not df_m.empty:
-                            frames.append(df_m)
-                    except Exception as e:
-                        log(f"    [{tag}] ERROR: {e}")
-                    finally:
-                        done += 1
-                        log(f"    [{tag}] progress: {done}/{total} months")
-
-            if not frames:
-                log(f"  {element_code}: no data returned")
-                continue
-
-            acc_df = pd.concat(frames, ignore_index=True)
-            acc_df.drop_duplicates(subset=["datetime"], inplace=True)
-
-            # trim to requested [start, end], sort, set index
-            mask = (acc_df["datetime"] >= start_date) & (acc_df["datetime"] <= end_date)
-            acc_df = acc_df.loc[mask].sort_values("datetime").set_index("datetime")
-
-            # Merge into station-wide DF
-            if station_df.empty:
-                station_df = acc_df
-            else:
-                station_df = station_df.join(acc_df[[col_label]], how="outer")
-
-        # Final tidy per station: sort and reindex to 10‑minute grid (naive)
-        if not station_df.empty:
-            station_df = station_df.sort_index()
-            if "minute" in station_data_types:
-                out_freq = "10min"
-            elif "hour" in station_data_types:
-                out_freq = "1h"
-            else:
-                out_freq = "1D"
 
-            full_index = pd.date_range(start=start_date, end=end_date, freq=out_freq)
-            station_df = station_df.reindex(full_index)
-            station_df.index.name = "datetime (utc)"
-            station_frames[station_name] = station_df
-            log(f"  Station {station_name}: data shape {station_df.shape}")
-        else:
-            log(f"  Station {station_name}: no data")
+                log(f"  Param: {param_fullname} → {element_code} [{data_type}], months: {total}")
+
+                frames: List[pd.DataFrame] = []
+                tag = f"{station_name} {element_code}"
+                done = 0
+
+                with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    futs = [
+                        ex.submit(fetch_month_chunk, station_code, element_code, data_type, y, m, col_label, tag)
+                        for (y, m) in month_jobs
+                    ]
+                    for fut in as_completed(futs):
+                        try:
+                            df_m = fut.result()
+                            if not df_m.empty:
+                                frames.append(df_m)
+                        except Exception as e:
+                            log(f"    [{tag}] ERROR: {e}")
+                        finally:
+                            done += 1
+                            log(f"    [{tag}] progress: {done}/{total} months | {HTTP_STATS.summary_line()}")
+
+                if not frames:
+                    log(f"  {element_code}: no data returned")
+                    continue
 
+                acc_df = pd.concat(frames, ignore_index=True)
+                acc_df.drop_duplicates(subset=["datetime"], inplace=True)
+
+                # trim to requested [start, end], sort, set index
+                mask = (acc_df["datetime"] >= start_date) & (acc_df["datetime"] <= end_date)
+                acc_df = acc_df.loc[mask].sort_values("datetime").set_index("datetime")
+
+                # Merge into station-wide DF
+                if station_df.empty:
+                    station_df = acc_df
+                else:
+                    station_df = station_df.join(acc_df[[col_label]], how="outer")
+
+            # Final tidy per station: sort and reindex to 10‑minute grid (naive)
+            if not station_df.empty:
+                station_df = station_df.sort_index()
+                if "minute" in station_data_types:
+                    out_freq = "10min"
+                elif "hour" in station_data_types:
+                    out_freq = "1h"
+                else:
+                    out_freq = "1D"
+
+                full_index = pd.date_range(start=start_date, end=end_date, freq=out_freq)
+                station_df = station_df.reindex(full_index)
+                station_df.index.name = "datetime (utc)"
+                station_frames[station_name] = station_df
+                log(f"  Station {station_name}: data shape {station_df.shape}")
+            else:
+                log(f"  Station {station_name}: no data")
+    finally:
+        log(HTTP_STATS.summary_line())
+        HTTP_STATS.write_summary()
+        HTTP_STATS.close_log()
     return station_frames
 
 
@@ -0,0 +1,281 @@
+"""
+Derive hourly and daily KAUR products from finer series already in hand
+- Per element code rules: sum, mean, max, min, last value, vector mean
+- Hour-ending convention: the value labelled HH:00 covers (HH-1:00, HH:00]
+- Daily values are labelled D and use the day boundary of their element code
+  (DAY_BOUNDARY): sums and extremes of hour-ending values cover
+  (D 00:00, D+1 00:00], the *08 means average the full-hour observations of
+  [D 00:00, D+1 00:00); the start hour can be overridden per code
+- Every derived value keeps its coverage count (number of source values);
+  periods below the rule's minimum coverage become NaN
+- plan_fetch() fetches only the codes that cannot be derived from other
+  requested codes, fetch_and_resample() returns aligned 10min / 1h / 1D frames;
+  derived codes need source values beyond the requested range (the last day's
+  DPREC needs PR1H up to D+1 00:00, the first PR1H needs PR10M from before
+  start), so the fetch is widened by one target period on each side and the
+  frames are trimmed back to [start, end]
+"""
+
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .measurement_download_parallel import (MAX_WORKERS, fetch_data_for_parameters_parallel,
+                                                possible_24h_params, possible_hour_params,
+                                                possible_minute_params)
+except ImportError:
+    from measurement_download_parallel import (MAX_WORKERS, fetch_data_for_parameters_parallel,
+                                               possible_24h_params, possible_hour_params,
+                                               possible_minute_params)
+
+# ---------------- Rules ----------------
+Rule = namedtuple("Rule", ["source", "how", "scale"])
+
+# target element code -> how to build it from the next finer code
+DERIVATION_RULES = {
+    # 10 minute -> hour
+    'PR1H':   Rule('PR10M', 'sum', 1.0),
+    'WSX1H':  Rule('WS10MX', 'max', 1.0),
+    'WS10M':  Rule('WS10MA', 'last', 1.0),          # last 10 min mean = the 10 min value at HH:00
+    'WD10M':  Rule('WD10MA', 'last', 1.0),
+    # hour -> 24h
+    'DPREC':  Rule('PR1H', 'sum', 1.0),
+    'DTAX':   Rule('TAX1H', 'max', 1.0),
+    'DTAN':   Rule('TAN1H', 'min', 1.0),
+    'DTA08':  Rule('TA', 'mean', 1.0),
+    'DRH08':  Rule('RH', 'mean', 1.0),
+    'DPA008': Rule('PA0', 'mean', 1.0),
+    'DWS08':  Rule('WS10M', 'mean', 1.0),
+    'DWD08':  Rule('WD10M', 'vector_mean', 1.0),
+    'DSDUR':  Rule('SDUR1H', 'sum', 1 / 60),        # min -> h
+}
+
+# Share of the expected source values a period needs; sums and extremes of
+# incomplete periods would be biased low/high, means tolerate a few gaps
+MIN_COVERAGE = {
+    'sum': 1.0,
+    'max': 1.0,
+    'min': 1.0,
+    'mean': 0.75,
+    'vector_mean': 0.75,
+    'last': 1.0,
+}
+
+# Climatological day of daily codes: (start hour UTC, closed side). 'right' = hour-ending
+# values of (D h:00, D+1 h:00], 'left' = observations at the full hours of [D h:00, D+1 h:00)
+DAY_BOUNDARY = {
+    'DPREC':  (0, 'right'),
+    'DTAX':   (0, 'right'),
+    'DTAN':   (0, 'right'),
+    'DSDUR':  (0, 'right'),
+    'DTA08':  (0, 'left'),
+    'DRH08':  (0, 'left'),
+    'DPA008': (0, 'left'),
+    'DWS08':  (0, 'left'),
+    'DWD08':  (0, 'left'),
+}
+
+DATA_TYPE_FREQ = {'minute': '10min', 'hour': '1h', '24h': '1D'}
+
+CODE_DATA_TYPE = {}
+CODE_PARAM = {}
+for _data_type, _params in (('minute', possible_minute_params), ('hour', possible_hour_params),
+                            ('24h', possible_24h_params)):
+    for _name, _code in _params.items():
+        CODE_DATA_TYPE[_code] = _data_type
+        CODE_PARAM[_code] = _name
+
+
+# ---------------- Planning ----------------
+def derivation_chain(code: str) -> List[str]:
+    """Codes a target can be built from, finest last: DPREC -> ['PR1H', 'PR10M']."""
+    chain = []
+    while code in DERIVATION_RULES:
+        code = DERIVATION_RULES[code].source
+        chain.append(code)
+    return chain
+
+
+def plan_fetch(codes: Iterable[str], available: Iterable[str] = ()) -> Tuple[List[str], List[str]]:
+    """
+    Split requested element codes into (codes to fetch, codes to derive).
+    A code is derived when a finer code in its chain is requested or already
+    available; otherwise it is fetched as before.
+    """
+    codes = list(dict.fromkeys(codes))
+    in_hand = set(codes) | set(available)
+    to_fetch, to_derive = [], []
+    for code in codes:
+        if any(source in in_hand for source in derivation_chain(code)):
+            to_derive.append(code)
+        elif code not in available:
+            to_fetch.append(code)
+    return to_fetch, to_derive
+
+
+def day_boundary(code: str, day_start_hours: Optional[Dict[str, int]] = None) -> Tuple[int, str]:
+    """(start hour, closed side) of a daily code, with the start hour overridden from day_start_hours."""
+    start_hour, closed = DAY_BOUNDARY.get(code, (0, 'right'))
+    if day_start_hours and code in day_start_hours:
+        start_hour = day_start_hours[code]
+    return start_hour, closed
+
+
+def fetch_window(start: pd.Timestamp, end: pd.Timestamp, to_derive: Iterable[str]) -> Tuple[pd.Timestamp, pd.Timestamp]:
+    """[start, end] widened by the longest period of the derived codes (unchanged if none are derived)."""
+    periods = [pd.Timedelta(DATA_TYPE_FREQ[CODE_DATA_TYPE[code]]) for code in to_derive]
+    if not periods:
+        return start, end
+    return start - max(periods), end + max(periods)
+
+
+# ---------------- Aggregation ----------------
+def _vector_mean_deg(directions: pd.Series, groups) -> pd.Series:
+    rad = np.radians(directions)
+    u = np.sin(rad).groupby(groups).mean()
+    v = np.cos(rad).groupby(groups).mean()
+    return (np.degrees(np.arctan2(u, v)) % 360).where(u.notna())
+
+
+def aggregate(series: pd.Series, rule: Rule, freq: str, day_start_hour: int = 0,
+              closed: str = 'right') -> Tuple[pd.Series, pd.Series]:
+    """
+    Aggregate one source series to freq ('1h' or '1D') with a rule. Days start at
+    day_start_hour and are closed on the right (hour-ending values) or left (observations).
+    Returns (values, coverage counts), both indexed by the period label.
+    """
+    series = series.dropna()
+    if freq == '1h':
+        source_freq = '10min'
+        # hour ending: (HH-1:00, HH:00] -> label HH:00
+        labels = series.index.ceil('1h')
+    else:
+        source_freq = '1h'
+        # day D: (D start, D+1 start] for hour-ending values, [D start, D+1 start) for observations
+        shifted = series.index - pd.Timedelta(hours=day_start_hour)
+        if closed == 'right':
+            shifted = shifted - pd.Timedelta(seconds=1)
+        labels = shifted.floor('1D')
+    expected = pd.Timedelta(freq) / pd.Timedelta(source_freq)
+
+    if rule.how == 'last':
+        # value at the end of the period itself
+        at_label = series[series.index == labels]
+        values = at_label.copy()
+        coverage = pd.Series(1, index=at_label.index)
+        expected = 1
+    else:
+        groups = series.groupby(labels)
+        coverage = groups.count()
+        if rule.how == 'vector_mean':
+            values = _vector_mean_deg(series, labels)
+        else:
+            values = getattr(groups, rule.how)()
+
+    complete = coverage >= MIN_COVERAGE[rule.how] * expected
+    values = (values * rule.scale).where(complete)
+    return values, coverage
+
+
+def resample_station(station_df: pd.DataFrame, targets: Iterable[str], start: pd.Timestamp, end: pd.Timestamp,
+                     day_start_hours: Optional[Dict[str, int]] = None
+                     ) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]:
+    """
+    Build aligned frames for one station from a wide frame of fetched codes.
+    RETURNS: (frames, coverage), dicts { '10min' | '1h' | '1D': DataFrame }.
+    frames hold the fetched and derived codes on a strict grid of their
+    frequency over [start, end]; coverage holds the source counts of every
+    derived value. station_df may extend beyond [start, end] (see fetch_window).
+    day_start_hours overrides the day start hour of DAY_BOUNDARY per code.
+    """
+    series: Dict[str, pd.Series] = {c: station_df[c].dropna() for c in station_df.columns}
+    coverage_series: Dict[str, pd.Series] = {}
+
+    def build(code: str) -> Optional[pd.Series]:
+        if code in series:
+            return series[code]
+        rule = DERIVATION_RULES.get(code)
+        if rule is None:
+            return None
+        source = build(rule.source)
+        if source is None:
+            return None
+        freq = DATA_TYPE_FREQ[CODE_DATA_TYPE[code]]
+        series[code], coverage_series[code] = aggregate(source, rule, freq, *day_boundary(code, day_start_hours))
+        return series[code]
+
+    for code in targets:
+        build(code)
+
+    frames: Dict[str, pd.DataFrame] = {}
+    coverage: Dict[str, pd.DataFrame] = {}
+    for data_type, freq in DATA_TYPE_FREQ.items():
+        codes = [c for c in series if CODE_DATA_TYPE.get(c) == data_type]
+        if not codes:
+            continue
+        if freq == '1D':
+            full_index = pd.date_range(start=start.floor('1D'), end=end, freq=freq)
+        else:
+            full_index = pd.date_range(start=start.ceil(freq), end=end, freq=freq)
+        df = pd.DataFrame({c: series[c].reindex(full_index) for c in codes}, index=full_index)
+        df.index.name = "datetime (utc)"
+        frames[freq] = df
+        derived = [c for c in codes if c in coverage_series]
+        if derived:
+            cov = pd.DataFrame({c: coverage_series[c].reindex(full_index).fillna(0).astype(int) for c in derived},
+                               index=full_index)
+            cov.index.name = "datetime (utc)"
+            coverage[freq] = cov
+    return frames, coverage
+
+
+# ---------------- Fetch + derive ----------------
+def fetch_and_resample(params_to_download: List[str],
+                       stations_to_download: List[str],
+                       start_date_str: str,
+                       end_date_str: str,
+                       max_workers: int = MAX_WORKERS,
+                       metrics_log: Optional[str] = None,
+                       day_start_hours: Optional[Dict[str, int]] = None
+                       ) -> Dict[str, Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]]:
+    """
+    Like fetch_data_for_parameters_parallel, but coarser codes that can be
+    derived from finer requested codes are not downloaded. When codes are derived
+    the fetch covers one extra target period on each side, so the boundary
+    periods are complete; the frames are trimmed to [start, end].
+    RETURNS: dict { station_name: (frames, coverage) } as from resample_station.
+    """
+    codes = []
+    for name in params_to_download:
+        for params in (possible_minute_params, possible_hour_params, possible_24h_params):
+            if name in params:
+                codes.append(params[name])
+    to_fetch, to_derive = plan_fetch(codes)
+    print(f"Fetching {to_fetch}, deriving {to_derive} locally")
+
+    start = pd.Timestamp(start_date_str)
+    end = pd.Timestamp(end_date_str)
+    fetch_start, fetch_end = fetch_window(start, end, to_derive)
+    station_frames = fetch_data_for_parameters_parallel(
+        [CODE_PARAM[c] for c in to_fetch], stations_to_download,
+        fetch_start.strftime("%Y-%m-%d %H:%M:%S"), fetch_end.strftime("%Y-%m-%d %H:%M:%S"),
+        max_workers=max_workers, metrics_log=metrics_log)
+
+    return {station: resample_station(df, codes, start, end, day_start_hours)
+            for station, df in station_frames.items()}
+
+
+if __name__ == "__main__":
+    results = fetch_and_resample(
+        ['10 minute precipitation sum (mm)', '1h precipitation sum (mm)', '24h precipitation sum (mm)',
+         'air temp at full hour (C)', '24h mean air temp (C)'],
+        ['Türi'],
+        "2023-11-01 00:00:00",
+        "2023-11-30 23:50:00",
+    )
+    for station, (frames, coverage) in results.items():
+        for freq, df in frames.items():
+            print(station, freq, df.shape)
@@ -0,0 +1,273 @@
+"""Streaming per-pixel climatology of the rainfall intensity frames.
+
+One pass over ``rainfall_intensities`` builds, for every day, month and year,
+per-pixel:
+- rainfall depth sum (mm, frames are 5-minute intensities in mm/h)
+- maximum intensity (mm/h)
+- wet-frame count (intensity >= WET_THRESHOLD)
+- exceedance counts for INTENSITY_THRESHOLDS
+- a fixed-bin intensity histogram used as a mergeable quantile sketch
+
+Only the currently open day, month and year are kept in memory, so memory is
+constant whatever the archive length. A reduction state is a dict of numpy
+arrays saved as a compressed ``<state_dir>/<period>/<key>.npz`` (counts are
+stored as uint16 while the frame count fits, i.e. for every day and for months
+up to ~227 days of 5-minute frames); states remember the time
+span they cover, are checkpointed while running (restart skips frames that
+are already included) and can be merged, so months can be reduced in
+parallel and combined into years afterwards.
+"""
+import os
+import datetime
+import numpy as np
+
+try:
+    from .radar_storage import echo_pixels, list_rainfall_files, load_rainfall, timestamp_from_path
+except ImportError:
+    from radar_storage import echo_pixels, list_rainfall_files, load_rainfall, timestamp_from_path
+
+PERIOD_FORMATS = {
+    "day": "%Y%m%d",
+    "month": "%Y%m",
+    "year": "%Y",
+}
+PERIOD_KEY_LENGTH = {"day": 8, "month": 6, "year": 4}
+
+FRAME_MINUTES = 5
+WET_THRESHOLD = 0.1  # mm/h
+INTENSITY_THRESHOLDS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)  # mm/h
+# Log-spaced histogram edges (mm/h); the last bin is open-ended
+HISTOGRAM_EDGES = np.geomspace(WET_THRESHOLD, 200.0, 25)
+
+COUNT_FIELDS = ("wet_count", "exceed_count", "histogram")
+
+CHECKPOINT_EVERY = 288  # frames (one day at 5-minute cadence)
+
+
+def new_state(shape, period, key, thresholds=INTENSITY_THRESHOLDS, edges=HISTOGRAM_EDGES):
+    # Empty reduction state for one period key
+    return {
+        "period": period,
+        "key": key,
+        "n_frames": 0,
+        "first_timestamp": "",
+        "last_timestamp": "",
+        "sum": np.zeros(shape, dtype=np.float64),
+        "max": np.zeros(shape, dtype=np.float32),
+        "wet_count": np.zeros(shape, dtype=np.uint32),
+        "thresholds": np.asarray(thresholds, dtype=np.float64),
+        "exceed_count": np.zeros((len(thresholds),) + tuple(shape), dtype=np.uint32),
+        "edges": np.asarray(edges, dtype=np.float64),
+        "histogram": np.zeros((len(edges),) + tuple(shape), dtype=np.uint32),
+    }
+
+
+def update_state(state, frame, timestamp, frame_minutes=FRAME_MINUTES):
+    # Add one intensity frame; work scales with the number of echo pixels
+    indices, values = echo_pixels(frame)
+    stamp = timestamp.strftime("%Y%m%d%H%M")
+
+    state["sum"].reshape(-1)[indices] += values * (frame_minutes / 60.0)
+    flat_max = state["max"].reshape(-1)
+    flat_max[indices] = np.maximum(flat_max[indices], values)
+
+    state["wet_count"].reshape(-1)[indices[values >= WET_THRESHOLD]] += 1
+    n_pixels = state["sum"].size
+    exceed = state["exceed_count"].reshape(len(state["thresholds"]), n_pixels)
+    for k, threshold in enumerate(state["thresholds"]):
+        exceed[k, indices[values >= threshold]] += 1
+
+    wet = values >= state["edges"][0]
+    bins = np.searchsorted(state["edges"], values[wet], side="right") - 1
+    histogram = state["histogram"].reshape(len(state["edges"]), n_pixels)
+    histogram[bins, indices[wet]] += 1  # (bin, pixel) pairs are unique within a frame
+
+    state["n_frames"] += 1
+    if not state["first_timestamp"] or stamp < state["first_timestamp"]:
+        state["first_timestamp"] = stamp
+    if stamp > state["last_timestamp"]:
+        state["last_timestamp"] = stamp
+    return state
+
+
+def merge_states(a, b):
+    # Combine two states covering disjoint time spans (e.g. two months into a year)
+    for name in ("thresholds", "edges"):
+        if not np.array_equal(a[name], b[name]):
+            raise ValueError(f"Cannot merge states with different {name}")
+    if a["sum"].shape != b["sum"].shape:
+        raise ValueError("Cannot merge states with different grid shapes")
+    if a["n_frames"] and b["n_frames"] and not (
+            a["last_timestamp"] < b["first_timestamp"] or b["last_timestamp"] < a["first_timestamp"]):
+        raise ValueError(f"States {a['key']} and {b['key']} overlap in time")
+
+    merged = dict(a)
+    merged["n_frames"] = a["n_frames"] + b["n_frames"]
+    stamps = [s for s in (a["first_timestamp"], b["first_timestamp"]) if s]
+    merged["first_timestamp"] = min(stamps) if stamps else ""
+    merged["last_timestamp"] = max(a["last_timestamp"], b["last_timestamp"])
+    merged["sum"] = a["sum"] + b["sum"]
+    merged["max"] = np.maximum(a["max"], b["max"])
+    for name in ("wet_count", "exceed_count", "histogram"):
+        merged[name] = a[name] + b[name]
+    return merged
+
+
+def save_state(state, state_dir):
+    # Write a state to <state_dir>/<period>/<key>.npz (atomically) and return the path
+    out_dir = os.path.join(state_dir, state["period"])
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{state['key']}.npz")
+    tmp_path = path + ".tmp.npz"
+    # No count exceeds n_frames, so the smallest dtype holding n_frames holds every count
+    count_dtype = np.uint16 if state["n_frames"] <= np.iinfo(np.uint16).max else np.uint32
+    stored = dict(state)
+    for name in COUNT_FIELDS:
+        stored[name] = state[name].astype(count_dtype)
+    np.savez_compressed(tmp_path, **stored)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_state(path):
+    with np.load(path) as stored:
+        state = {name: stored[name] for name in stored.files}
+    for name in COUNT_FIELDS:
+        state[name] = state[name].astype(np.uint32)
+    for name in ("period", "key", "first_timestamp", "last_timestamp"):
+        state[name] = str(state[name])
+    state["n_frames"] = int(state["n_frames"])
+    return state
+
+
+def state_quantiles(state, quantiles=(0.5, 0.9, 0.99)):
+    # Per-pixel intensity quantiles over all frames (dry frames count as 0), from the histogram.
+    # Returns (len(quantiles), ny, nx); each value is the geometric centre of the bin holding it.
+    n_frames = state["n_frames"]
+    histogram = state["histogram"]
+    edges = state["edges"]
+    centres = np.sqrt(edges * np.append(edges[1:], edges[-1] * (edges[1] / edges[0])))
+    dry = n_frames - histogram.sum(axis=0, dtype=np.int64)
+    cumulative = np.cumsum(histogram, axis=0, dtype=np.int64) + dry
+    out = np.zeros((len(quantiles),) + histogram.shape[1:], dtype=np.float32)
+    for k, q in enumerate(quantiles):
+        rank = q * n_frames
+        first_bin = np.argmax(cumulative >= rank, axis=0)
+        out[k] = np.where(dry >= rank, 0.0, centres[first_bin])
+    return out
+
+
+def state_products(state, quantiles=(0.5, 0.9, 0.99)):
+    # Final per-pixel products of a state
+    n_frames = max(state["n_frames"], 1)
+    products = {
+        "total_mm": state["sum"].astype(np.float32),
+        "max_intensity": state["max"],
+        "wet_frames": state["wet_count"],
+        "wet_fraction": (state["wet_count"] / n_frames).astype(np.float32),
+    }
+    for threshold, count in zip(state["thresholds"], state["exceed_count"]):
+        products[f"exceed_{threshold:g}_count"] = count
+        products[f"exceed_{threshold:g}_frequency"] = (count / n_frames).astype(np.float32)
+    for q, values in zip(quantiles, state_quantiles(state, quantiles)):
+        products[f"q{q * 100:g}"] = values
+    return products
+
+
+def _period_key(timestamp, period):
+    return timestamp.strftime(PERIOD_FORMATS[period])
+
+
+def reduce_rainfall_archive(rainfall_intensities_dir, state_dir, periods=("day", "month", "year"),
+                            start=None, end=None, checkpoint_every=CHECKPOINT_EVERY):
+    # One streaming pass over the intensity frames; returns the paths of the written states
+    files = list_rainfall_files(rainfall_intensities_dir)
+    open_states = {period: None for period in periods}
+    written = []
+    since_checkpoint = 0
+
+    def flush(state):
+        if state is not None and state["n_frames"]:
+            path = save_state(state, state_dir)
+            if path not in written:
+                written.append(path)
+
+    for file in files:
+        ts = timestamp_from_path(file)
+        if (start is not None and ts < start) or (end is not None and ts > end):
+            continue
+        stamp = ts.strftime("%Y%m%d%H%M")
+        frame = None
+
+        for period in periods:
+            key = _period_key(ts, period)
+            state = open_states[period]
+            if state is None or state["key"] != key:
+                flush(state)
+                existing = os.path.join(state_dir, period, f"{key}.npz")
+                state = None
+                if os.path.exists(existing):
+                    state = load_state(existing)
+                open_states[period] = state
+            if state is not None and state["first_timestamp"] <= stamp <= state["last_timestamp"]:
+                continue  # already reduced in an earlier (interrupted) run
+            if frame is None:
+                frame = load_rainfall(file, dense=False)
+            if state is None:
+                state = new_state(frame.shape, period, key)
+                open_states[period] = state
+            update_state(state, frame, ts)
+
+        since_checkpoint += 1
+        if since_checkpoint >= checkpoint_every:
+            for state in open_states.values():
+                flush(state)
+            since_checkpoint = 0
+
+    for state in open_states.values():
+        flush(state)
+    return written
+
+
+def combine_states(state_dir, source_period="month", target_period="year"):
+    # Merge finished states of one period into the enclosing period, e.g. months into years
+    source_dir = os.path.join(state_dir, source_period)
+    groups = {}
+    for f in sorted(os.listdir(source_dir)):
+        if f.endswith(".npz") and ".tmp" not in f:
+            key = f[:-4]
+            groups.setdefault(key[:PERIOD_KEY_LENGTH[target_period]], []).append(os.path.join(source_dir, f))
+
+    written = []
+    for target_key, paths in groups.items():
+        merged = None
+        for path in paths:
+            state = load_state(path)
+            merged = state if merged is None else merge_states(merged, state)
+        merged["period"] = target_period
+        merged["key"] = target_key
+        written.append(save_state(merged, state_dir))
+        print(f"Combined {len(paths)} {source_period} states into {target_period} {target_key}")
+    return written
+
+
+def reduce_months_parallel(rainfall_intensities_dir, state_dir, n_jobs=None):
+    # Reduce every month in its own worker (days and months), then combine months into years
+    from joblib import Parallel, delayed
+
+    months = sorted({timestamp_from_path(f).replace(day=1, hour=0, minute=0)
+                     for f in list_rainfall_files(rainfall_intensities_dir)})
+    if not months:
+        return []
+    n_jobs = n_jobs or max(1, (os.cpu_count() or 1) - 1)
+
+    def month_end(month_start):
+        next_month = month_start.replace(year=month_start.year + month_start.month // 12,
+                                         month=month_start.month % 12 + 1)
+        return next_month - datetime.timedelta(minutes=1)
+
+    Parallel(n_jobs=n_jobs)(
+        delayed(reduce_rainfall_archive)(rainfall_intensities_dir, state_dir, ("day", "month"),
+                                         m, month_end(m)) for m in months
+    )
+    return combine_states(state_dir, "month", "year")
@@ -0,0 +1,253 @@
+"""Static ground-clutter and beam-blockage map of the SUR radar.
+
+Persistent clutter and blocked azimuths look the same in every volume, so
+instead of finding them again in each frame with percentiles, median filters
+and connected-component labelling, they are found once from a long archive:
+
+- one streaming pass over the ``.h5`` volumes counts, per pixel, the frames
+  with echo (DBZH >= ``ECHO_THRESHOLD_DBZ``). Counts of several batches are
+  merged, so the pass runs in parallel and an existing map can be extended
+  with newer volumes.
+- pixels with echo in more than ``CLUTTER_FREQUENCY`` of the frames are
+  clutter (rain is nowhere near that frequent).
+- azimuths whose mean echo frequency is far below that of their neighbours
+  (``BLOCKAGE_RATIO``) are blocked; they are filled from the nearest
+  unblocked azimuth, as the dynamic filter did with the local median.
+
+The map is stored as ``.npz`` with the ranges, azimuths and site it was built
+for. ``apply_clutter_map`` is one row gather plus one mask assignment, after
+which ``clean_radar_reflectivity_residual`` only has to remove residual noise.
+"""
+import os
+from functools import lru_cache
+import numpy as np
+
+try:
+    from .radar_scheduler import batch_files
+    from .radar_staging import touch
+except ImportError:
+    from radar_scheduler import batch_files
+    from radar_staging import touch
+
+ECHO_THRESHOLD_DBZ = 0.0  # same as the background cutoff of the rainfall conversion
+CLUTTER_FREQUENCY = 0.5
+BLOCKAGE_WINDOW = 9  # azimuths compared with each azimuth
+BLOCKAGE_RATIO = 0.3
+# Neighbours need at least this echo frequency for a deficit to mean blockage
+MIN_BLOCKAGE_FREQUENCY = 0.005
+# Geometry tolerances when checking a map against a volume
+RANGE_TOLERANCE_M = 1.0
+AZIMUTH_TOLERANCE_DEG = 0.5
+
+# Maps registered by path, served by load_clutter_map instead of reading the file
+_registered_maps = {}
+
+
+def volume_timestamp(file):
+    # SUR.202311130300.h5 -> "202311130300"
+    return os.path.basename(file).split(".")[1]
+
+
+def read_reflectivity(file):
+    # (dbzh, ranges, azimuths, site) of the lowest sweep, or None if the file cannot be read
+    import xradar as xd
+
+    try:
+        radar_data = xd.io.open_odim_datatree(file)
+    except Exception as e:
+        print(f"Failed to open: {file} with error: {e}")
+        return None
+    touch(file)
+    sweep_0 = radar_data["/sweep_0"]
+    params = radar_data["/radar_parameters"]
+    site = np.array([float(params["latitude"].values), float(params["longitude"].values),
+                     float(params["altitude"].values)])
+    return sweep_0["DBZH"].values, sweep_0["range"].values, sweep_0["azimuth"].values, site
+
+
+def new_occurrence(shape, ranges, azimuths, site):
+    return {
+        "n_frames": 0,
+        "echo_count": np.zeros(shape, dtype=np.uint32),
+        "ranges": np.asarray(ranges, dtype=np.float64),
+        "azimuths": np.asarray(azimuths, dtype=np.float64),
+        "site": np.asarray(site, dtype=np.float64),
+        "first_timestamp": "",
+        "last_timestamp": "",
+    }
+
+
+def update_occurrence(state, dbzh, timestamp, echo_threshold=ECHO_THRESHOLD_DBZ):
+    # Count one volume; NaN (nodata) compares False and is not echo
+    with np.errstate(invalid="ignore"):
+        state["echo_count"] += dbzh >= echo_threshold
+    state["n_frames"] += 1
+    if not state["first_timestamp"] or timestamp < state["first_timestamp"]:
+        state["first_timestamp"] = timestamp
+    if timestamp > state["last_timestamp"]:
+        state["last_timestamp"] = timestamp
+    return state
+
+
+def merge_occurrence(a, b):
+    # Combine the counts of two batches of volumes
+    if a is None or b is None:
+        return a if b is None else b
+    if a["echo_count"].shape != b["echo_count"].shape:
+        raise ValueError("Cannot merge clutter counts with different grid shapes")
+    merged = dict(a)
+    merged["echo_count"] = a["echo_count"] + b["echo_count"]
+    merged["n_frames"] = a["n_frames"] + b["n_frames"]
+    stamps = [s for s in (a["first_timestamp"], b["first_timestamp"]) if s]
+    merged["first_timestamp"] = min(stamps) if stamps else ""
+    merged["last_timestamp"] = max(a["last_timestamp"], b["last_timestamp"])
+    return merged
+
+
+def count_echo_occurrence(files, echo_threshold=ECHO_THRESHOLD_DBZ):
+    # Echo counts of a list of volumes (one worker task); volumes with another grid are skipped
+    state = None
+    for file in files:
+        volume = read_reflectivity(file)
+        if volume is None:
+            continue
+        dbzh, ranges, azimuths, site = volume
+        if state is None:
+            state = new_occurrence(dbzh.shape, ranges, azimuths, site)
+        elif dbzh.shape != state["echo_count"].shape:
+            print(f"Skipping {file}: grid {dbzh.shape} differs from {state['echo_count'].shape}")
+            continue
+        update_occurrence(state, dbzh, volume_timestamp(file), echo_threshold)
+    return state
+
+
+def find_blocked_azimuths(echo_frequency, clutter_mask, window=BLOCKAGE_WINDOW, ratio=BLOCKAGE_RATIO,
+                          min_frequency=MIN_BLOCKAGE_FREQUENCY):
+    # Azimuths whose mean echo frequency (clutter excluded) is far below that of their neighbours
+    from scipy.ndimage import median_filter
+
+    open_pixels = ~clutter_mask
+    n_open = np.maximum(open_pixels.sum(axis=1), 1)
+    azimuth_frequency = np.where(open_pixels, echo_frequency, 0).sum(axis=1) / n_open
+    neighbours = median_filter(azimuth_frequency, size=window, mode="wrap")
+    return (neighbours >= min_frequency) & (azimuth_frequency < ratio * neighbours)
+
+
+def nearest_unblocked_rows(blocked):
+    # Row index to read for every azimuth: itself, or the nearest unblocked azimuth (circular)
+    n_az = len(blocked)
+    rows = np.arange(n_az)
+    open_rows = rows[~blocked]
+    if len(open_rows) == 0:
+        return rows
+    distance = np.abs(rows[:, None] - open_rows[None, :])
+    distance = np.minimum(distance, n_az - distance)
+    return np.where(blocked, open_rows[np.argmin(distance, axis=1)], rows)
+
+
+def clutter_map_from_occurrence(state, clutter_frequency=CLUTTER_FREQUENCY, blockage_ratio=BLOCKAGE_RATIO,
+                                echo_threshold=ECHO_THRESHOLD_DBZ):
+    # Clutter mask, blocked azimuths and their fill rows from merged echo counts
+    echo_frequency = (state["echo_count"] / max(state["n_frames"], 1)).astype(np.float32)
+    clutter_mask = echo_frequency > clutter_frequency
+    blocked = find_blocked_azimuths(echo_frequency, clutter_mask, ratio=blockage_ratio)
+    return {
+        "echo_frequency": echo_frequency,
+        "clutter_mask": clutter_mask,
+        "blocked_azimuths": blocked,
+        "row_source": nearest_unblocked_rows(blocked),
+        "echo_count": state["echo_count"],
+        "n_frames": state["n_frames"],
+        "first_timestamp": state["first_timestamp"],
+        "last_timestamp": state["last_timestamp"],
+        "ranges": state["ranges"],
+        "azimuths": state["azimuths"],
+        "site": state["site"],
+        "echo_threshold": echo_threshold,
+        "clutter_frequency": clutter_frequency,
+        "blockage_ratio": blockage_ratio,
+    }
+
+
+def save_clutter_map(clutter_map, path):
+    # Atomic write, so workers never load a half-written map
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **clutter_map)
+    os.replace(tmp_path, path)
+    return path
+
+
+def register_clutter_map(path, clutter_map):
+    # Serve load_clutter_map(path) from an already built map (e.g. shared-memory views in a pool worker)
+    _registered_maps[path] = clutter_map
+    load_clutter_map.cache_clear()
+
+
+@lru_cache(maxsize=4)
+def load_clutter_map(path):
+    # Cached per process, so a worker reads the map once for all its volumes
+    if path in _registered_maps:
+        return _registered_maps[path]
+    with np.load(path) as stored:
+        clutter_map = {name: stored[name] for name in stored.files}
+    for name in ("first_timestamp", "last_timestamp"):
+        clutter_map[name] = str(clutter_map[name])
+    clutter_map["n_frames"] = int(clutter_map["n_frames"])
+    # Pixels to mask after the blocked rows have been filled
+    clutter_map["source_mask"] = clutter_map["clutter_mask"][clutter_map["row_source"]]
+    for value in clutter_map.values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False  # shared between calls through the cache
+    return clutter_map
+
+
+def build_clutter_map(radar_files, output_path, clutter_frequency=CLUTTER_FREQUENCY,
+                      blockage_ratio=BLOCKAGE_RATIO, echo_threshold=ECHO_THRESHOLD_DBZ, update=True, n_jobs=None):
+    # Count echo occurrence over the volumes in parallel and write the map.
+    # With update=True the counts of an existing map are kept and only newer volumes are added.
+    from joblib import Parallel, delayed
+
+    state = None
+    if update and os.path.exists(output_path):
+        state = dict(load_clutter_map.__wrapped__(output_path))
+        state["echo_count"] = state["echo_count"].copy()
+        radar_files = [f for f in radar_files if volume_timestamp(f) > state["last_timestamp"]]
+        print(f"Extending clutter map of {state['n_frames']} frames with {len(radar_files)} newer volumes")
+
+    batches = batch_files(sorted(radar_files))
+    if batches:
+        n_jobs = n_jobs or max(1, (os.cpu_count() or 1) - 1)
+        partial_states = Parallel(n_jobs=min(n_jobs, len(batches)))(
+            delayed(count_echo_occurrence)(batch, echo_threshold) for batch in batches
+        )
+        for partial in partial_states:
+            state = merge_occurrence(state, partial)
+    if state is None:
+        raise FileNotFoundError("No readable radar volumes to build the clutter map from")
+
+    clutter_map = clutter_map_from_occurrence(state, clutter_frequency, blockage_ratio, echo_threshold)
+    save_clutter_map(clutter_map, output_path)
+    load_clutter_map.cache_clear()
+    print(f"Saved clutter map from {clutter_map['n_frames']} frames: "
+          f"{clutter_map['clutter_mask'].mean() * 100:.2f}% clutter pixels, "
+          f"{int(clutter_map['blocked_azimuths'].sum())} blocked azimuths -> {output_path}")
+    return output_path
+
+
+def clutter_map_matches(clutter_map, ranges, azimuths):
+    # True if the map was built for this sweep geometry
+    if len(ranges) != len(clutter_map["ranges"]) or len(azimuths) != len(clutter_map["azimuths"]):
+        return False
+    if np.max(np.abs(np.asarray(ranges) - clutter_map["ranges"])) > RANGE_TOLERANCE_M:
+        return False
+    azimuth_diff = np.abs(np.asarray(azimuths) - clutter_map["azimuths"]) % 360
+    return bool(np.max(np.minimum(azimuth_diff, 360 - azimuth_diff)) <= AZIMUTH_TOLERANCE_DEG)
+
+
+def apply_clutter_map(dbzh, clutter_map, fill_value=np.nan):
+    # Fill blocked azimuths from their neighbours and mask static clutter.
+    # Returns a new array holding only original values (still on the ODIM code grid).
+    cleaned = dbzh[clutter_map["row_source"]]
+    cleaned[clutter_map["source_mask"]] = fill_value
+    return cleaned
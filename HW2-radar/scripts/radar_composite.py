@@ -0,0 +1,278 @@
+"""Fast path for the pre-gridded national composite ("comp") product.
+
+The composite is an ODIM HDF5 ``COMP`` object: one reflectivity field on a
+regular Cartesian grid merged from all radars of the network, already cleaned
+by the producer. Compared to the SUR volume path nothing has to be filtered
+per azimuth and no polar geometry is involved:
+
+- ``download_composite``: zips of the ``Radar = comp`` query
+  (``radar_download`` with ``raw=False``, saved as COMP_<start>_<end>.zip);
+- ``read_composite``: the raw DBZH codes, their packing and the grid read
+  directly with h5py;
+- ``process_composite_file``: codes -> rainfall through the same lookup table
+  as the volume path (``rainfall_lookup_table``) for unsigned codes of up to
+  16 bits, otherwise by unpacking and the Z-R relation
+  (``composite_rainfall``), saved with ``save_rainfall`` so
+  ``accumulate_rainfall`` and the storage helpers work unchanged;
+- ``station_index``: (row, col) of a station from one projection of its
+  coordinates, instead of a distance search over the whole grid.
+
+Usage (from the HW2-radar folder):
+    download_composite(start, end)
+    extract_all_zips(COMP_RAW_DIR, COMP_UNZIPPED_DIR)
+    main()
+    rain = extract_stations(os.path.join(COMP_RAINFALL_DIR, "accumulated_rainfall", "1h"),
+                            {"Türi": (58.808708, 25.409156)})
+"""
+import os
+import json
+from functools import partial
+
+import numpy as np
+
+try:
+    from .radar_storage import (DEFAULT_ENCODING, existing_rainfall_path, list_rainfall_files, load_rainfall,
+                                sample_frame, save_rainfall, timestamp_from_path)
+    from .radar_reflectivity_to_rainfall import accumulate_rainfall, rainfall_lookup_table, reflectivity_to_rainfall
+    from .radar_workers import pool_map
+except ImportError:
+    from radar_storage import (DEFAULT_ENCODING, existing_rainfall_path, list_rainfall_files, load_rainfall,
+                               sample_frame, save_rainfall, timestamp_from_path)
+    from radar_reflectivity_to_rainfall import accumulate_rainfall, rainfall_lookup_table, reflectivity_to_rainfall
+    from radar_workers import pool_map
+
+COMP_RAW_DIR = "data/radar_comp_raw"
+COMP_UNZIPPED_DIR = "data/radar_comp_unzipped"
+COMP_RAINFALL_DIR = "data/radar_comp_rainfall"
+GRID_FILENAME = "composite_grid.json"
+REFLECTIVITY_QUANTITIES = ("DBZH", "TH")
+
+
+def _attr(attrs, name, default=None):
+    value = attrs.get(name, default)
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.item()
+    return value
+
+
+# ----------------------------
+# Download
+# ----------------------------
+def download_composite(start_datetime, end_datetime, interval_hour=1, days_per_hour=12, out_dir=COMP_RAW_DIR,
+                       metrics_log=None):
+    # Composite zips for [start, end], with the same hourly limit as the volume downloads
+    try:
+        from .radar_download import download_radar_data_with_limit
+    except ImportError:
+        from radar_download import download_radar_data_with_limit
+
+    download_radar_data_with_limit(start_datetime, end_datetime, interval_hour, days_per_hour, raw=False,
+                                   out_dir=out_dir, metrics_log=metrics_log)
+
+
+# ----------------------------
+# Reading
+# ----------------------------
+def read_composite(file):
+    # Raw reflectivity codes (ysize, xsize; row 0 = north), their packing, the grid and the timestamp
+    import h5py
+
+    with h5py.File(file, "r") as h5:
+        what, where = h5["what"].attrs, h5["where"].attrs
+        timestamp = f"{_attr(what, 'date')}{_attr(what, 'time')}"[:12]
+        for name in sorted(k for k in h5.keys() if k.startswith("dataset")):
+            dataset = h5[name]
+            for data_name in sorted(k for k in dataset.keys() if k.startswith("data")):
+                data_what = dataset[data_name]["what"].attrs
+                if _attr(data_what, "quantity") in REFLECTIVITY_QUANTITIES:
+                    codes = dataset[data_name]["data"][()]
+                    packing = (float(_attr(data_what, "gain", 1.0)), float(_attr(data_what, "offset", 0.0)),
+                               _attr(data_what, "nodata"), _attr(data_what, "undetect"))
+                    break
+            else:
+                continue
+            break
+        else:
+            raise ValueError(f"No reflectivity quantity {REFLECTIVITY_QUANTITIES} in {file}")
+        grid = {
+            "projdef": _attr(where, "projdef"),
+            "xsize": int(_attr(where, "xsize")),
+            "ysize": int(_attr(where, "ysize")),
+            "xscale": float(_attr(where, "xscale")),
+            "yscale": float(_attr(where, "yscale")),
+            "UL_lon": float(_attr(where, "UL_lon")),
+            "UL_lat": float(_attr(where, "UL_lat")),
+        }
+    return codes, packing, grid, timestamp
+
+
+def grid_origin(grid):
+    # Projected (x, y) of the outer upper-left corner of the grid
+    from pyproj import Transformer
+
+    transformer = Transformer.from_crs("EPSG:4326", grid["projdef"], always_xy=True)
+    return transformer.transform(grid["UL_lon"], grid["UL_lat"])
+
+
+def save_grid(directory, grid):
+    # Store the grid once next to the frames, with its projected origin
+    path = os.path.join(directory, GRID_FILENAME)
+    if os.path.exists(path):
+        return path
+    grid = dict(grid)
+    grid["UL_x"], grid["UL_y"] = grid_origin(grid)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(grid, f, indent=1)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_grid(directory):
+    with open(os.path.join(directory, GRID_FILENAME)) as f:
+        return json.load(f)
+
+
+# ----------------------------
+# Conversion
+# ----------------------------
+def composite_rainfall(codes, packing, a=300, b=1.5, background_cutoff=0.0):
+    # Rainfall intensity (mm/h) of raw composite codes; nodata, undetect and codes below the
+    # background cutoff are NaN. Unsigned codes of up to 16 bits go through the cached lookup
+    # table (as odim_encoding allows for the volumes); anything else (signed, 32-bit, float)
+    # is unpacked as offset + gain * code first.
+    gain, offset, nodata, undetect = packing
+    if codes.dtype.kind == "u" and codes.dtype.itemsize <= 2:
+        table = rainfall_lookup_table(gain, offset, a, b, background_cutoff,
+                                      None if nodata is None else int(nodata),
+                                      None if undetect is None else int(undetect),
+                                      2 ** (8 * codes.dtype.itemsize))
+        return table[codes]
+    dbz = offset + gain * codes.astype(np.float64)
+    invalid = np.isnan(dbz) | (dbz < background_cutoff)
+    for code in (nodata, undetect):
+        if code is not None:
+            invalid |= codes == code
+    with np.errstate(invalid="ignore", over="ignore"):
+        rainfall = reflectivity_to_rainfall(dbz, a=a, b=b).astype(np.float32)
+    rainfall[invalid] = np.nan
+    return rainfall
+
+
+def process_composite_file(file, rainfall_intensities_dir, a=300, b=1.5, encoding=DEFAULT_ENCODING):
+    # Composite reflectivity -> rainfall intensity frame; returns the saved path (None if skipped)
+    try:
+        codes, packing, grid, timestamp = read_composite(file)
+    except Exception as e:
+        print(f"Failed to open: {file} with error: {e}")
+        return None
+
+    existing_file = existing_rainfall_path(rainfall_intensities_dir, timestamp)
+    if existing_file is not None:
+        print(f"Skipping existing file: {existing_file}")
+        return None
+
+    rainfall_intensity = composite_rainfall(codes, packing, a, b)
+
+    output_file = save_rainfall(rainfall_intensities_dir, timestamp, rainfall_intensity, encoding=encoding)
+    save_grid(rainfall_intensities_dir, grid)
+    print(f"Saved: {output_file}")
+    return output_file
+
+
+def process_composite_batch(files, rainfall_intensities_dir, a=300, b=1.5, encoding=DEFAULT_ENCODING):
+    return [process_composite_file(file, rainfall_intensities_dir, a, b, encoding) for file in files]
+
+
+def main(a=300, b=1.5, intervals=(1,), encoding=DEFAULT_ENCODING, input_dir=COMP_UNZIPPED_DIR,
+         output_base_dir=COMP_RAINFALL_DIR, n_jobs=None, pool=None):
+    # pool: persistent worker pool from radar_workers.start_pool, used instead of fresh joblib workers
+    try:
+        from .radar_scheduler import batch_files
+    except ImportError:
+        from radar_scheduler import batch_files
+
+    rainfall_intensities_dir = os.path.join(output_base_dir, "rainfall_intensities")
+    accumulated_rainfall_dir = os.path.join(output_base_dir, "accumulated_rainfall")
+    os.makedirs(rainfall_intensities_dir, exist_ok=True)
+    os.makedirs(accumulated_rainfall_dir, exist_ok=True)
+
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"Input directory not found: {input_dir}")
+    files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(".h5"))
+    if not files:
+        raise FileNotFoundError(f"No .h5 files found in {input_dir}")
+
+    batches = batch_files(files)
+    if pool is not None:
+        pool_map(pool, partial(process_composite_batch, rainfall_intensities_dir=rainfall_intensities_dir,
+                               a=a, b=b, encoding=encoding), batches)
+    else:
+        from joblib import Parallel, delayed
+
+        n_jobs = n_jobs or max(1, (os.cpu_count() or 1) - 1)
+        Parallel(n_jobs=min(n_jobs, len(batches)))(
+            delayed(process_composite_batch)(batch, rainfall_intensities_dir, a, b, encoding) for batch in batches
+        )
+
+    accumulate_rainfall(rainfall_intensities_dir, accumulated_rainfall_dir, intervals, encoding)
+
+
+# ----------------------------
+# Stations
+# ----------------------------
+def station_index(grid, lat, lon):
+    # (row, col) of the grid cell containing a station, None outside the grid
+    from pyproj import Transformer
+
+    transformer = Transformer.from_crs("EPSG:4326", grid["projdef"], always_xy=True)
+    x, y = transformer.transform(lon, lat)
+    ul_x, ul_y = grid["UL_x"], grid["UL_y"]
+    col = int(np.floor((x - ul_x) / grid["xscale"]))
+    row = int(np.floor((ul_y - y) / grid["yscale"]))
+    if 0 <= row < grid["ysize"] and 0 <= col < grid["xsize"]:
+        return row, col
+    return None
+
+
+def extract_stations(product_dir, stations, grid_dir=None):
+    # Time series of every station ({name: (lat, lon)}) from a directory of composite frames,
+    # one DataFrame column per station inside the grid
+    import pandas as pd
+
+    grid = load_grid(grid_dir or os.path.join(COMP_RAINFALL_DIR, "rainfall_intensities"))
+    names, flat_indices = [], []
+    for name, (lat, lon) in stations.items():
+        index = station_index(grid, lat, lon)
+        if index is None:
+            print(f"Station {name} is outside the composite grid")
+            continue
+        names.append(name)
+        flat_indices.append(np.ravel_multi_index(index, (grid["ysize"], grid["xsize"])))
+    flat_indices = np.asarray(flat_indices, dtype=np.int64)
+
+    rows, times = [], []
+    for file in list_rainfall_files(product_dir):
+        rows.append(sample_frame(load_rainfall(file, dense=False), flat_indices))
+        times.append(timestamp_from_path(file))
+    df = pd.DataFrame(np.asarray(rows, dtype=np.float64).reshape(len(rows), len(names)), index=times,
+                      columns=names)
+    df.index.name = "datetime"
+    return df
+
+
+if __name__ == '__main__':
+    import datetime
+
+    try:
+        from .radar_unzip import extract_all_zips
+    except ImportError:
+        from radar_unzip import extract_all_zips
+
+    download_composite(datetime.datetime(2023, 11, 13, 2, 0), datetime.datetime(2023, 11, 13, 7, 59))
+    extract_all_zips(COMP_RAW_DIR, COMP_UNZIPPED_DIR)
+    main()
+    print(extract_stations(os.path.join(COMP_RAINFALL_DIR, "accumulated_rainfall", "1h"),
+                           {"Türi": (58.808708, 25.409156)}))
@@ -3,10 +3,16 @@ import json
 import time
 import datetime
 import copy
-import requests
+
+try:
+    from .http_metrics import HttpStats
+except ImportError:
+    from http_metrics import HttpStats
 
 path = "./data/radar_raw"
-os.makedirs(path, exist_ok=True)
+
+# Request metrics of the zipped-files endpoint (see http_metrics.py)
+HTTP_STATS = HttpStats("radar")
 
 zipped_files_url = "https://avaandmed.keskkonnaportaal.ee/_vti_bin/RmApi.svc/active/items/zipped-files"
 
@@ -129,7 +135,14 @@ def format_timestep(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S.0000000\u002B00:00")
 
 
-def download_radar_data_for_range(start_datetime, end_datetime, raw=False):
+def zip_filename(start_datetime, end_datetime, out_dir=path, product="SUR"):
+    # product: "SUR" for raw volumes, "COMP" for the national composite
+    return f"{out_dir}/{product}_{start_datetime.strftime('%Y%m%d%H%M')}_{end_datetime.strftime('%Y%m%d%H%M')}.zip"
+
+
+def download_radar_data_for_range(start_datetime, end_datetime, raw=False, out_dir=path, url=zipped_files_url):
+    import requests
+
     start_timestamp = format_timestep(start_datetime)
     end_timestamp = format_timestep(end_datetime)
 
@@ -146,25 +159,30 @@ def download_radar_data_for_range(start_datetime, end_datetime, raw=False):
 
     try:
         print(f"Requesting data from {start_timestamp} to {end_timestamp}...")
-        with requests.post(
-                zipped_files_url,
+        with HTTP_STATS.track(url, start=start_timestamp, end=end_timestamp) as rec, requests.post(
+                url,
                 json=filter_json,
                 headers={"Content-Type": "application/json"},
                 stream=True,
                 timeout=360
         ) as response:
+            # With stream=True the call returns once the headers are in
+            rec["status"] = response.status_code
+            rec["ttfb_s"] = response.elapsed.total_seconds()
 
             if response.status_code == 200:
-                print(response.headers)
-
-                filename = f"{path}/SUR_{start_datetime.strftime('%Y%m%d%H%M')}_{end_datetime.strftime('%Y%m%d%H%M')}.zip"
+                os.makedirs(out_dir, exist_ok=True)
+                filename = zip_filename(start_datetime, end_datetime, out_dir, "SUR" if raw else "COMP")
                 with open(filename, "wb") as file:
                     for chunk in response.iter_content(chunk_size=8192):
-
+                        rec["bytes"] += len(chunk)
                         file.write(chunk)
-                print(f"Data downloaded successfully as '{filename}'.")
+                print(f"Data downloaded successfully as '{filename}' "
+                      f"({rec['bytes'] / 1e6:.1f} MB, first byte after {rec['ttfb_s']:.1f} s).")
+                print(HTTP_STATS.summary_line())
                 return True
             else:
+                rec["error"] = f"HTTP {response.status_code}"
                 print(f"Failed to download data: {response.status_code} - {response.text}")
                 return False
 
@@ -173,31 +191,61 @@ def download_radar_data_for_range(start_datetime, end_datetime, raw=False):
         return False
 
 
+def hourly_limiter():
+    # Download budget state of download_radar_data_with_limit; share one between calls
+    # (e.g. the merged ranges of a batch) so the hourly limit holds across all of them
+    return {"days": 0.0, "start_time": time.time()}
+
+
 def download_radar_data_with_limit(start_datetime: datetime.datetime,
                                    end_datetime: datetime.datetime,
                                    interval_hour: int,
                                    days_per_hour: int,
-                                   raw=True):
+                                   raw=True,
+                                   out_dir=path,
+                                   metrics_log=None,
+                                   staging_budget_gb=None,
+                                   limiter=None):
+    # limiter: state from hourly_limiter() shared by several calls; None starts a fresh hour
+    # staging_budget_gb: keep raw and unzipped data under this size by evicting completed files
+    # (see radar_staging.py) before every download
+    # The range is pinned while downloading, so no budget enforcement evicts its zips and volumes
+    try:
+        from .radar_staging import enforce_budget, pinned
+    except ImportError:
+        from radar_staging import enforce_budget, pinned
 
     ranges = generate_ranges(start_datetime, end_datetime, interval_hour)
-    total_days_downloaded = 0
-    start_time = time.time()
-
-    for start, end in ranges:
-        if total_days_downloaded >= days_per_hour:
-            elapsed_time = time.time() - start_time
-            if elapsed_time < 3600:
-                wait_time = 3800 - elapsed_time
-                print(f"Waiting {wait_time:.2f} seconds to comply with the hourly limit...")
-                time.sleep(wait_time)
-            total_days_downloaded = 0
-            start_time = time.time()
-
-        success = download_radar_data_for_range(start, end, raw=raw)
-        if success:
-            total_days_downloaded += interval_hour / 24
-        else:
-            print(f"Skipping to the next range after failure for {start} to {end}.")
+    if metrics_log is not None:
+        HTTP_STATS.open_log(metrics_log)
+    if limiter is None:
+        limiter = hourly_limiter()
+
+    try:
+        with pinned([(start_datetime, end_datetime)], "download", raw_dir=out_dir):
+            for start, end in ranges:
+                if limiter["days"] >= days_per_hour:
+                    elapsed_time = time.time() - limiter["start_time"]
+                    if elapsed_time < 3600:
+                        wait_time = 3800 - elapsed_time
+                        print(f"Waiting {wait_time:.2f} seconds to comply with the hourly limit...")
+                        HTTP_STATS.record_throttle(wait_time, reason="hourly download limit")
+                        time.sleep(wait_time)
+                    limiter["days"] = 0.0
+                    limiter["start_time"] = time.time()
+
+                if staging_budget_gb is not None:
+                    enforce_budget(int(staging_budget_gb * 1024 ** 3), raw_dir=out_dir)
+
+                success = download_radar_data_for_range(start, end, raw=raw, out_dir=out_dir)
+                if success:
+                    limiter["days"] += interval_hour / 24
+                else:
+                    print(f"Skipping to the next range after failure for {start} to {end}.")
+    finally:
+        print(HTTP_STATS.summary_line())
+        HTTP_STATS.write_summary()
+        HTTP_STATS.close_log()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,17 @@
 import numpy as np
-import pandas as pd
-import datetime
 import os
+from functools import partial
+
+try:
+    from .radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+    from .radar_workers import pool_map, shared_coords
+except ImportError:
+    from radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+    from radar_workers import pool_map, shared_coords
+
+RAINFALL_INTENSITIES_DIR = 'data/radar_rainfall/rainfall_intensities'
+# Files per worker task when extracting on a pool
+EXTRACT_BATCH_FILES = 256
 
 
 def get_coords_arr(ranges, azimuths, radar_lat, radar_lon):
@@ -24,33 +34,49 @@ def get_station_index(latarr, lonarr, stationcoords):
     return idx
 
 
-if __name__ == '__main__':
-    # load in radar azimuths, ranges and meta file that holds information to generate coordinate fields.
-    azims = np.load('data/radar_rainfall/rainfall_intensities/azimuths.npy')
-    ranges = np.load('data/radar_rainfall/rainfall_intensities/ranges.npy')
-    meta = np.load('data/radar_rainfall/rainfall_intensities/radar_metadata.npy')
+def station_indices(geometry_dir, stations):
+    # {name: (azimuth index, range index)} for {name: (lat, lon)}; inside a worker pool the
+    # lat/lon fields are the shared arrays (radar_workers.shared_coords), not recomputed
+    latarr, lonarr = shared_coords(geometry_dir)
+    return {name: get_station_index(latarr, lonarr, coords) for name, coords in stations.items()}
+
+
+def sample_files(files, flat_indices):
+    # (n_files, n_indices) values of every file at the flat pixel indices
+    rows = [sample_frame(load_rainfall(file, dense=False), flat_indices) for file in files]
+    return np.asarray(rows, dtype=np.float64).reshape(len(files), len(flat_indices))
 
-    # generate coordinate fields
-    latarr, lonarr = get_coords_arr(ranges, azims, meta[0], meta[1])
 
+def extract_stations(product_dir, stations, geometry_dir=RAINFALL_INTENSITIES_DIR, pool=None,
+                     batch_files=EXTRACT_BATCH_FILES):
+    # Time series of every station ({name: (lat, lon)}) from a directory of frames, one column per station.
+    # pool: radar_workers pool; batches are sampled in the workers and returned through shared memory.
+    import pandas as pd
+
+    indices = station_indices(geometry_dir, stations)
+    shape = tuple(shared_coords(geometry_dir)[0].shape)
+    flat_indices = np.array([np.ravel_multi_index(index, shape) for index in indices.values()], dtype=np.int64)
+    files = list_rainfall_files(product_dir)
+    if pool is not None and files:
+        batches = [files[i:i + batch_files] for i in range(0, len(files), batch_files)]
+        values = np.concatenate(pool_map(pool, partial(sample_files, flat_indices=flat_indices), batches,
+                                         shared_result=True))
+    else:
+        values = sample_files(files, flat_indices)
+    df = pd.DataFrame(values, index=[timestamp_from_path(file) for file in files], columns=list(indices))
+    df.index.name = 'datetime'
+    return df
+
+
+if __name__ == '__main__':
     # Türi station that I have used so far
     stationcoords = [58.808708, 25.409156]
 
-    # get array index for the station that user analyses
-    lat_ind, lon_ind = get_station_index(latarr, lonarr, stationcoords)
-
-    # loop to extract accumulated rainfall from radar arrays for the station
+    # extract accumulated rainfall from radar arrays for the station
+    # (coordinate fields come from the azimuths, ranges and meta file of the intensities)
     image_path = 'data/radar_rainfall/accumulated_rainfall/1h'
-    rain_amount = [] 
-    for file in sorted(os.listdir(image_path)):
-        print(file)
-        ts_str = os.path.basename(file).split("_")[1].split(".")[0]
-        ts = datetime.datetime.strptime(ts_str, "%Y%m%d%H%M")
-        rainfall = np.load(os.path.join(image_path, file))
-        rain_amount.append((ts, rainfall[lat_ind, lon_ind]))
+    rain_df = extract_stations(image_path, {'radar_rain_amount': stationcoords})
 
     # save radar rainfall for further plotting
-    rain_df = pd.DataFrame(rain_amount, columns=['datetime', 'radar_rain_amount'])
-    rain_df.set_index('datetime', inplace=True)
     rain_df.sort_index(inplace=True)
     rain_df.to_csv('radar_rain_amount.csv')
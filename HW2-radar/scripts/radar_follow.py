@@ -0,0 +1,321 @@
+"""Near-real-time follow mode of the radar pipeline.
+
+``follow`` polls the zipped-files endpoint for SUR volumes newer than the last
+one it has seen and pushes each new volume straight through unzip, cleaning,
+conversion (``process_radar_file``) and the frame index. Rolling 1h/3h/24h
+accumulations are updated incrementally: the new frame is added to a running
+sum and frames that fall out of the window are read back from disk and
+subtracted, so an update costs two sparse frames instead of up to 288. Station
+values (intensity and rolling sums) are appended to one CSV per station.
+
+Rolling sums follow the convention of ``accumulate_rainfall`` (sum of the
+intensity frames); the product labelled T holds the frames in [T - window, T),
+so after the frame at t the product is written as t + FRAME_INTERVAL, and
+rolling_1h at a full hour is the same sum as the 1h product.
+
+Every poll asks again for the last ``late_lookback`` minutes, so volumes that
+are published late (behind an already processed one) are still picked up;
+frames that already exist are skipped.
+
+``serve_replay`` starts a local HTTP server that answers the zipped-files
+request from a directory of volumes, releasing them on a (sped up) replay
+clock, so follow mode can be run and timed without the live endpoint:
+
+    server, url, clock = serve_replay("data/radar_unzipped", start, speed=60)
+    follow(url=url, now=clock, poll_interval_s=5)
+"""
+import os
+import io
+import csv
+import json
+import time
+import bisect
+import zipfile
+import datetime
+import threading
+from collections import deque
+import numpy as np
+
+try:
+    from .radar_download import download_radar_data_for_range, zip_filename, zipped_files_url
+    from .radar_unzip import extract_zip_file
+    from .radar_storage import (DEFAULT_ENCODING, add_frame, existing_rainfall_path, list_rainfall_files,
+                                load_rainfall, sample_frame, save_rainfall, timestamp_from_path)
+    from .radar_summary import INDEX_FILENAME, write_summaries
+    from .radar_extract import station_indices as extract_station_indices
+    from .radar_reflectivity_to_rainfall import process_radar_file
+    from .radar_staging import enforce_budget, pinned
+except ImportError:
+    from radar_download import download_radar_data_for_range, zip_filename, zipped_files_url
+    from radar_unzip import extract_zip_file
+    from radar_storage import (DEFAULT_ENCODING, add_frame, existing_rainfall_path, list_rainfall_files,
+                               load_rainfall, sample_frame, save_rainfall, timestamp_from_path)
+    from radar_summary import INDEX_FILENAME, write_summaries
+    from radar_extract import station_indices as extract_station_indices
+    from radar_reflectivity_to_rainfall import process_radar_file
+    from radar_staging import enforce_budget, pinned
+
+POLL_INTERVAL_S = 30
+# How far back the first poll looks for volumes
+INITIAL_LOOKBACK = datetime.timedelta(hours=1)
+# Every later poll re-asks this far back for volumes published late
+LATE_LOOKBACK = datetime.timedelta(minutes=30)
+# Radar cadence, as assumed by accumulate_rainfall (12 frames per hour)
+FRAME_INTERVAL = datetime.timedelta(minutes=5)
+ROLLING_WINDOWS_H = (1, 3, 24)
+# Running sums are float64; anything below this after a subtraction is rounding residue
+ROLLING_ZERO = 1e-6
+
+RAW_DIR = "data/radar_raw"
+UNZIPPED_DIR = "data/radar_unzipped"
+RAINFALL_INTENSITIES_DIR = "data/radar_rainfall/rainfall_intensities"
+ACCUMULATED_RAINFALL_DIR = "data/radar_rainfall/accumulated_rainfall"
+STATIONS_DIR = "data/radar_rainfall/stations"
+
+
+# ----------------------------
+# Rolling accumulations
+# ----------------------------
+def new_rolling(window_h, shape):
+    return {
+        "window": datetime.timedelta(hours=window_h),
+        "window_h": window_h,
+        "sum": np.zeros(shape, dtype=np.float64),
+        "frames": deque(),  # (timestamp, path), sorted by timestamp
+    }
+
+
+def rolling_time(state):
+    # Label of the current sum: the product at T holds the frames in [T - window, T)
+    return state["frames"][-1][0] + FRAME_INTERVAL if state["frames"] else None
+
+
+def rolling_add(state, timestamp, file, frame=None):
+    # Add one intensity frame and drop the frames that left the window (read back from disk).
+    # Returns False if the frame is already included or older than the window.
+    frames = state["frames"]
+    if frames and timestamp < rolling_time(state) - state["window"]:
+        return False
+    if any(ts == timestamp for ts, _ in frames):
+        return False
+    add_frame(state["sum"], load_rainfall(file, dense=False) if frame is None else frame)
+    bisect.insort(frames, (timestamp, file))  # late volumes are inserted in place
+
+    window_start = rolling_time(state) - state["window"]
+    while frames and frames[0][0] < window_start:
+        _, old_file = frames.popleft()
+        add_frame(state["sum"], load_rainfall(old_file, dense=False), scale=-1.0)
+    state["sum"][state["sum"] < ROLLING_ZERO] = 0.0
+    return True
+
+
+def rolling_from_disk(rainfall_intensities_dir, window_h, end_time, shape):
+    # Rebuild a rolling state from the stored frames in [end_time - window, end_time) once at start-up
+    state = new_rolling(window_h, shape)
+    start_time = end_time - state["window"]
+    for file in list_rainfall_files(rainfall_intensities_dir):
+        ts = timestamp_from_path(file)
+        if start_time <= ts < end_time:
+            rolling_add(state, ts, file)
+    return state
+
+
+def save_rolling(state, accumulated_rainfall_dir, encoding=DEFAULT_ENCODING):
+    # Write the current sum as rolling_<N>h/rainfall_<T>, T = newest frame + FRAME_INTERVAL
+    if not state["frames"]:
+        return None
+    out_dir = os.path.join(accumulated_rainfall_dir, f"rolling_{state['window_h']}h")
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = rolling_time(state).strftime("%Y%m%d%H%M")
+    return save_rainfall(out_dir, stamp, state["sum"], encoding=encoding)
+
+
+# ----------------------------
+# Station extraction
+# ----------------------------
+def station_indices(rainfall_intensities_dir, stations):
+    # {name: (azimuth index, range index)} for {name: (lat, lon)}
+    return extract_station_indices(rainfall_intensities_dir, stations)
+
+
+def append_station_rows(stations_dir, indices, timestamp, frame, rolling_states):
+    # One row per station: timestamp, intensity and every rolling sum
+    os.makedirs(stations_dir, exist_ok=True)
+    header = ["datetime", "radar_intensity"] + [f"radar_rolling_{s['window_h']}h" for s in rolling_states]
+    for name, index in indices.items():
+        row = [timestamp.strftime("%Y-%m-%d %H:%M:%S"), float(sample_frame(frame, index))]
+        row += [float(s["sum"][index]) for s in rolling_states]
+        path = os.path.join(stations_dir, f"radar_follow_{name}.csv")
+        new_file = not os.path.exists(path)
+        with open(path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(header)
+            writer.writerow(row)
+
+
+# ----------------------------
+# Follow loop
+# ----------------------------
+def volume_timestamp(name):
+    # SUR.202311130300.h5 -> datetime(2023, 11, 13, 3, 0), None for other files
+    parts = os.path.basename(name).split(".")
+    if len(parts) < 3 or parts[-1] != "h5":
+        return None
+    try:
+        return datetime.datetime.strptime(parts[1], "%Y%m%d%H%M")
+    except ValueError:
+        return None
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def poll_once(start, end, url, raw_dir, unzipped_dir, rainfall_intensities_dir, keep_zips=False):
+    # Download the volumes of [start, end] and return the new ones as sorted (timestamp, path)
+    if not download_radar_data_for_range(start, end, raw=True, out_dir=raw_dir, url=url):
+        return []
+    zip_path = zip_filename(start, end, raw_dir)
+    names = extract_zip_file(os.path.basename(zip_path), raw_dir, unzipped_dir)
+    if not keep_zips and os.path.exists(zip_path):
+        os.remove(zip_path)
+    volumes = []
+    for name in names:
+        ts = volume_timestamp(name)
+        if ts is not None and existing_rainfall_path(rainfall_intensities_dir, ts.strftime("%Y%m%d%H%M")) is None:
+            volumes.append((ts, os.path.join(unzipped_dir, name)))
+    return sorted(volumes)
+
+
+def follow(stations=None, url=zipped_files_url, poll_interval_s=POLL_INTERVAL_S, now=utc_now,
+           rolling_windows_h=ROLLING_WINDOWS_H, a=300, b=1.5, encoding=DEFAULT_ENCODING, clutter_map_path=None,
+           raw_dir=RAW_DIR, unzipped_dir=UNZIPPED_DIR, rainfall_intensities_dir=RAINFALL_INTENSITIES_DIR,
+           accumulated_rainfall_dir=ACCUMULATED_RAINFALL_DIR, stations_dir=STATIONS_DIR,
+           initial_lookback=INITIAL_LOOKBACK, late_lookback=LATE_LOOKBACK, max_polls=None, keep_zips=False,
+           staging_budget_gb=None):
+    # Poll for new volumes and process each as soon as it arrives.
+    # stations: {name: (lat, lon)}; now: clock returning naive UTC datetimes (replay clock in tests).
+    # late_lookback: every poll also covers this much time before now, for volumes published late.
+    # staging_budget_gb: evict processed volumes and zips beyond this size after every poll.
+    os.makedirs(rainfall_intensities_dir, exist_ok=True)
+    index_path = os.path.join(rainfall_intensities_dir, INDEX_FILENAME)
+    rolling_states = None
+    indices = None
+    last_seen = None
+    attempted = set()  # volumes that were processed (or failed) in the lookback window
+    polls = 0
+
+    while max_polls is None or polls < max_polls:
+        poll_start = time.perf_counter()
+        end = now().replace(second=0, microsecond=0)
+        if last_seen is None:
+            start = end - initial_lookback
+        else:
+            start = min(last_seen + datetime.timedelta(minutes=1), end - late_lookback)
+        new_volumes = []
+        # Volumes of this poll stay pinned until they are converted
+        with pinned([(start, end)], "follow", raw_dir):
+            if start <= end:
+                polled = poll_once(start, end, url, raw_dir, unzipped_dir, rainfall_intensities_dir, keep_zips)
+                new_volumes = [(ts, volume) for ts, volume in polled if ts not in attempted]
+            attempted = {ts for ts in attempted if ts >= start} | {ts for ts, _ in new_volumes}
+
+            for ts, volume in new_volumes:
+                summary = process_radar_file(volume, rainfall_intensities_dir, a, b, encoding,
+                                             clutter_map_path=clutter_map_path)
+                output_file = existing_rainfall_path(rainfall_intensities_dir, ts.strftime("%Y%m%d%H%M"))
+                if output_file is None:
+                    continue
+                write_summaries(index_path, [summary])
+                frame = load_rainfall(output_file, dense=False)
+
+                if rolling_states is None:
+                    rolling_states = [rolling_from_disk(rainfall_intensities_dir, h, ts, frame.shape)
+                                      for h in rolling_windows_h]
+                for state in rolling_states:
+                    if rolling_add(state, ts, output_file, frame):
+                        save_rolling(state, accumulated_rainfall_dir, encoding)
+
+                if stations:
+                    if indices is None:
+                        indices = station_indices(rainfall_intensities_dir, stations)
+                    append_station_rows(stations_dir, indices, ts, frame, rolling_states)
+                print(f"Follow: {ts:%Y-%m-%d %H:%M} processed "
+                      f"{time.perf_counter() - poll_start:.1f} s after poll start")
+
+        if staging_budget_gb is not None and new_volumes:
+            enforce_budget(int(staging_budget_gb * 1024 ** 3), raw_dir, unzipped_dir, rainfall_intensities_dir)
+        if new_volumes:
+            last_seen = max(last_seen or new_volumes[-1][0], new_volumes[-1][0])
+        elif last_seen is None:
+            last_seen = start - datetime.timedelta(minutes=1)  # nothing yet, keep asking from here
+        polls += 1
+        if max_polls is not None and polls >= max_polls:
+            break
+        time.sleep(max(0.0, poll_interval_s - (time.perf_counter() - poll_start)))
+
+
+# ----------------------------
+# Local replay server
+# ----------------------------
+def _filter_timestamps(node, found=None):
+    # Timestamp bounds of a zipped-files filter, {"greaterThanOrEqual": ..., "lessThanOrEqual": ...}
+    found = {} if found is None else found
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ("greaterThanOrEqual", "lessThanOrEqual") and value.get("field") == "Timestamp":
+                found[key] = datetime.datetime.strptime(value["value"][:19], "%Y-%m-%dT%H:%M:%S")
+            else:
+                _filter_timestamps(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            _filter_timestamps(value, found)
+    return found
+
+
+def replay_clock(start, speed=1.0):
+    # Clock starting at start and running speed times faster than the wall clock
+    t0 = time.time()
+    return lambda: start + datetime.timedelta(seconds=(time.time() - t0) * speed)
+
+
+def serve_replay(volume_dir, start, speed=1.0, host="127.0.0.1", port=0):
+    # Serve the volumes of volume_dir like the zipped-files endpoint; a volume is available once the
+    # replay clock has passed its timestamp. Returns (server, url, clock); stop with server.shutdown().
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    clock = replay_clock(start, speed)
+    volumes = sorted((ts, name) for name in os.listdir(volume_dir)
+                     for ts in [volume_timestamp(name)] if ts is not None)
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            bounds = _filter_timestamps(json.loads(body or b"{}"))
+            first = bounds.get("greaterThanOrEqual", datetime.datetime.min)
+            last = min(bounds.get("lessThanOrEqual", datetime.datetime.max), clock())
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+                for ts, name in volumes:
+                    if first <= ts <= last:
+                        archive.write(os.path.join(volume_dir, name), name)
+            payload = buffer.getvalue()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://{host}:{server.server_address[1]}/zipped-files"
+    print(f"Replaying {len(volumes)} volumes from {volume_dir} at {url} ({speed:g}x)")
+    return server, url, clock
+
+
+if __name__ == "__main__":
+    follow(stations={"Turi": (58.808708, 25.409156)})
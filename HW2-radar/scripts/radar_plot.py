@@ -1,11 +1,15 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from cartopy.io import shapereader
+from functools import partial
 from pathlib import Path
 
+try:
+    from .radar_storage import load_rainfall, timestamp_from_path
+    from .radar_workers import pool_map, shared_coords
+except ImportError:
+    from radar_storage import load_rainfall, timestamp_from_path
+    from radar_workers import pool_map, shared_coords
+
 
 def _resolve_default_land_shp():
     here = Path(__file__).resolve().parent
@@ -29,19 +33,29 @@ def plot_radar_polar(
     station_label="Station",
     transparency_threshold=0.05,
     radar_alpha=0.7,
+    lat=None,
+    lon=None,
 ):
+    # lat, lon: precomputed coordinate fields of the sweep (e.g. radar_workers.shared_coords),
+    # computed from ranges and azimuths when not given
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import BoundaryNorm
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from cartopy.io import shapereader
 
     levels = np.linspace(0, 15, 15)
     base_cmap = plt.cm.RdBu_r
 
-    r, theta = np.meshgrid(ranges, np.radians(azimuths))
-    # ODIM azimuth is clockwise from north:
-    # x (east) = r * sin(theta), y (north) = r * cos(theta)
-    x = r * np.sin(theta)
-    y = r * np.cos(theta)
+    if lat is None or lon is None:
+        r, theta = np.meshgrid(ranges, np.radians(azimuths))
+        # ODIM azimuth is clockwise from north:
+        # x (east) = r * sin(theta), y (north) = r * cos(theta)
+        x = r * np.sin(theta)
+        y = r * np.cos(theta)
 
-    lat = radar_lat + (y / 6371000) * (180 / np.pi)
-    lon = radar_lon + (x / (6371000 * np.cos(np.radians(radar_lat)))) * (180 / np.pi)
+        lat = radar_lat + (y / 6371000) * (180 / np.pi)
+        lon = radar_lon + (x / (6371000 * np.cos(np.radians(radar_lat)))) * (180 / np.pi)
 
     projection = ccrs.Stereographic(central_latitude=radar_lat, central_longitude=radar_lon)
     fig, ax = plt.subplots(subplot_kw={'projection': projection}, figsize=(8, 8))
@@ -119,12 +133,34 @@ def plot_radar_polar(
     plt.close()
 
 
+def plot_frame_file(file, out_dir, geometry_dir, **kwargs):
+    # Plot one stored frame as <out_dir>/radar_rainfall_<timestamp>.png; the lat/lon fields come from
+    # shared memory when running on a radar_workers pool
+    meta = np.load(os.path.join(geometry_dir, "radar_metadata.npy"))
+    lat, lon = shared_coords(geometry_dir)
+    stamp = timestamp_from_path(file).strftime("%Y%m%d%H%M")
+    filename = os.path.join(out_dir, f"radar_rainfall_{stamp}.png")
+    plot_radar_polar(load_rainfall(file), f"Rainfall {stamp}", filename, None, None, float(meta[0]),
+                     float(meta[1]), lat=lat, lon=lon, **kwargs)
+    return filename
+
+
+def plot_frames(files, out_dir, geometry_dir="data/radar_rainfall/rainfall_intensities", pool=None, **kwargs):
+    # Plot many frames; with a radar_workers pool (started with geometry_dir) every task reuses the
+    # shared lat/lon fields instead of rebuilding them. kwargs go to plot_radar_polar.
+    os.makedirs(out_dir, exist_ok=True)
+    task = partial(plot_frame_file, out_dir=out_dir, geometry_dir=geometry_dir, **kwargs)
+    if pool is not None:
+        return pool_map(pool, task, files)
+    return [task(file) for file in files]
+
+
 if __name__ == '__main__':
     file_to_plot = 'data/radar_rainfall/accumulated_rainfall/1h/rainfall_202311130300.npy'
     azims = np.load('data/radar_rainfall/rainfall_intensities/azimuths.npy')
     ranges = np.load('data/radar_rainfall/rainfall_intensities/ranges.npy')
     meta = np.load('data/radar_rainfall/rainfall_intensities/radar_metadata.npy')
-    array_to_plot = np.load(file_to_plot)
+    array_to_plot = load_rainfall(file_to_plot)
 
     local_land = "assets/ne_50m_land/ne_50m_land.shp"
     plot_radar_polar(
@@ -3,12 +3,27 @@ Author: Yee Chun Tsoi, Department of Marine Systems
 Modified by: Sander Rikka, Department of Marine Systems
 """
 import os
+import bisect
 import datetime
+from functools import lru_cache, partial
 import numpy as np
-import xradar as xd
-import wradlib as wrl
-from joblib import Parallel, delayed
-from scipy.ndimage import median_filter, label
+
+try:
+    from .radar_storage import (DEFAULT_ENCODING, add_frame, existing_rainfall_path, list_rainfall_files,
+                                load_rainfall, save_rainfall, timestamp_from_path)
+    from .radar_scheduler import plan_rainfall_workers
+    from .radar_summary import INDEX_FILENAME, is_indexed, summarize_frame, write_summaries
+    from .radar_clutter import apply_clutter_map, clutter_map_matches, load_clutter_map
+    from .radar_staging import touch
+    from .radar_workers import pool_map
+except ImportError:
+    from radar_storage import (DEFAULT_ENCODING, add_frame, existing_rainfall_path, list_rainfall_files,
+                               load_rainfall, save_rainfall, timestamp_from_path)
+    from radar_scheduler import plan_rainfall_workers
+    from radar_summary import INDEX_FILENAME, is_indexed, summarize_frame, write_summaries
+    from radar_clutter import apply_clutter_map, clutter_map_matches, load_clutter_map
+    from radar_staging import touch
+    from radar_workers import pool_map
 
 
 def reflectivity_to_rainfall(reflectivity, a=300, b=1.5):
@@ -17,7 +32,50 @@ def reflectivity_to_rainfall(reflectivity, a=300, b=1.5):
     return (Z / a) ** (1 / b)
 
 
+@lru_cache(maxsize=32)
+def rainfall_lookup_table(gain, offset, a=300, b=1.5, background_cutoff=0.0, nodata=None, undetect=None,
+                          n_codes=256):
+    # Rainfall intensity (mm/h) for every raw ODIM code: value = offset + gain * code.
+    # Codes below the background cutoff and the nodata/undetect codes map to NaN.
+    dbz = offset + gain * np.arange(n_codes, dtype=np.float64)
+    table = reflectivity_to_rainfall(dbz, a=a, b=b).astype(np.float32)
+    table[dbz < background_cutoff] = np.nan
+    for code in (nodata, undetect):
+        if code is not None and 0 <= code < n_codes:
+            table[int(code)] = np.nan
+    table.flags.writeable = False  # shared between calls through the cache
+    return table
+
+
+def reflectivity_codes_to_rainfall(codes, table):
+    # One gather per pixel instead of two float powers and their temporaries
+    return table[codes]
+
+
+def quantize_reflectivity(dbzh, gain, offset, nodata, dtype=np.uint8):
+    # Map decoded dBZ back onto raw codes; NaN -> nodata code
+    codes = np.rint((dbzh - offset) / gain)
+    codes[np.isnan(codes)] = nodata
+    return codes.astype(dtype)
+
+
+def odim_encoding(data_array):
+    # (gain, offset, nodata, undetect, dtype) of a decoded ODIM moment, or None if it was not packed
+    dbzh_encoding = data_array.encoding
+    gain = dbzh_encoding.get("scale_factor")
+    if gain is None:
+        return None
+    dtype = np.dtype(dbzh_encoding.get("dtype", np.uint8))
+    if dtype.kind not in "ui" or dtype.itemsize > 2:
+        return None
+    return (float(gain), float(dbzh_encoding.get("add_offset", 0.0)), dbzh_encoding.get("_FillValue"),
+            data_array.attrs.get("_Undetect"), dtype)
+
+
 def clean_radar_reflectivity_by_azimuth_aggressive(dbzh, window, threshold, background_cutoff, fill_value, min_area):
+    import wradlib as wrl
+    from scipy.ndimage import median_filter
+
     # Detect and replace outlier rows based on azimuthal profiles
     row_medians = np.percentile(dbzh, 95, axis=1)
     row_medians[row_medians < 0] = 0
@@ -34,18 +92,35 @@ def clean_radar_reflectivity_by_azimuth_aggressive(dbzh, window, threshold, back
     new_dbzh[new_dbzh < background_cutoff] = fill_value
 
     # Remove small speckles and isolated regions
-    valid_mask = ~np.isnan(new_dbzh)
-    labeled, num_features = label(valid_mask)
-    for region in range(1, num_features + 1):
-        region_mask = (labeled == region)
-        area = np.sum(region_mask)
-        if area <= min_area:
-            new_dbzh[region_mask] = np.nan
+    remove_small_regions(new_dbzh, min_area)
 
     new_dbzh = wrl.util.despeckle(new_dbzh, n=5)
     return new_dbzh
 
 
+def remove_small_regions(dbzh, min_area):
+    # Set connected echo regions of at most min_area pixels to NaN (in place).
+    # Region areas come from one bincount instead of one full-grid mask per region.
+    from scipy.ndimage import label
+
+    labeled, num_features = label(~np.isnan(dbzh))
+    if num_features:
+        small = np.bincount(labeled.ravel(), minlength=num_features + 1) <= min_area
+        small[0] = False  # background
+        dbzh[small[labeled]] = np.nan
+    return dbzh
+
+
+def clean_radar_reflectivity_residual(dbzh, background_cutoff, fill_value, min_area):
+    # Light cleaning after the static clutter map has removed clutter and blocked azimuths
+    import wradlib as wrl
+
+    new_dbzh = dbzh.copy()
+    new_dbzh[new_dbzh < background_cutoff] = fill_value
+    remove_small_regions(new_dbzh, min_area)
+    return wrl.util.despeckle(new_dbzh, n=5)
+
+
 def save_radar_metadata(directory, sweep_0, radar_data):
     # Save range, azimuth, and radar metadata to disk
     np.save(os.path.join(directory, "ranges.npy"), sweep_0["range"].values)
@@ -57,82 +132,103 @@ def save_radar_metadata(directory, sweep_0, radar_data):
     ]))
 
 
-def process_radar_file(file, rainfall_intensities_dir, a, b):
+def process_radar_file(file, rainfall_intensities_dir, a, b, encoding=DEFAULT_ENCODING, use_lut=True,
+                       clutter_map_path=None):
     # Process a single radar file and compute rainfall intensity
+    import xradar as xd
+
     try:
         radar_data = xd.io.open_odim_datatree(file)
     except Exception as e:
         print(f"Failed to open: {file} with error: {e}")
         return
+    touch(file)
 
     filename = os.path.basename(file)
     timestamp = filename.split(".")[1]
-    output_file = os.path.join(rainfall_intensities_dir, f"rainfall_{timestamp}.npy")
-
-    if os.path.exists(output_file):
-        print(f"Skipping existing file: {output_file}")
-        return
+    existing_file = existing_rainfall_path(rainfall_intensities_dir, timestamp)
 
     sweep_0 = radar_data["/sweep_0"]
+    if existing_file is not None:
+        print(f"Skipping existing file: {existing_file}")
+        if is_indexed(os.path.join(rainfall_intensities_dir, INDEX_FILENAME), timestamp):
+            return
+        # Frame from an earlier run that never made it into the index: summarise the stored frame
+        return summarize_frame(
+            load_rainfall(existing_file, dense=False), timestamp_from_path(existing_file),
+            sweep_0["range"].values, sweep_0["azimuth"].values,
+            float(radar_data["/radar_parameters"]["latitude"].values),
+            float(radar_data["/radar_parameters"]["longitude"].values))
+
     reflectivity = sweep_0["DBZH"].values
 
     if reflectivity.shape != (360, 833):
         return
 
     # Clean reflectivity and convert to rainfall
-    reflectivity_filtered = clean_radar_reflectivity_by_azimuth_aggressive(
-        reflectivity, window=5, threshold=8.0, background_cutoff=0.0, fill_value=np.nan, min_area=10)
-    rainfall_intensity = reflectivity_to_rainfall(reflectivity_filtered, a=a, b=b)
+    background_cutoff = 0.0
+    clutter_map = load_clutter_map(clutter_map_path) if clutter_map_path else None
+    if clutter_map is not None and not clutter_map_matches(clutter_map, sweep_0["range"].values,
+                                                           sweep_0["azimuth"].values):
+        print(f"Clutter map geometry does not match {filename}, using the full filter")
+        clutter_map = None
+    if clutter_map is not None:
+        # Static clutter and blockage from the map, only residual noise is filtered per frame
+        reflectivity_filtered = clean_radar_reflectivity_residual(
+            apply_clutter_map(reflectivity, clutter_map), background_cutoff=background_cutoff,
+            fill_value=np.nan, min_area=10)
+    else:
+        reflectivity_filtered = clean_radar_reflectivity_by_azimuth_aggressive(
+            reflectivity, window=5, threshold=8.0, background_cutoff=background_cutoff, fill_value=np.nan,
+            min_area=10)
+
+    packing = odim_encoding(sweep_0["DBZH"]) if use_lut else None
+    if packing is not None:
+        # Cleaning only keeps or replaces original values, so the filtered field is still on the code grid
+        gain, offset, nodata, undetect, dtype = packing
+        n_codes = 2 ** (8 * dtype.itemsize)
+        if nodata is None:
+            nodata = n_codes - 1
+        table = rainfall_lookup_table(gain, offset, a, b, background_cutoff, int(nodata),
+                                      None if undetect is None else int(undetect), n_codes)
+        codes = quantize_reflectivity(reflectivity_filtered, gain, offset, nodata, dtype)
+        rainfall_intensity = reflectivity_codes_to_rainfall(codes, table)
+    else:
+        rainfall_intensity = reflectivity_to_rainfall(reflectivity_filtered, a=a, b=b)
 
     # Save processed rainfall intensity
-    np.save(output_file, np.where(np.isnan(rainfall_intensity), np.nan, rainfall_intensity))
+    output_file = save_rainfall(rainfall_intensities_dir, timestamp, rainfall_intensity, encoding=encoding)
     print(f"Saved: {output_file}")
 
     if not os.path.exists(os.path.join(rainfall_intensities_dir, "ranges.npy")):
         save_radar_metadata(rainfall_intensities_dir, sweep_0, radar_data)
 
+    # Summary for the frame index while the frame is still in memory
+    return summarize_frame(
+        rainfall_intensity, timestamp_from_path(output_file), sweep_0["range"].values, sweep_0["azimuth"].values,
+        float(radar_data["/radar_parameters"]["latitude"].values),
+        float(radar_data["/radar_parameters"]["longitude"].values))
 
-def main(a=300, b=1.5, intervals=(1,)):
-    # --- CONFIGURATION ---
-    input_dir = "data/radar_unzipped"
-    output_base_dir = "data/radar_rainfall"
-
-    rainfall_intensities_dir = os.path.join(output_base_dir, "rainfall_intensities")
-    os.makedirs(rainfall_intensities_dir, exist_ok=True)
-    accumulated_rainfall_dir = os.path.join(output_base_dir, "accumulated_rainfall")
-    os.makedirs(accumulated_rainfall_dir, exist_ok=True)
-
-    # --- LIST RADAR FILES ---
-    radar_files = []
-    if not os.path.isdir(input_dir):
-        raise FileNotFoundError(f"Input directory not found: {input_dir}")
 
-    for f in os.listdir(input_dir):
-        if f.endswith(".h5"):
-            radar_files.append(os.path.join(input_dir, f))
-    radar_files = sorted(radar_files)
-    if not radar_files:
-        raise FileNotFoundError(f"No .h5 files found in {input_dir}")
+def process_radar_batch(files, rainfall_intensities_dir, a, b, encoding=DEFAULT_ENCODING, use_lut=True,
+                        clutter_map_path=None):
+    # Process several radar files in one worker dispatch, returns their frame summaries
+    summaries = []
+    for file in files:
+        summaries.append(process_radar_file(file, rainfall_intensities_dir, a, b, encoding, use_lut,
+                                            clutter_map_path))
+    return summaries
 
-    # Process files in parallel
-    num_cores = max(1, (os.cpu_count() or 1) - 1)
-    Parallel(n_jobs=num_cores)(
-        delayed(process_radar_file)(file, rainfall_intensities_dir, a, b) for file in radar_files
-    )
 
+def accumulate_rainfall(rainfall_intensities_dir, accumulated_rainfall_dir, intervals=(1,),
+                        encoding=DEFAULT_ENCODING):
     # --- LIST RAINFALL FILES ---
-    rainfall_files = []
-    for f in os.listdir(rainfall_intensities_dir):
-        if f.startswith("rainfall_"):
-            rainfall_files.append(os.path.join(rainfall_intensities_dir, f))
-    rainfall_files = sorted(rainfall_files)
+    rainfall_files = list_rainfall_files(rainfall_intensities_dir)
 
     # Parse timestamps from filenames
     timestamps = []
     for idx, file in enumerate(rainfall_files):
-        ts_str = os.path.basename(file).split("_")[1].split(".")[0]
-        ts = datetime.datetime.strptime(ts_str, "%Y%m%d%H%M")
-        timestamps.append((idx, ts))
+        timestamps.append((idx, timestamp_from_path(file)))
 
     # --- HOURLY ACCUMULATION ---
     for interval_hr in intervals:
@@ -147,37 +243,94 @@ def main(a=300, b=1.5, intervals=(1,)):
             if ts.minute == 0 and ts.second == 0:
                 hourly_indices.append(i)
 
-        # For each full-hour timestamp, accumulate previous frames
+        # For each full-hour timestamp T, accumulate the frames in [T - interval, T) (the frame at
+        # T itself belongs to the next interval). Frames are selected by time, not by position
+        # in the file list: a T whose window misses a frame is skipped instead of reaching back
+        # across the gap, so separate event windows in one directory are never mixed.
+        times = [ts for _, ts in timestamps]
         for i in hourly_indices:
-            if i < frames_needed:
+            first = bisect.bisect_left(times, times[i] - datetime.timedelta(hours=interval_hr))
+            if i - first < frames_needed:
                 continue  # Not enough history
 
             # Select files to sum
-            files_to_sum = []
-            for j in range(i - frames_needed, i):
-                files_to_sum.append(rainfall_files[j])
+            files_to_sum = rainfall_files[first:i]
 
             try:
-                sample = np.load(files_to_sum[0])
+                sample = load_rainfall(files_to_sum[0], dense=False)
             except:
                 continue
-            accum_rainfall = np.zeros_like(sample)
+            # Sum in float64 regardless of the storage encoding
+            accum_rainfall = np.zeros(sample.shape, dtype=np.float64)
 
-            # Sum rainfall across selected frames
+            # Sum rainfall across selected frames; sparse frames only add their echo pixels
             for file in files_to_sum:
                 try:
-                    rainfall = np.load(file)
-                    accum_rainfall += np.nan_to_num(rainfall)
+                    rainfall = load_rainfall(file, dense=False)
+                    add_frame(accum_rainfall, rainfall)
                 except Exception as e:
                     print(f"Skipping {file} due to error: {e}")
                     break
 
             # Save accumulated rainfall to file
-            timestamp_str = os.path.basename(rainfall_files[i]).split("_")[1].split(".")[0]
-            out_name = os.path.join(interval_dir, f"rainfall_{timestamp_str}.npy")
-            np.save(out_name, accum_rainfall)
+            timestamp_str = timestamp_from_path(rainfall_files[i]).strftime("%Y%m%d%H%M")
+            out_name = save_rainfall(interval_dir, timestamp_str, accum_rainfall, encoding=encoding)
             print(f"Saved accumulated rainfall: {out_name}")
 
 
+def main(a=300, b=1.5, intervals=(1,), encoding=DEFAULT_ENCODING, use_lut=True, ram_budget_gb=None,
+         max_workers=None, clutter_map_path=None, pool=None):
+    # clutter_map_path: static clutter map from radar_clutter.build_clutter_map; without it every
+    # frame goes through the full clean_radar_reflectivity_by_azimuth_aggressive filter
+    # pool: persistent worker pool from radar_workers.start_pool, used instead of fresh joblib workers
+    # --- CONFIGURATION ---
+    input_dir = "data/radar_unzipped"
+    output_base_dir = "data/radar_rainfall"
+
+    rainfall_intensities_dir = os.path.join(output_base_dir, "rainfall_intensities")
+    os.makedirs(rainfall_intensities_dir, exist_ok=True)
+    accumulated_rainfall_dir = os.path.join(output_base_dir, "accumulated_rainfall")
+    os.makedirs(accumulated_rainfall_dir, exist_ok=True)
+
+    # --- LIST RADAR FILES ---
+    radar_files = []
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"Input directory not found: {input_dir}")
+
+    for f in os.listdir(input_dir):
+        if f.endswith(".h5"):
+            radar_files.append(os.path.join(input_dir, f))
+    radar_files = sorted(radar_files)
+    if not radar_files:
+        raise FileNotFoundError(f"No .h5 files found in {input_dir}")
+
+    # Process files in parallel, worker count capped by the RAM budget
+    ram_budget_bytes = None if ram_budget_gb is None else int(ram_budget_gb * 1024 ** 3)
+    if pool is not None:
+        # The pool's workers are already running; at most as many batches as the RAM budget
+        # allows (<= pool size) are in flight at a time
+        num_workers, batches = plan_rainfall_workers(radar_files, ram_budget_bytes, pool["max_workers"])
+        batch_summaries = pool_map(
+            pool, partial(process_radar_batch, rainfall_intensities_dir=rainfall_intensities_dir, a=a, b=b,
+                          encoding=encoding, use_lut=use_lut, clutter_map_path=clutter_map_path),
+            batches, max_in_flight=num_workers)
+    else:
+        from joblib import Parallel, delayed
+
+        num_workers, batches = plan_rainfall_workers(radar_files, ram_budget_bytes, max_workers)
+        batch_summaries = Parallel(n_jobs=num_workers)(
+            delayed(process_radar_batch)(batch, rainfall_intensities_dir, a, b, encoding, use_lut,
+                                         clutter_map_path)
+            for batch in batches
+        )
+
+    # Record the frame summaries in the queryable index
+    index_path = os.path.join(rainfall_intensities_dir, INDEX_FILENAME)
+    n_indexed = write_summaries(index_path, [s for batch in batch_summaries for s in batch])
+    print(f"Indexed {n_indexed} frame summaries in {index_path}")
+
+    accumulate_rainfall(rainfall_intensities_dir, accumulated_rainfall_dir, intervals, encoding)
+
+
 if __name__ == "__main__":
     main()
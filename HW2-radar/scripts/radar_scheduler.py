@@ -0,0 +1,98 @@
+"""Memory-aware scheduling of the reflectivity -> rainfall stage.
+
+Every worker opens a full xradar datatree and keeps several full-size float64
+temporaries (percentile, median filters, labels, masks), so on many-core
+machines memory runs out long before the CPUs are busy. The scheduler
+estimates the peak footprint of each task, caps the number of workers to a
+RAM budget and groups files into batches so that each dispatch does enough
+work to hide the joblib overhead.
+"""
+import os
+
+GRID_SHAPE = (360, 833)
+
+# Full-size float64 grids alive at the peak of process_radar_file
+PEAK_GRID_COPIES = 12
+# Decoded datatree (all moments, float) relative to the size of the .h5 file
+DATATREE_EXPANSION = 8
+# Interpreter plus the imported radar stack in each worker
+WORKER_BASELINE_BYTES = 300 * 1024 ** 2
+# Share of the available memory used when no budget is given
+DEFAULT_RAM_FRACTION = 0.7
+# Files are batched until a batch holds about this much input
+TARGET_BATCH_BYTES = 64 * 1024 ** 2
+MAX_BATCH_FILES = 32
+
+
+def available_memory_bytes():
+    # Currently available RAM (Linux /proc/meminfo, POSIX sysconf fallback), None if unknown
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_task_memory(file, grid_shape=GRID_SHAPE):
+    # Peak bytes needed to process one radar volume on top of the worker baseline
+    grid_bytes = grid_shape[0] * grid_shape[1] * 8
+    return os.path.getsize(file) * DATATREE_EXPANSION + PEAK_GRID_COPIES * grid_bytes
+
+
+def batch_files(files, target_batch_bytes=TARGET_BATCH_BYTES, max_batch_files=MAX_BATCH_FILES):
+    # Group consecutive files so that every batch carries about target_batch_bytes of input
+    batches = []
+    current = []
+    current_bytes = 0
+    for file in files:
+        current.append(file)
+        current_bytes += os.path.getsize(file)
+        if current_bytes >= target_batch_bytes or len(current) >= max_batch_files:
+            batches.append(current)
+            current = []
+            current_bytes = 0
+    if current:
+        batches.append(current)
+    return batches
+
+
+def plan_rainfall_workers(files, ram_budget_bytes=None, max_workers=None, grid_shape=GRID_SHAPE):
+    # Choose the worker count for a RAM budget and split the files into batches.
+    # Returns (n_jobs, batches).
+    if not files:
+        return 1, []
+
+    if ram_budget_bytes is None:
+        available = available_memory_bytes()
+        if available is not None:
+            ram_budget_bytes = int(available * DEFAULT_RAM_FRACTION)
+
+    cpu_workers = max(1, (os.cpu_count() or 1) - 1)
+    if max_workers is not None:
+        cpu_workers = max(1, min(cpu_workers, max_workers))
+
+    task_bytes = max(estimate_task_memory(f, grid_shape) for f in files)
+    per_worker_bytes = WORKER_BASELINE_BYTES + task_bytes
+    if ram_budget_bytes is None:
+        memory_workers = cpu_workers
+    else:
+        memory_workers = max(1, ram_budget_bytes // per_worker_bytes)
+
+    n_jobs = int(min(cpu_workers, memory_workers))
+    batches = batch_files(files)
+    # Keep at least two batches per worker so nobody sits idle at the end
+    if len(batches) < n_jobs * 2:
+        batches = batch_files(files, max_batch_files=max(1, len(files) // (n_jobs * 2)))
+    n_jobs = min(n_jobs, len(batches))
+
+    budget_str = "unknown" if ram_budget_bytes is None else f"{ram_budget_bytes / 1024 ** 3:.1f} GB"
+    print(f"Scheduler: {len(files)} files in {len(batches)} batches, "
+          f"~{per_worker_bytes / 1024 ** 2:.0f} MB per worker, RAM budget {budget_str}, "
+          f"CPU limit {cpu_workers} -> {n_jobs} workers")
+    return n_jobs, batches
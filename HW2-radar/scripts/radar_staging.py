@@ -0,0 +1,241 @@
+"""Disk-budgeted staging area for raw zips and unzipped radar volumes.
+
+``data/radar_raw`` (SUR_<start>_<end>.zip) and ``data/radar_unzipped``
+(SUR.<YYYYmmddHHMM>.h5) are intermediate data: once the rainfall intensity
+frame of a volume exists, neither the volume nor the zip it came from is
+needed again. ``enforce_budget`` keeps both directories under a byte budget by
+deleting files least-recently-used first, but only files whose downstream
+products are complete:
+
+- a volume is complete when its intensity frame exists
+  (``existing_rainfall_path``);
+- a zip is complete when every member is either extracted or already has its
+  intensity frame.
+
+Time ranges can be pinned (``pin``/``unpin``, kept in ``.staging_pins.json``,
+whose read-modify-write is serialised across processes by a lock file) so that volumes and zips needed by pending work are never evicted, whatever
+their state. The downloaders and ``batch_assignments.run_batch`` pin the ranges
+they work on with ``pinned`` for as long as they run. Unlike
+``radar_clean_raw_files.delete_raw_files`` nothing is lost that would have to
+be downloaded again.
+
+Readers of staged files (unzipping, conversion, the clutter map) call ``touch``,
+which sets the access and modification time explicitly, so the LRU order does
+not depend on the atime behaviour of the mount (relatime/noatime).
+"""
+import os
+import json
+import time
+import zipfile
+import itertools
+from contextlib import contextmanager
+
+try:
+    from .radar_storage import existing_rainfall_path
+except ImportError:
+    from radar_storage import existing_rainfall_path
+
+RAW_DIR = "data/radar_raw"
+UNZIPPED_DIR = "data/radar_unzipped"
+RAINFALL_INTENSITIES_DIR = "data/radar_rainfall/rainfall_intensities"
+PINS_FILENAME = ".staging_pins.json"
+# A lock older than this was left by a crashed process and is broken
+PINS_LOCK_STALE_S = 60
+PINS_LOCK_POLL_S = 0.05
+STAMP_FORMAT = "%Y%m%d%H%M"
+
+
+def volume_stamp(name):
+    # SUR.202311130300.h5 -> "202311130300", None for other files
+    parts = name.split(".")
+    if len(parts) >= 3 and parts[-1] == "h5" and len(parts[1]) == 12 and parts[1].isdigit():
+        return parts[1]
+    return None
+
+
+def zip_span(name):
+    # SUR_202311130200_202311130259.zip -> ("202311130200", "202311130259"), None for other files
+    if not name.endswith(".zip"):
+        return None
+    parts = name[:-4].split("_")
+    if len(parts) != 3:
+        return None
+    return parts[1], parts[2]
+
+
+def touch(path):
+    # Record a use of a staged file; both times are set, so the LRU order works on noatime mounts
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+# ----------------------------
+# Pins
+# ----------------------------
+def _pins_path(raw_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(raw_dir)), PINS_FILENAME)
+
+
+def load_pins(raw_dir=RAW_DIR):
+    path = _pins_path(raw_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+@contextmanager
+def _pins_lock(raw_dir):
+    # Exclusive lock file next to the pins file (O_EXCL create works on every platform and
+    # on network mounts), held for one read-modify-write
+    path = _pins_path(raw_dir) + ".lock"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > PINS_LOCK_STALE_S:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue  # released meanwhile
+            time.sleep(PINS_LOCK_POLL_S)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _save_pins(pins, raw_dir):
+    path = _pins_path(raw_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(pins, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def pin(owner, start, end, raw_dir=RAW_DIR):
+    # Protect every volume and zip of [start, end] (datetimes) until unpin(owner)
+    with _pins_lock(raw_dir):
+        pins = load_pins(raw_dir)
+        pins.setdefault(owner, []).append([start.strftime(STAMP_FORMAT), end.strftime(STAMP_FORMAT)])
+        _save_pins(pins, raw_dir)
+
+
+def unpin(owner, raw_dir=RAW_DIR):
+    with _pins_lock(raw_dir):
+        pins = load_pins(raw_dir)
+        if pins.pop(owner, None) is not None:
+            _save_pins(pins, raw_dir)
+
+
+_pin_ids = itertools.count()
+
+
+@contextmanager
+def pinned(ranges, label="pin", raw_dir=RAW_DIR):
+    """Pin every (start, end) of ranges while the block runs; the pins are removed even on errors."""
+    owner = f"{label}-{os.getpid()}-{next(_pin_ids)}"
+    for start, end in ranges:
+        pin(owner, start, end, raw_dir)
+    try:
+        yield owner
+    finally:
+        unpin(owner, raw_dir)
+
+
+def _pinned(first, last, pins):
+    # True if the stamp span [first, last] overlaps any pinned range
+    for ranges in pins.values():
+        for start, end in ranges:
+            if first <= end and start <= last:
+                return True
+    return False
+
+
+# ----------------------------
+# Eviction
+# ----------------------------
+def staged_files(raw_dir=RAW_DIR, unzipped_dir=UNZIPPED_DIR):
+    # (path, kind, size, last use) of every staged zip and volume
+    files = []
+    for directory, kind in ((raw_dir, "zip"), (unzipped_dir, "volume")):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, kind, stat.st_size, max(stat.st_atime, stat.st_mtime)))
+    return files
+
+
+def is_evictable(path, kind, rainfall_intensities_dir, unzipped_dir, pins):
+    # Downstream products complete and not pinned
+    name = os.path.basename(path)
+    if kind == "volume":
+        stamp = volume_stamp(name)
+        if stamp is None or _pinned(stamp, stamp, pins):
+            return False
+        return existing_rainfall_path(rainfall_intensities_dir, stamp) is not None
+
+    span = zip_span(name)
+    if span is None or _pinned(span[0], span[1], pins):
+        return False
+    try:
+        with zipfile.ZipFile(path) as archive:
+            members = archive.namelist()
+    except (zipfile.BadZipFile, OSError):
+        return False  # incomplete download, leave it for the downloader
+    for member in members:
+        stamp = volume_stamp(os.path.basename(member))
+        if stamp is not None and existing_rainfall_path(rainfall_intensities_dir, stamp) is not None:
+            continue
+        if not os.path.exists(os.path.join(unzipped_dir, member)):
+            return False
+    return True
+
+
+def enforce_budget(budget_bytes, raw_dir=RAW_DIR, unzipped_dir=UNZIPPED_DIR,
+                   rainfall_intensities_dir=RAINFALL_INTENSITIES_DIR, dry_run=False):
+    # Evict completed files, least recently used first, until the staging area fits the budget.
+    # Returns a report dict (bytes before/after, reclaimed, evicted count, bytes that cannot be evicted yet).
+    files = staged_files(raw_dir, unzipped_dir)
+    total = sum(size for _, _, size, _ in files)
+    report = {"budget_bytes": budget_bytes, "before_bytes": total, "after_bytes": total,
+              "reclaimed_bytes": 0, "evicted": 0, "blocked_bytes": 0}
+    if total <= budget_bytes:
+        return report
+
+    pins = load_pins(raw_dir)
+    for path, kind, size, _ in sorted(files, key=lambda f: f[3]):
+        if total <= budget_bytes:
+            break
+        if not is_evictable(path, kind, rainfall_intensities_dir, unzipped_dir, pins):
+            report["blocked_bytes"] += size
+            continue
+        if not dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        total -= size
+        report["reclaimed_bytes"] += size
+        report["evicted"] += 1
+
+    report["after_bytes"] = total
+    print(f"Staging: {report['before_bytes'] / 1024 ** 3:.2f} GB -> {total / 1024 ** 3:.2f} GB "
+          f"(budget {budget_bytes / 1024 ** 3:.2f} GB), reclaimed {report['reclaimed_bytes'] / 1024 ** 2:.0f} MB "
+          f"from {report['evicted']} files" + (" [dry run]" if dry_run else ""))
+    if total > budget_bytes:
+        print(f"Staging: still over budget, {report['blocked_bytes'] / 1024 ** 2:.0f} MB waits for "
+              f"downstream products or is pinned")
+    return report
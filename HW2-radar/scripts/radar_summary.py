@@ -0,0 +1,224 @@
+"""Per-frame rainfall summaries and a queryable SQLite index over them.
+
+``process_radar_file`` summarises every intensity frame while it is still in
+memory: wet fraction, areal mean and maximum intensity, intensity-weighted
+echo centroid, an intensity histogram and a small block-maximum thumbnail
+(about 2 kB). The summaries go into ``frame_index.sqlite`` next to the
+intensity frames, so event search, window selection and thumbnail browsing
+over years of radar read kilobytes instead of the arrays.
+"""
+import os
+import json
+import sqlite3
+import numpy as np
+
+try:
+    from .radar_storage import echo_pixels, list_rainfall_files, load_rainfall, timestamp_from_path
+except ImportError:
+    from radar_storage import echo_pixels, list_rainfall_files, load_rainfall, timestamp_from_path
+
+INDEX_FILENAME = "frame_index.sqlite"
+
+WET_THRESHOLD = 0.1  # mm/h
+HISTOGRAM_EDGES = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0)  # mm/h, last bin open-ended
+# Thumbnail: maximum over blocks of 10 azimuths x 17 range bins, 0.5 mm/h per step
+THUMBNAIL_BLOCK = (10, 17)
+THUMBNAIL_STEP = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    timestamp TEXT PRIMARY KEY,
+    wet_fraction REAL,
+    echo_fraction REAL,
+    areal_mean REAL,
+    wet_mean REAL,
+    max_intensity REAL,
+    centroid_x_km REAL,
+    centroid_y_km REAL,
+    centroid_lat REAL,
+    centroid_lon REAL,
+    histogram TEXT,
+    thumbnail BLOB,
+    thumbnail_shape TEXT
+)
+"""
+
+
+def make_thumbnail(frame, block=THUMBNAIL_BLOCK, step=THUMBNAIL_STEP):
+    # Block maximum of the frame as uint8 codes (value = code * step)
+    n_az, n_r = frame.shape
+    thumb_shape = (-(-n_az // block[0]), -(-n_r // block[1]))
+    indices, values = echo_pixels(frame)
+    az_i, r_i = np.divmod(indices, n_r)
+    flat_thumb = (az_i // block[0]) * thumb_shape[1] + r_i // block[1]
+    codes = np.clip(np.ceil(values / step), 0, 255).astype(np.uint8)
+    thumbnail = np.zeros(thumb_shape[0] * thumb_shape[1], dtype=np.uint8)
+    np.maximum.at(thumbnail, flat_thumb, codes)
+    return thumbnail.reshape(thumb_shape)
+
+
+def summarize_frame(frame, timestamp, ranges, azimuths, radar_lat, radar_lon):
+    # Summary dict of one intensity frame (dense array or SparseFrame, mm/h)
+    n_az, n_r = frame.shape
+    n_pixels = n_az * n_r
+    indices, values = echo_pixels(frame)
+    wet = values >= WET_THRESHOLD
+
+    summary = {
+        "timestamp": timestamp.strftime("%Y%m%d%H%M"),
+        "wet_fraction": float(np.count_nonzero(wet)) / n_pixels,
+        "echo_fraction": float(len(values)) / n_pixels,
+        "areal_mean": float(values.sum()) / n_pixels,
+        "wet_mean": float(values[wet].mean()) if wet.any() else 0.0,
+        "max_intensity": float(values.max()) if len(values) else 0.0,
+        "centroid_x_km": None,
+        "centroid_y_km": None,
+        "centroid_lat": None,
+        "centroid_lon": None,
+    }
+
+    if len(values):
+        # Intensity-weighted centroid; ODIM azimuth is clockwise from north
+        az_i, r_i = np.divmod(indices, n_r)
+        r = np.asarray(ranges)[r_i]
+        theta = np.radians(np.asarray(azimuths)[az_i])
+        weights = values / values.sum()
+        x = float(np.sum(weights * r * np.sin(theta)))
+        y = float(np.sum(weights * r * np.cos(theta)))
+        summary["centroid_x_km"] = x / 1000
+        summary["centroid_y_km"] = y / 1000
+        summary["centroid_lat"] = float(radar_lat + (y / 6371000) * (180 / np.pi))
+        summary["centroid_lon"] = float(radar_lon + (x / (6371000 * np.cos(np.radians(radar_lat)))) * (180 / np.pi))
+
+    edges = np.asarray(HISTOGRAM_EDGES)
+    bins = np.searchsorted(edges, values[values >= edges[0]], side="right") - 1
+    summary["histogram"] = np.bincount(bins, minlength=len(edges)).tolist()
+
+    thumbnail = make_thumbnail(frame)
+    summary["thumbnail"] = thumbnail.tobytes()
+    summary["thumbnail_shape"] = list(thumbnail.shape)
+    return summary
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(index_path)
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def is_indexed(index_path, timestamp):
+    # Whether a frame (datetime or YYYYmmddHHMM string) already has a summary in the index
+    if not os.path.exists(index_path):
+        return False
+    key = timestamp if isinstance(timestamp, str) else timestamp.strftime("%Y%m%d%H%M")
+    connection = sqlite3.connect(index_path)
+    try:
+        row = connection.execute("SELECT 1 FROM frames WHERE timestamp = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None  # index file without the frames table yet
+    finally:
+        connection.close()
+    return row is not None
+
+
+def write_summaries(index_path, summaries):
+    # Insert or replace summaries (None entries, e.g. skipped files, are ignored)
+    rows = []
+    for s in summaries:
+        if s is None:
+            continue
+        rows.append((s["timestamp"], s["wet_fraction"], s["echo_fraction"], s["areal_mean"], s["wet_mean"],
+                     s["max_intensity"], s["centroid_x_km"], s["centroid_y_km"], s["centroid_lat"],
+                     s["centroid_lon"], json.dumps(s["histogram"]), s["thumbnail"],
+                     json.dumps(s["thumbnail_shape"])))
+    with open_index(index_path) as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    connection.close()
+    return len(rows)
+
+
+def query_frames(index_path, start=None, end=None, min_wet_fraction=None, min_max_intensity=None,
+                 with_thumbnails=False):
+    # Frames matching the filters as a DataFrame indexed by datetime
+    import pandas as pd
+
+    columns = "*" if with_thumbnails else (
+        "timestamp, wet_fraction, echo_fraction, areal_mean, wet_mean, max_intensity, "
+        "centroid_x_km, centroid_y_km, centroid_lat, centroid_lon, histogram")
+    clauses, params = [], []
+    if start is not None:
+        clauses.append("timestamp >= ?")
+        params.append(start.strftime("%Y%m%d%H%M"))
+    if end is not None:
+        clauses.append("timestamp <= ?")
+        params.append(end.strftime("%Y%m%d%H%M"))
+    if min_wet_fraction is not None:
+        clauses.append("wet_fraction >= ?")
+        params.append(min_wet_fraction)
+    if min_max_intensity is not None:
+        clauses.append("max_intensity >= ?")
+        params.append(min_max_intensity)
+    sql = f"SELECT {columns} FROM frames"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY timestamp"
+
+    connection = open_index(index_path)
+    try:
+        df = pd.read_sql_query(sql, connection, params=params)
+    finally:
+        connection.close()
+    df["datetime"] = pd.to_datetime(df["timestamp"], format="%Y%m%d%H%M")
+    df["histogram"] = df["histogram"].map(json.loads)
+    return df.set_index("datetime").drop(columns="timestamp")
+
+
+def thumbnail_from_row(row):
+    # Thumbnail of a query_frames(with_thumbnails=True) row as mm/h values
+    shape = json.loads(row["thumbnail_shape"])
+    codes = np.frombuffer(row["thumbnail"], dtype=np.uint8).reshape(shape)
+    return codes.astype(np.float32) * THUMBNAIL_STEP
+
+
+def find_events(index_path, min_wet_fraction=0.01, max_gap_minutes=30, min_frames=3, start=None, end=None):
+    # Group consecutive wet frames into events: start, end, frames, peak and mean wet fraction
+    import pandas as pd
+
+    frames = query_frames(index_path, start, end, min_wet_fraction=min_wet_fraction)
+    if frames.empty:
+        return pd.DataFrame(columns=["start", "end", "n_frames", "max_intensity", "mean_wet_fraction"])
+    gaps = frames.index.to_series().diff() > pd.Timedelta(minutes=max_gap_minutes)
+    event_id = gaps.cumsum()
+    events = frames.groupby(event_id.values).agg(
+        n_frames=("wet_fraction", "size"),
+        max_intensity=("max_intensity", "max"),
+        mean_wet_fraction=("wet_fraction", "mean"),
+    )
+    bounds = frames.index.to_series().groupby(event_id.values).agg(["min", "max"])
+    events.insert(0, "start", bounds["min"].values)
+    events.insert(1, "end", bounds["max"].values)
+    return events[events["n_frames"] >= min_frames].reset_index(drop=True)
+
+
+def build_summary_index(rainfall_intensities_dir, index_path=None):
+    # Backfill the index from stored intensity frames that are not in it yet
+    index_path = index_path or os.path.join(rainfall_intensities_dir, INDEX_FILENAME)
+    ranges = np.load(os.path.join(rainfall_intensities_dir, "ranges.npy"))
+    azimuths = np.load(os.path.join(rainfall_intensities_dir, "azimuths.npy"))
+    meta = np.load(os.path.join(rainfall_intensities_dir, "radar_metadata.npy")).astype(float)
+
+    connection = open_index(index_path)
+    known = {row[0] for row in connection.execute("SELECT timestamp FROM frames")}
+    connection.close()
+
+    summaries = []
+    for file in list_rainfall_files(rainfall_intensities_dir):
+        ts = timestamp_from_path(file)
+        if ts.strftime("%Y%m%d%H%M") in known:
+            continue
+        frame = load_rainfall(file, dense=False)
+        summaries.append(summarize_frame(frame, ts, ranges, azimuths, meta[0], meta[1]))
+    written = write_summaries(index_path, summaries)
+    print(f"Indexed {written} new frames in {index_path}")
+    return written
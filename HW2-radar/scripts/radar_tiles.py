@@ -0,0 +1,287 @@
+"""Web-mercator z/x/y PNG tile pyramid of the radar products.
+
+Frames are rendered with the colours of ``plot_radar_polar`` (RdBu_r, 0-15
+levels, transparent below 0.05) into ``<tiles_dir>/<product>/<timestamp>/{z}/{x}/{y}.png``
+so a time series can be browsed in any local XYZ tile viewer (Leaflet,
+OpenLayers, QGIS "XYZ tiles" with a ``file://`` URL).
+
+For every zoom level the tile pixel -> polar bin lookup is computed once and
+cached in ``<tiles_dir>/_lut`` under a hash of the sweep geometry, so
+rendering a frame is one ``sample_frame`` gather per zoom level. Tiles without
+any pixel above the transparency threshold are not written (and removed if an
+older version of the frame had them). A manifest per frame keeps a hash of
+every tile, so re-rendering an updated product only rewrites tiles that
+changed.
+"""
+import os
+import json
+import hashlib
+from functools import lru_cache
+import numpy as np
+
+try:
+    from .radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+except ImportError:
+    from radar_storage import list_rainfall_files, load_rainfall, sample_frame, timestamp_from_path
+
+TILE_SIZE = 256
+DEFAULT_ZOOMS = (5, 6, 7, 8)
+EARTH_RADIUS_M = 6371000  # same spherical approximation as get_coords_arr / plot_radar_polar
+
+# Colours of plot_radar_polar
+LEVELS = np.linspace(0, 15, 15)
+COLORMAP = "RdBu_r"
+TRANSPARENCY_THRESHOLD = 0.05
+RADAR_ALPHA = 0.7
+
+LUT_DIRNAME = "_lut"
+MANIFEST_FILENAME = "manifest.json"
+INDEX_FILENAME = "index.json"
+
+
+def geometry_hash(ranges, azimuths, radar_lat, radar_lon, tile_size=TILE_SIZE):
+    # Short hash identifying the sweep geometry a lookup table was built for
+    digest = hashlib.sha1()
+    for part in (ranges, azimuths, [radar_lat, radar_lon, tile_size]):
+        digest.update(np.ascontiguousarray(part, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    # Fractional web-mercator tile coordinates
+    n = 2 ** zoom
+    x = (np.asarray(lon) + 180.0) / 360.0 * n
+    lat_rad = np.radians(lat)
+    y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return x, y
+
+
+def tile_to_lonlat(x, y, zoom):
+    # Inverse of lonlat_to_tile
+    n = 2 ** zoom
+    lon = np.asarray(x) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / n))))
+    return lon, lat
+
+
+def _nearest_azimuth_index(azimuth_deg, azimuths):
+    # Index of the nearest ray (circular) for every azimuth
+    order = np.argsort(azimuths)
+    sorted_az = np.asarray(azimuths)[order]
+    pos = np.searchsorted(sorted_az, azimuth_deg) % len(sorted_az)
+    prev = (pos - 1) % len(sorted_az)
+    d_next = np.abs((sorted_az[pos] - azimuth_deg + 180) % 360 - 180)
+    d_prev = np.abs((sorted_az[prev] - azimuth_deg + 180) % 360 - 180)
+    return order[np.where(d_prev < d_next, prev, pos)]
+
+
+def build_zoom_lookup(zoom, ranges, azimuths, radar_lat, radar_lon, tile_size=TILE_SIZE):
+    # Lookup of one zoom level: the block of tiles covering the radar, and for every covered
+    # block pixel its flat polar index
+    ranges = np.asarray(ranges, dtype=np.float64)
+    max_range = ranges[-1] + (ranges[-1] - ranges[-2]) / 2
+    d_lat = np.degrees(max_range / EARTH_RADIUS_M)
+    d_lon = d_lat / np.cos(np.radians(radar_lat))
+    x0, y0 = lonlat_to_tile(radar_lon - d_lon, radar_lat + d_lat, zoom)
+    x1, y1 = lonlat_to_tile(radar_lon + d_lon, radar_lat - d_lat, zoom)
+    tx0, ty0 = int(np.floor(x0)), int(np.floor(y0))
+    n_tx, n_ty = int(np.floor(x1)) - tx0 + 1, int(np.floor(y1)) - ty0 + 1
+
+    # Pixel centres of the whole block; rows share a latitude, columns a longitude
+    px = tx0 + (np.arange(n_tx * tile_size) + 0.5) / tile_size
+    py = ty0 + (np.arange(n_ty * tile_size) + 0.5) / tile_size
+    lon, _ = tile_to_lonlat(px, np.zeros_like(px), zoom)
+    _, lat = tile_to_lonlat(np.zeros_like(py), py, zoom)
+    x = np.radians(lon - radar_lon) * EARTH_RADIUS_M * np.cos(np.radians(radar_lat))
+    y = np.radians(lat - radar_lat) * EARTH_RADIUS_M
+    xx, yy = np.meshgrid(x, y)
+    r = np.hypot(xx, yy)
+    covered = r <= max_range
+    pixel = np.flatnonzero(covered)
+
+    range_index = np.clip(np.searchsorted(ranges, r.ravel()[pixel]), 1, len(ranges) - 1)
+    closer_prev = (r.ravel()[pixel] - ranges[range_index - 1]) < (ranges[range_index] - r.ravel()[pixel])
+    range_index = np.where(closer_prev, range_index - 1, range_index)
+    azimuth = np.degrees(np.arctan2(xx.ravel()[pixel], yy.ravel()[pixel])) % 360  # clockwise from north
+    azimuth_index = _nearest_azimuth_index(azimuth, azimuths)
+    polar = (azimuth_index * len(ranges) + range_index).astype(np.int32)
+
+    return {
+        "zoom": zoom,
+        "origin": np.array([tx0, ty0]),
+        "n_tiles": np.array([n_tx, n_ty]),
+        "pixel": pixel.astype(np.int64),
+        "polar": polar,
+    }
+
+
+@lru_cache(maxsize=16)
+def load_zoom_lookup(lut_dir, zoom, ranges_bytes, azimuths_bytes, radar_lat, radar_lon, tile_size=TILE_SIZE):
+    # Cached on disk by geometry hash and in memory per process
+    ranges = np.frombuffer(ranges_bytes, dtype=np.float64)
+    azimuths = np.frombuffer(azimuths_bytes, dtype=np.float64)
+    key = geometry_hash(ranges, azimuths, radar_lat, radar_lon, tile_size)
+    path = os.path.join(lut_dir, f"{key}_z{zoom}.npz")
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            return {name: stored[name] for name in stored.files}
+    lookup = build_zoom_lookup(zoom, ranges, azimuths, radar_lat, radar_lon, tile_size)
+    os.makedirs(lut_dir, exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **lookup)
+    os.replace(tmp_path, path)
+    return lookup
+
+
+def zoom_lookups(tiles_dir, zooms, ranges, azimuths, radar_lat, radar_lon, tile_size=TILE_SIZE):
+    lut_dir = os.path.join(tiles_dir, LUT_DIRNAME)
+    ranges_bytes = np.asarray(ranges, dtype=np.float64).tobytes()
+    azimuths_bytes = np.asarray(azimuths, dtype=np.float64).tobytes()
+    return [load_zoom_lookup(lut_dir, z, ranges_bytes, azimuths_bytes, float(radar_lat), float(radar_lon),
+                             tile_size) for z in zooms]
+
+
+@lru_cache(maxsize=1)
+def colour_table():
+    # RGBA (uint8) for every colour bin of plot_radar_polar: index 0 below the first level,
+    # len(LEVELS) above the last
+    import matplotlib
+    from matplotlib.colors import BoundaryNorm
+
+    norm = BoundaryNorm(LEVELS, ncolors=256)
+    cmap = matplotlib.colormaps[COLORMAP]
+    bin_values = np.concatenate([[LEVELS[0] - 1], (LEVELS[:-1] + LEVELS[1:]) / 2, [LEVELS[-1] + 1]])
+    table = cmap(norm(bin_values), bytes=True)
+    table[:, 3] = int(round(RADAR_ALPHA * 255))
+    return table
+
+
+def colourize(values, threshold=TRANSPARENCY_THRESHOLD):
+    # RGBA (uint8) of intensity values; NaN and values below the threshold are transparent
+    bins = np.searchsorted(LEVELS, values, side="right")
+    rgba = colour_table()[bins]
+    rgba[~(values >= threshold)] = 0
+    return rgba
+
+
+def render_zoom(frame, lookup, tile_size=TILE_SIZE, threshold=TRANSPARENCY_THRESHOLD):
+    # {(z, x, y): rgba tile} of the non-transparent tiles of one zoom level
+    n_tx, n_ty = (int(n) for n in lookup["n_tiles"])
+    tx0, ty0 = (int(n) for n in lookup["origin"])
+    values = sample_frame(frame, lookup["polar"])
+    visible = values >= threshold
+    if not visible.any():
+        return {}
+    block = np.zeros((n_ty * tile_size * n_tx * tile_size, 4), dtype=np.uint8)
+    block[lookup["pixel"][visible]] = colourize(values[visible], threshold)
+    block = block.reshape(n_ty, tile_size, n_tx, tile_size, 4)
+
+    wet_tiles = block[..., 3].any(axis=(1, 3))
+    zoom = int(lookup["zoom"])
+    return {(zoom, tx0 + i, ty0 + j): block[j, :, i] for j, i in zip(*np.nonzero(wet_tiles))}
+
+
+def _read_manifest(frame_dir):
+    path = os.path.join(frame_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_frame_tiles(frame, frame_dir, lookups, threshold=TRANSPARENCY_THRESHOLD):
+    # Render one frame into frame_dir/{z}/{x}/{y}.png; returns (written, unchanged, removed) tile counts
+    from matplotlib.image import imsave
+
+    old_manifest = _read_manifest(frame_dir)
+    manifest = {}
+    written = unchanged = 0
+    for lookup in lookups:
+        for (z, x, y), rgba in render_zoom(frame, lookup, threshold=threshold).items():
+            key = f"{z}/{x}/{y}"
+            digest = hashlib.blake2b(rgba.tobytes(), digest_size=16).hexdigest()
+            manifest[key] = digest
+            path = os.path.join(frame_dir, str(z), str(x), f"{y}.png")
+            if old_manifest.get(key) == digest and os.path.exists(path):
+                unchanged += 1
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            imsave(path, np.ascontiguousarray(rgba), format="png")
+            written += 1
+
+    # Tiles of an older version of the frame that are dry now
+    removed = 0
+    for key in set(old_manifest) - set(manifest):
+        path = os.path.join(frame_dir, *key.split("/")) + ".png"
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+
+    os.makedirs(frame_dir, exist_ok=True)
+    with open(os.path.join(frame_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f)
+    return written, unchanged, removed
+
+
+def render_frame_files(files, product_tiles_dir, tiles_dir, zooms, ranges, azimuths, radar_lat, radar_lon,
+                       threshold=TRANSPARENCY_THRESHOLD):
+    # Render a batch of product files (one worker task); returns the rendered timestamps
+    lookups = zoom_lookups(tiles_dir, zooms, ranges, azimuths, radar_lat, radar_lon)
+    stamps = []
+    for file in files:
+        stamp = timestamp_from_path(file).strftime("%Y%m%d%H%M")
+        frame = load_rainfall(file, dense=False)
+        written, unchanged, removed = write_frame_tiles(
+            frame, os.path.join(product_tiles_dir, stamp), lookups, threshold)
+        if written or removed:
+            print(f"Tiles {stamp}: {written} written, {unchanged} unchanged, {removed} removed")
+        stamps.append(stamp)
+    return stamps
+
+
+def build_tile_pyramid(product_dir, tiles_dir, product=None, zooms=DEFAULT_ZOOMS,
+                       geometry_dir="data/radar_rainfall/rainfall_intensities", start=None, end=None,
+                       threshold=TRANSPARENCY_THRESHOLD, n_jobs=None):
+    # Render every frame of a product directory (intensities or an accumulation interval).
+    # Writes <tiles_dir>/<product>/index.json with the frame timestamps and the URL template.
+    from joblib import Parallel, delayed
+
+    product = product or os.path.basename(os.path.normpath(product_dir))
+    product_tiles_dir = os.path.join(tiles_dir, product)
+    ranges = np.load(os.path.join(geometry_dir, "ranges.npy"))
+    azimuths = np.load(os.path.join(geometry_dir, "azimuths.npy"))
+    meta = np.load(os.path.join(geometry_dir, "radar_metadata.npy")).astype(float)
+
+    files = []
+    for file in list_rainfall_files(product_dir):
+        ts = timestamp_from_path(file)
+        if (start is None or ts >= start) and (end is None or ts <= end):
+            files.append(file)
+    if not files:
+        return []
+
+    # Build the lookups once before the workers read them from the cache
+    zoom_lookups(tiles_dir, zooms, ranges, azimuths, meta[0], meta[1])
+    n_jobs = min(n_jobs or max(1, (os.cpu_count() or 1) - 1), len(files))
+    batches = [files[i::n_jobs] for i in range(n_jobs)]
+    rendered = Parallel(n_jobs=n_jobs)(
+        delayed(render_frame_files)(batch, product_tiles_dir, tiles_dir, zooms, ranges, azimuths,
+                                    meta[0], meta[1], threshold) for batch in batches
+    )
+
+    index_path = os.path.join(product_tiles_dir, INDEX_FILENAME)
+    index = {"timestamps": [], "zooms": list(zooms)}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    index["timestamps"] = sorted(set(index["timestamps"]) | {s for batch in rendered for s in batch})
+    index["zooms"] = sorted(set(index["zooms"]) | set(zooms))
+    index["url_template"] = os.path.abspath(product_tiles_dir) + "/{timestamp}/{z}/{x}/{y}.png"
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=1)
+    print(f"Tile pyramid of {len(files)} frames: {index['url_template']}")
+    return index["timestamps"]
+
+
+if __name__ == '__main__':
+    build_tile_pyramid('data/radar_rainfall/accumulated_rainfall/1h', 'data/radar_tiles', product='1h')
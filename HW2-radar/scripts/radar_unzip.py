@@ -3,59 +3,72 @@ Author: Yee Chun Tsoi
 Modified by: Sander Rikka"""
 import os
 import zipfile
+from functools import partial
 from datetime import datetime, timedelta
-from joblib import Parallel, delayed
-import pandas as pd
 
 
 # ----------------------------
-# Configuration
+# Configuration (defaults, pass other values explicitly)
 # ----------------------------
 ZIP_DIR = "data/radar_raw"
 OUTPUT_DIR = "data/radar_unzipped"
 MISSING_CSV_PATH = "data/missing_data_final.csv"
 
-start_date = datetime(2023, 11, 13, 2, 0)
-end_date = datetime(2023, 11, 13, 7, 59)
 TIME_INTERVAL = timedelta(minutes=5)
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 # ----------------------------
 # Helpers
 # ----------------------------
-def extract_zip_file(zip_filename):
+def extract_zip_file(zip_filename, zip_dir=ZIP_DIR, output_dir=OUTPUT_DIR):
     extracted_files = set()
-    zip_path = os.path.join(ZIP_DIR, zip_filename)
+    zip_path = os.path.join(zip_dir, zip_filename)
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        from .radar_staging import touch
+    except ImportError:
+        from radar_staging import touch
+
     try:
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            touch(zip_path)
             for file in zip_ref.namelist():
-                target_path = os.path.join(OUTPUT_DIR, file)
+                target_path = os.path.join(output_dir, file)
                 if not os.path.exists(target_path):
-                    zip_ref.extract(file, OUTPUT_DIR)
+                    zip_ref.extract(file, output_dir)
                 extracted_files.add(file)
     except zipfile.BadZipFile:
         print(f"Invalid ZIP file: {zip_filename}")
     return extracted_files
 
 
-def extract_all_zips():
-    if not os.path.isdir(ZIP_DIR):
+def extract_all_zips(zip_dir=ZIP_DIR, output_dir=OUTPUT_DIR, pool=None):
+    # pool: persistent worker pool from radar_workers.start_pool, used instead of fresh joblib workers
+    if not os.path.isdir(zip_dir):
         return set()
-    zip_files = sorted(f for f in os.listdir(ZIP_DIR) if f.endswith(".zip"))
+    zip_files = sorted(f for f in os.listdir(zip_dir) if f.endswith(".zip"))
     if not zip_files:
         return set()
-    results = Parallel(n_jobs=-1)(delayed(extract_zip_file)(f) for f in zip_files)
+    if pool is not None:
+        try:
+            from .radar_workers import pool_map
+        except ImportError:
+            from radar_workers import pool_map
+
+        results = pool_map(pool, partial(extract_zip_file, zip_dir=zip_dir, output_dir=output_dir), zip_files)
+    else:
+        from joblib import Parallel, delayed
+
+        results = Parallel(n_jobs=-1)(delayed(extract_zip_file)(f, zip_dir, output_dir) for f in zip_files)
     all_extracted = set().union(*results)
     return all_extracted
 
 
-def generate_expected_timestamps():
+def generate_expected_timestamps(start_date, end_date, time_interval=TIME_INTERVAL):
     timestamps = []
     current = start_date
     while current <= end_date:
         timestamps.append(current.strftime("%Y-%m-%dT%H:%M"))
-        current += TIME_INTERVAL
+        current += time_interval
     return timestamps
 
 
@@ -75,16 +88,21 @@ def extract_timestamps_from_files(file_list):
 # Main Execution
 # ----------------------------
 if __name__ == "__main__":
+    import pandas as pd
+
+    start_date = datetime(2023, 11, 13, 2, 0)
+    end_date = datetime(2023, 11, 13, 7, 59)
+
     print("Extracting ZIP files...")
     extracted_files = extract_all_zips()
     if not extracted_files:
-        extracted_files = set(os.listdir(OUTPUT_DIR))
+        extracted_files = set(os.listdir(OUTPUT_DIR)) if os.path.isdir(OUTPUT_DIR) else set()
 
     print("Extracting timestamps from files...")
     actual_timestamps = extract_timestamps_from_files(extracted_files)
 
     print("Generating expected timestamps...")
-    expected_timestamps = generate_expected_timestamps()
+    expected_timestamps = generate_expected_timestamps(start_date, end_date)
 
     print("Comparing and writing results...")
     status = [
@@ -0,0 +1,254 @@
+"""Persistent warm worker pool with shared-memory arrays for the radar stages.
+
+Every ``joblib.Parallel`` call starts fresh workers that import the radar stack
+again and rebuild the same geometry, clutter map and lookup tables. A pool from
+``start_pool`` is started once and passed to several stages
+(``radar_unzip.extract_all_zips``, ``radar_reflectivity_to_rainfall.main``,
+``radar_composite.main``, ``radar_extract.extract_stations``,
+``radar_plot.plot_frames``, all with ``pool=...``), which run their tasks through
+``pool_map``:
+
+- workers import the heavy modules (xradar, the radar helpers) once, in the
+  initializer, and keep their per-process caches between tasks. The rainfall
+  lookup tables stay in these caches (at most 256 kB per packing) rather than
+  in shared memory;
+- read-only arrays are copied once into ``multiprocessing.shared_memory`` and
+  attached by every worker without a copy: the lat/lon fields of the product
+  geometry, read by station extraction and plotting through ``shared_coords``,
+  and the clutter map, which is registered so that
+  ``radar_clutter.load_clutter_map`` serves it from shared memory;
+- ``pool_map(..., shared_result=True)`` returns array results through
+  shared-memory buffers instead of pickling them through the result pipe or
+  writing temporary files; ``extract_stations`` returns the sampled station
+  values of every batch of frames this way. On Windows a segment is freed when
+  its last handle closes, so there results are pickled as usual
+  (``SHARED_RESULTS``).
+
+Usage:
+    pool = start_pool(max_workers=4, clutter_map_path="data/clutter_map.npz",
+                      geometry_dir="data/radar_rainfall/rainfall_intensities")
+    try:
+        extract_all_zips(pool=pool)
+        main(clutter_map_path="data/clutter_map.npz", pool=pool)
+        rain = extract_stations("data/radar_rainfall/accumulated_rainfall/1h", stations, pool=pool)
+    finally:
+        close_pool(pool)
+"""
+import os
+import importlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Imported once per worker when the pool starts
+WARM_MODULES = ("numpy", "xradar", "scripts.radar_reflectivity_to_rainfall", "scripts.radar_unzip")
+CLUTTER_PREFIX = "clutter:"
+COORDS_PREFIX = "coords:"
+# Windows frees a segment as soon as its last handle closes, i.e. when the worker returns and
+# before the parent attaches; there array results go through the result pipe instead
+SHARED_RESULTS = os.name != "nt"
+
+# Arrays attached in this process (workers and the parent of a pool), by name
+_shared = {}
+# SharedMemory handles of the attached arrays, kept open while the views are used
+_segments = []
+
+
+# ----------------------------
+# Shared memory
+# ----------------------------
+def _attach_segment(name):
+    # Attach without tracking, the creator unlinks the segment
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument and always registers the segment with the
+        # resource tracker. Pool workers (fork and spawn) use the parent's tracker, which
+        # keeps one entry per name, so this repeats the creator's registration instead of
+        # adding a second owner; the creator's unlink() removes the entry, and the tracker
+        # does not unlink the segment when a worker exits. On Windows there is no tracker.
+        return shared_memory.SharedMemory(name=name)
+
+
+def to_shared(array):
+    # Copy an array into a new shared-memory segment, returns (segment, spec)
+    array = np.asarray(array, order="C")  # keeps 0-d arrays 0-d, unlike ascontiguousarray
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+    return segment, (segment.name, array.shape, array.dtype.str)
+
+
+def from_shared(spec, copy=True, unlink=False):
+    # Array of a spec; copy=False returns a read-only view that keeps the segment attached
+    name, shape, dtype = spec
+    # A segment handed over for unlinking stays tracked until unlink() releases it
+    segment = shared_memory.SharedMemory(name=name) if unlink else _attach_segment(name)
+    view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+    if not copy:
+        view.flags.writeable = False
+        _segments.append(segment)
+        return view
+    array = view.copy()
+    del view
+    segment.close()
+    if unlink:
+        segment.unlink()
+    return array
+
+
+def attach_arrays(specs):
+    # Attach named arrays ({name: spec}) as read-only views in this process
+    for name, spec in specs.items():
+        _shared[name] = from_shared(spec, copy=False)
+    _register_clutter_maps()
+
+
+def shared_array(name, default=None):
+    return _shared.get(name, default)
+
+
+def _register_clutter_maps():
+    # Rebuild clutter maps from their shared arrays and serve them through load_clutter_map
+    try:
+        from .radar_clutter import register_clutter_map
+    except ImportError:
+        from radar_clutter import register_clutter_map
+
+    maps = {}
+    for name, value in _shared.items():
+        if name.startswith(CLUTTER_PREFIX):
+            path, key = name[len(CLUTTER_PREFIX):].rsplit(":", 1)
+            maps.setdefault(path, {})[key] = value
+    for path, arrays in maps.items():
+        clutter_map = dict(arrays)
+        for key in ("first_timestamp", "last_timestamp"):
+            clutter_map[key] = str(clutter_map[key])
+        clutter_map["n_frames"] = int(clutter_map["n_frames"])
+        register_clutter_map(path, clutter_map)
+
+
+def shared_coords(geometry_dir):
+    """(lat, lon) fields of a product geometry: shared views in a pool, computed otherwise."""
+    key = os.path.abspath(geometry_dir)
+    if COORDS_PREFIX + key + ":lat" in _shared:
+        return _shared[COORDS_PREFIX + key + ":lat"], _shared[COORDS_PREFIX + key + ":lon"]
+    return _coords(geometry_dir)
+
+
+def _coords(geometry_dir):
+    try:
+        from .radar_extract import get_coords_arr
+    except ImportError:
+        from radar_extract import get_coords_arr
+
+    ranges = np.load(os.path.join(geometry_dir, "ranges.npy"))
+    azimuths = np.load(os.path.join(geometry_dir, "azimuths.npy"))
+    meta = np.load(os.path.join(geometry_dir, "radar_metadata.npy"))
+    return get_coords_arr(ranges, azimuths, float(meta[0]), float(meta[1]))
+
+
+# ----------------------------
+# Pool
+# ----------------------------
+def _init_worker(specs, warm_modules):
+    attach_arrays(specs)
+    for module in warm_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def start_pool(max_workers=None, arrays=None, clutter_map_path=None, geometry_dir=None,
+               warm_modules=WARM_MODULES):
+    """
+    Start a persistent process pool. arrays ({name: ndarray}), the clutter map and the
+    lat/lon fields of geometry_dir are placed once in shared memory for all workers.
+    Returns the pool dict to pass to the stages and to close_pool.
+    """
+    arrays = dict(arrays or {})
+    if clutter_map_path is not None:
+        try:
+            from .radar_clutter import load_clutter_map
+        except ImportError:
+            from radar_clutter import load_clutter_map
+
+        clutter_map = load_clutter_map(clutter_map_path)
+        for key, value in clutter_map.items():
+            if key != "source_mask":
+                arrays[f"{CLUTTER_PREFIX}{clutter_map_path}:{key}"] = np.asarray(value)
+        arrays[f"{CLUTTER_PREFIX}{clutter_map_path}:source_mask"] = clutter_map["source_mask"]
+    if geometry_dir is not None and os.path.exists(os.path.join(geometry_dir, "ranges.npy")):
+        lat, lon = _coords(geometry_dir)
+        key = os.path.abspath(geometry_dir)
+        arrays[COORDS_PREFIX + key + ":lat"] = lat
+        arrays[COORDS_PREFIX + key + ":lon"] = lon
+
+    segments, specs = [], {}
+    for name, array in arrays.items():
+        segment, specs[name] = to_shared(array)
+        segments.append(segment)
+    max_workers = max_workers or max(1, (os.cpu_count() or 1) - 1)
+    if os.name != "nt":
+        # Workers inherit a running tracker; started later, each would get its own, and the
+        # segments of shared results (unlinked here) would be reported as leaked at shutdown
+        resource_tracker.ensure_running()
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                   initargs=(specs, tuple(warm_modules)))
+    total = sum(array.nbytes for array in arrays.values())
+    print(f"Worker pool: {max_workers} workers, {len(arrays)} shared arrays ({total / 1024 ** 2:.1f} MB)")
+    return {"executor": executor, "segments": segments, "specs": specs, "max_workers": max_workers}
+
+
+def close_pool(pool):
+    # Stop the workers and free the shared arrays
+    pool["executor"].shutdown(wait=True)
+    for segment in pool["segments"]:
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    pool["segments"] = []
+
+
+def _call_shared(fn, args):
+    # Run fn in a worker; an array result goes back through a shared-memory buffer
+    result = fn(*args)
+    if not isinstance(result, np.ndarray) or not SHARED_RESULTS:
+        return False, result
+    segment, spec = to_shared(result)
+    segment.close()
+    return True, spec
+
+
+def pool_map(pool, fn, *iterables, shared_result=False, max_in_flight=None):
+    """
+    map(fn, *iterables) on the pool, results in order. With shared_result=True array
+    results are handed back through shared memory (other results, and all results on
+    Windows, as usual). max_in_flight caps the tasks submitted at a time (e.g. to a RAM
+    budget below the pool size); None lets every worker run.
+    """
+    call = partial(_call_shared, fn) if shared_result else fn
+    if max_in_flight is None or max_in_flight >= pool["max_workers"]:
+        # _call_shared takes the argument tuple as one argument
+        outputs = pool["executor"].map(call, *((zip(*iterables),) if shared_result else iterables))
+    else:
+        outputs = _bounded_map(pool["executor"], call, zip(*iterables), max(1, max_in_flight), shared_result)
+    if not shared_result:
+        return list(outputs)
+    return [from_shared(value, unlink=True) if is_array else value for is_array, value in outputs]
+
+
+def _bounded_map(executor, call, arg_tuples, max_in_flight, packed):
+    # Ordered map with at most max_in_flight submitted tasks; packed passes each tuple as one argument
+    pending = deque()
+    for args in arg_tuples:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(call, args) if packed else executor.submit(call, *args))
+    while pending:
+        yield pending.popleft().result()